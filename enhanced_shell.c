@@ -56,6 +56,9 @@ int alias_count = 0;
 job_t jobs[MAX_JOBS];
 int job_count = 0;
 int last_exit_status = 0;
+unsigned long lines_read = 0;
+int interactive = 1;
+const char *sentinel = "__PROMPT__";
 char current_dir[MAX_LINE];
 char home_dir[MAX_LINE];
 
@@ -78,6 +81,7 @@ void print_jobs(void);
 void cleanup_jobs(void);
 void handle_signals(void);
 void print_prompt(void);
+void print_sentinel(void);
 void initialize_shell(void);
 int has_wildcards(char *str);
 char **expand_wildcards(char **args);
@@ -87,20 +91,23 @@ void sigchld_handler(int sig) {
     int status;
     pid_t pid;
     
-    while ((pid = waitpid(-1, &status, WNOHANG)) > 0) {
-        // Find and mark job as completed
-        for (int i = 0; i < job_count; i++) {
-            if (jobs[i].pid == pid && jobs[i].active) {
-                jobs[i].active = 0;
-                printf("\n[%d] Done\t\t%s\n", jobs[i].job_id, jobs[i].command);
-                fflush(stdout);
-                break;
-            }
+    // Only reap background jobs; execute_command() waits for the
+    // foreground child itself and needs its exit status
+    for (int i = 0; i < job_count; i++) {
+        if (!jobs[i].active) continue;
+        pid = waitpid(jobs[i].pid, &status, WNOHANG);
+        if (pid > 0) {
+            jobs[i].active = 0;
+            printf("\n[%d] Done\t\t%s\n", jobs[i].job_id, jobs[i].command);
+            fflush(stdout);
         }
     }
 }
 
 void sigint_handler(int sig) {
+    if (!interactive) {
+        return;
+    }
     printf("\n");
     print_prompt();
     fflush(stdout);
@@ -112,6 +119,14 @@ void initialize_shell(void) {
     signal(SIGCHLD, sigchld_handler);
     signal(SIGINT, sigint_handler);
     
+    // When driven over a pipe (e.g. by the web server) skip the banner and
+    // prompts, and end each command with the caller's sentinel line
+    interactive = isatty(STDIN_FILENO);
+    char *custom_sentinel = getenv("MYSH_SENTINEL");
+    if (custom_sentinel && *custom_sentinel) {
+        sentinel = custom_sentinel;
+    }
+    
     // Get home directory
     struct passwd *pw = getpwuid(getuid());
     if (pw) {
@@ -162,6 +177,17 @@ void print_prompt(void) {
     fflush(stdout);
 }
 
+// Mark the end of a command's output: "<sentinel> <line> <exit status> <cwd>",
+// where line counts the input lines read so far, so the caller can tell
+// which line the status belongs to
+void print_sentinel(void) {
+    if (interactive) {
+        return;  // On a terminal the prompt does this job
+    }
+    printf("%s %lu %d %s\n", sentinel, lines_read, last_exit_status, current_dir);
+    fflush(stdout);
+}
+
 // Check if string contains wildcards
 int has_wildcards(char *str) {
     return strchr(str, '*') != NULL || strchr(str, '?') != NULL || strchr(str, '[') != NULL;
@@ -269,43 +295,42 @@ void expand_aliases(char **args) {
     
     for (int i = 0; i < alias_count; i++) {
         if (strcmp(args[0], aliases[i].name) == 0) {
-            // Parse alias value
+            // Tokenize the alias value locally; parse_input() returns the
+            // same static array that args points into
             char *alias_copy = strdup(aliases[i].value);
-            char **alias_args = parse_input(alias_copy);
-            
-            // Shift original args and prepend alias args
-            int alias_argc = 0;
-            while (alias_args[alias_argc] != NULL) alias_argc++;
+            char *saveptr = NULL;
             
             int orig_argc = 0;
             while (args[orig_argc] != NULL) orig_argc++;
             
             // Create new args array
-            static char *new_args[MAX_ARGS];
+            char *new_args[MAX_ARGS];
             int new_argc = 0;
             
             // Copy alias args
-            for (int j = 0; j < alias_argc && new_argc < MAX_ARGS - 1; j++) {
-                new_args[new_argc++] = strdup(alias_args[j]);
+            char *token = strtok_r(alias_copy, " \t\n", &saveptr);
+            while (token != NULL && new_argc < MAX_ARGS - 1) {
+                new_args[new_argc++] = strdup(token);
+                token = strtok_r(NULL, " \t\n", &saveptr);
             }
             
-            // Copy original args (skip first one)
-            for (int j = 1; j < orig_argc && new_argc < MAX_ARGS - 1; j++) {
-                new_args[new_argc++] = strdup(args[j]);
+            // Move original args (skip first one)
+            free(args[0]);
+            for (int j = 1; j < orig_argc; j++) {
+                if (new_argc < MAX_ARGS - 1) {
+                    new_args[new_argc++] = args[j];
+                } else {
+                    free(args[j]);
+                }
             }
             new_args[new_argc] = NULL;
             
             // Copy back to original args
-            for (int j = 0; j < new_argc; j++) {
-                if (args[j]) free(args[j]);
+            for (int j = 0; j <= new_argc; j++) {
                 args[j] = new_args[j];
             }
-            for (int j = new_argc; j < MAX_ARGS; j++) {
-                args[j] = NULL;
-            }
             
             free(alias_copy);
-            free(alias_args);
             break;
         }
     }
@@ -375,6 +400,7 @@ int is_builtin(char *cmd) {
 
 // Handle built-in commands
 void handle_builtin(char **args) {
+    last_exit_status = 0;
     if (strcmp(args[0], "cd") == 0) {
         change_directory(args[1]);
     } else if (strcmp(args[0], "pwd") == 0) {
@@ -424,7 +450,17 @@ void handle_builtin(char **args) {
         }
         printf("\n");
     }
-    last_exit_status = 0;
+}
+
+// Without a terminal, stdin is the server's command pipe; children that
+// read it would swallow the following commands and hang until timeout
+void detach_stdin(void) {
+    if (interactive) return;
+    int null_fd = open("/dev/null", O_RDONLY);
+    if (null_fd >= 0) {
+        dup2(null_fd, STDIN_FILENO);
+        close(null_fd);
+    }
 }
 
 // Execute command with background support
@@ -433,6 +469,7 @@ void execute_background(char **args) {
     if (pid == 0) {
         // Child process
         signal(SIGINT, SIG_DFL);
+        detach_stdin();
         execvp(args[0], args);
         perror("mysh");
         exit(EXIT_FAILURE);
@@ -466,6 +503,7 @@ void execute_command(char **args) {
     if (pid == 0) {
         // Child process
         signal(SIGINT, SIG_DFL);
+        detach_stdin();
         execvp(args[0], args);
         perror("mysh");
         exit(EXIT_FAILURE);
@@ -473,7 +511,11 @@ void execute_command(char **args) {
         // Parent process
         int status;
         waitpid(pid, &status, 0);
-        last_exit_status = WEXITSTATUS(status);
+        if (WIFSIGNALED(status)) {
+            last_exit_status = 128 + WTERMSIG(status);
+        } else {
+            last_exit_status = WEXITSTATUS(status);
+        }
     } else {
         perror("mysh: fork");
         last_exit_status = 1;
@@ -501,23 +543,29 @@ int main() {
     
     initialize_shell();
     
-    printf("%sWelcome to MyShell - Advanced Terminal%s\n", COLOR_CYAN, COLOR_RESET);
-    printf("Type 'help' for available commands\n\n");
+    if (interactive) {
+        printf("%sWelcome to MyShell - Advanced Terminal%s\n", COLOR_CYAN, COLOR_RESET);
+        printf("Type 'help' for available commands\n\n");
+    }
     
     while (1) {
         cleanup_jobs();
-        print_prompt();
+        if (interactive) {
+            print_prompt();
+        }
         
         if (!fgets(line, MAX_LINE, stdin)) {
             printf("\n");
             break;
         }
+        lines_read++;
         
         // Remove trailing newline
         line[strcspn(line, "\n")] = 0;
         
         // Skip empty lines
         if (strlen(line) == 0) {
+            print_sentinel();
             continue;
         }
         
@@ -535,6 +583,7 @@ int main() {
         // Parse command
         args = parse_input(line);
         if (args[0] == NULL) {
+            print_sentinel();
             continue;
         }
         
@@ -564,8 +613,7 @@ int main() {
             free(args[i]);
         }
         
-        printf("__PROMPT__\n");
-        fflush(stdout);
+        print_sentinel();
     }
     
     return 0;
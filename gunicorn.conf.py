@@ -0,0 +1,30 @@
+"""Gunicorn settings for CBash.
+
+Each worker imports the app after forking and starts its background
+subsystems once it is up, so nothing running in the parent is forked into
+it; they are stopped (flushing buffered audit entries) when it exits.
+"""
+import os
+import time
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+worker_class = 'eventlet'
+# One event loop per worker; scale out with more workers behind nginx
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+preload_app = False
+
+
+def post_fork(server, worker):
+    worker.cbash_forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    import server as cbash
+    cbash.after_fork()
+    cbash.start_subsystems()
+    worker.log.info("Worker %s booted in %.3fs", worker.pid, time.perf_counter() - worker.cbash_forked_at)
+
+
+def worker_exit(server, worker):
+    import server as cbash
+    cbash.stop_subsystems()
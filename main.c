@@ -8,15 +8,30 @@
 #define MAX_LINE 1024
 #define MAX_ARGS 64
 
-void execute(char **args) {
+int execute(char **args) {
+    int status = 0;
     pid_t pid = fork();
     if (pid == 0) {
         execvp(args[0], args);
         perror("mysh");
         exit(EXIT_FAILURE);
     } else {
-        wait(NULL);
+        waitpid(pid, &status, 0);
     }
+    if (WIFSIGNALED(status)) {
+        return 128 + WTERMSIG(status);
+    }
+    return WEXITSTATUS(status);
+}
+
+// Mark the end of a command's output: "<sentinel> <exit status> <cwd>"
+void print_sentinel(int status) {
+    char cwd[MAX_LINE];
+    const char *sentinel = getenv("MYSH_SENTINEL");
+    if (!sentinel || !*sentinel) sentinel = "__PROMPT__";
+    if (!getcwd(cwd, sizeof(cwd))) strcpy(cwd, "/");
+    printf("%s %d %s\n", sentinel, status, cwd);
+    fflush(stdout);
 }
 
 char **parse_input(char *line) {
@@ -41,8 +56,7 @@ int main() {
 
         args = parse_input(line);
         if (args[0] == NULL) {
-            printf("__PROMPT__\n");
-            fflush(stdout);
+            print_sentinel(0);
             free(args);
             continue;
         }
@@ -52,11 +66,10 @@ int main() {
             break;
         }
 
-        execute(args);
+        int status = execute(args);
         free(args);
 
-        printf("__PROMPT__\n");
-        fflush(stdout);
+        print_sentinel(status);
     }
     return 0;
 }
\ No newline at end of file
@@ -1,20 +1,49 @@
+import os
+
+# Async backend. 'threading' ties one OS thread to every in-flight command;
+# 'eventlet' runs handlers as green threads over non-blocking pipes and
+# sockets, so a single worker can hold many more sessions. Monkey patching
+# must happen before anything else imports socket, threading or subprocess.
+ASYNC_MODE = os.environ.get('CBASH_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
 from flask import Flask, render_template, jsonify, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import subprocess
-import os
 import re
 import shlex
 import json
 import time
+import codecs
+import tempfile
+import zlib
+import select
+import signal
+import pty
+import fcntl
+import termios
+import struct
 import psutil
 import threading
 import hashlib
+import errno
+import fnmatch
+import socket
+import secrets
 import jwt
+import base64
+import binascii
+import bisect
+from array import array
+from collections import OrderedDict, deque, namedtuple
 from datetime import datetime, timedelta
 from functools import wraps
 import redis
 from prometheus_client import Counter, Histogram, Gauge, generate_latest
 import logging
+import atexit
 from logging.handlers import RotatingFileHandler
 
 # Configure logging
@@ -23,28 +52,388 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-this')
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+# Set (e.g. redis://redis:6379) when running more than one worker, so emits
+# reach clients connected to any of them
+MESSAGE_QUEUE = os.environ.get('CBASH_MESSAGE_QUEUE') or None
+WORKER_ID = os.environ.get('CBASH_WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, message_queue=MESSAGE_QUEUE)
 
 # Redis connection for session management and caching
-try:
-    redis_client = redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379'), decode_responses=True)
-    redis_client.ping()
-    logger.info("Connected to Redis")
-except Exception as e:
-    logger.warning(f"Redis connection failed: {e}. Using in-memory storage.")
-    redis_client = None
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
+REDIS_MAX_CONNECTIONS = int(os.environ.get('CBASH_REDIS_MAX_CONNECTIONS', 50))
+REDIS_SOCKET_TIMEOUT = float(os.environ.get('CBASH_REDIS_SOCKET_TIMEOUT', 1))
+REDIS_CONNECT_TIMEOUT = float(os.environ.get('CBASH_REDIS_CONNECT_TIMEOUT', 1))
+# Consecutive failures that open the circuit, and how often it is probed
+REDIS_FAILURE_THRESHOLD = 3
+REDIS_HEALTH_CHECK_INTERVAL = 5
+
+class RedisManager:
+    """Shared Redis connection pool behind a circuit breaker.
+
+    Nothing touches the network until the first get(), which starts a
+    background health check; until a ping succeeds, or while the circuit is
+    open after repeated failures, get() returns None and callers use their
+    in-memory fallbacks. The health check closes the circuit again once
+    Redis answers.
+    """
+    
+    def __init__(self, url=REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS,
+                 socket_timeout=REDIS_SOCKET_TIMEOUT, connect_timeout=REDIS_CONNECT_TIMEOUT,
+                 failure_threshold=REDIS_FAILURE_THRESHOLD,
+                 health_check_interval=REDIS_HEALTH_CHECK_INTERVAL):
+        self.url = url
+        self.max_connections = max_connections
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.failure_threshold = failure_threshold
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.client = None
+        self.state = 'unknown'  # 'unknown', 'closed' (usable) or 'open'
+        self.failures = 0
+        self.started = False
+        self.stopped = False
+    
+    def start(self):
+        """Create the pool and start health checks (done lazily on first get)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            pool = redis.ConnectionPool.from_url(
+                self.url,
+                max_connections=self.max_connections,
+                socket_timeout=self.socket_timeout,
+                socket_connect_timeout=self.connect_timeout,
+                health_check_interval=30,
+                decode_responses=True
+            )
+            self.client = redis.Redis(connection_pool=pool)
+        socketio.start_background_task(self._health_check)
+    
+    def get(self):
+        """The shared client, or None if Redis isn't currently usable"""
+        if not self.started:
+            self.start()
+        return self.client if self.state == 'closed' else None
+    
+    def stop(self):
+        """Stop health checks and close the pool's connections"""
+        with self.lock:
+            self.stopped = True
+            client, self.state = self.client, 'open'
+        if client is not None:
+            client.connection_pool.disconnect()
+    
+    def report_failure(self, error):
+        """Record a failed call; enough in a row open the circuit"""
+        redis_errors.inc()
+        with self.lock:
+            self.failures += 1
+            if self.state == 'closed' and self.failures >= self.failure_threshold:
+                self._set_state('open', error)
+    
+    def report_success(self):
+        self.failures = 0
+    
+    def check(self):
+        """Ping Redis once and update the circuit; returns True if healthy"""
+        try:
+            self.client.ping()
+        except redis.RedisError as e:
+            with self.lock:
+                self._set_state('open', e)
+            return False
+        with self.lock:
+            self.failures = 0
+            self._set_state('closed')
+        return True
+    
+    def _set_state(self, state, error=None):
+        if state == self.state:
+            return
+        if state == 'closed':
+            logger.info("Connected to Redis")
+        else:
+            logger.warning(f"Redis unavailable: {error}. Using in-memory storage.")
+        self.state = state
+        redis_up.set(1 if state == 'closed' else 0)
+    
+    def _health_check(self):
+        while not self.stopped:
+            self.check()
+            socketio.sleep(self.health_check_interval)
+
+redis_manager = RedisManager()
+
+def get_redis():
+    """Shared Redis client, or None when callers should use their fallbacks"""
+    return redis_manager.get()
+
+# Commands are counted by family rather than by whatever the user typed,
+# which would make every typo a new label value
+COMMAND_FAMILIES = {
+    'builtin': ['cd', 'pwd', 'clear', 'echo', 'export', 'env', 'alias', 'unalias', 'unset', 'history', 'jobs',
+                'exit', 'help', 'true', 'false'],
+    'files': ['ls', 'cat', 'head', 'tail', 'less', 'more', 'cp', 'mv', 'rm', 'mkdir', 'rmdir', 'touch', 'ln',
+              'chmod', 'chown', 'find', 'tree', 'stat', 'file', 'du', 'df', 'wc', 'tar', 'gzip', 'gunzip', 'zip',
+              'unzip', 'md5sum', 'sha256sum'],
+    'text': ['grep', 'egrep', 'sed', 'awk', 'sort', 'uniq', 'cut', 'tr', 'diff', 'printf', 'xargs', 'jq'],
+    'vcs': ['git'],
+    'dev': ['python', 'python3', 'pip', 'pip3', 'node', 'npm', 'npx', 'make', 'gcc', 'cc', 'g++', 'java',
+            'javac', 'go', 'cargo', 'rustc'],
+    'network': ['curl', 'wget', 'ping', 'ssh', 'scp', 'nc', 'dig', 'nslookup'],
+    'process': ['ps', 'top', 'htop', 'kill', 'pkill', 'sleep', 'time', 'timeout', 'nohup'],
+    'editor': ['vim', 'vi', 'nano', 'emacs'],
+    'cbash': ['cbash'],
+}
+COMMAND_FAMILY_OF = {name: family for family, names in COMMAND_FAMILIES.items() for name in names}
+
+# Histogram buckets, in seconds unless noted. Stages run from sub-millisecond
+# (emits, output handling) to the command timeout (execution)
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COMMAND_DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+EMIT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+POLICY_BUCKETS = (0.0000005, 0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.001)
+OUTPUT_BYTES_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)  # Bytes
 
 # Prometheus metrics
-command_counter = Counter('cbash_commands_total', 'Total commands executed', ['command', 'status'])
-command_duration = Histogram('cbash_command_duration_seconds', 'Command execution time')
+redis_up = Gauge('cbash_redis_up', 'Whether Redis is reachable (circuit closed)')
+redis_errors = Counter('cbash_redis_errors_total', 'Failed Redis calls')
+command_counter = Counter('cbash_commands_total', 'Total commands executed', ['family', 'status'])
+command_duration = Histogram('cbash_command_duration_seconds', 'Command execution time', ['family'],
+                             buckets=COMMAND_DURATION_BUCKETS)
+command_stages = Histogram('cbash_command_stage_seconds', 'Time commands spend in each stage of handling', ['stage'],
+                           buckets=STAGE_BUCKETS)
+command_output_bytes = Histogram('cbash_command_output_bytes', 'Output produced per command', ['family'],
+                                 buckets=OUTPUT_BYTES_BUCKETS)
+completion_duration = Histogram('cbash_completion_seconds', 'Time to answer a completion request', ['kind'],
+                                buckets=EMIT_BUCKETS)
+policy_duration = Histogram('cbash_policy_seconds', 'Time to decide whether a command line may run', ['cache'],
+                            buckets=POLICY_BUCKETS)
+emit_duration = Histogram('cbash_emit_seconds', 'Time to hand an event to Socket.IO', ['event'], buckets=EMIT_BUCKETS)
 active_sessions = Gauge('cbash_active_sessions', 'Number of active sessions')
 system_cpu = Gauge('cbash_system_cpu_percent', 'System CPU usage')
 system_memory = Gauge('cbash_system_memory_percent', 'System memory usage')
+command_queue_length = Gauge('cbash_command_queue_length', 'Commands waiting for an execution slot')
+shell_pool_size = Gauge('cbash_shell_pool_idle', 'Pre-spawned shells waiting in the pool')
+shell_pool_requests = Counter('cbash_shell_pool_requests_total', 'Shell requests served from the pool', ['result'])
+sessions_reaped = Counter('cbash_sessions_reaped_total', 'Sessions torn down by the reaper', ['reason'])
+sessions_alive = Gauge('cbash_sessions_alive', 'Sessions held in memory')
+shells_alive = Gauge('cbash_shells_alive', 'Session shell processes currently assigned')
+audit_pending = Gauge('cbash_audit_pending', 'Audit entries waiting to be written to Redis')
+rate_limited = Counter('cbash_rate_limited_total', 'Requests refused by the rate limiter', ['scope'])
+output_frames = Counter('cbash_output_frames_total', 'Output frames sent to clients', ['encoding'])
+output_truncated = Counter('cbash_output_truncated_total', 'Commands whose output went over the budget')
+output_omitted_bytes = Counter('cbash_output_omitted_bytes_total', 'Output bytes left out of the terminal')
+output_wire_bytes = Counter('cbash_output_wire_bytes_total', 'Output payload bytes sent to clients after encoding')
+audit_dropped = Counter('cbash_audit_dropped_total', 'Audit entries dropped because the buffer was full')
+output_cache_requests = Counter('cbash_output_cache_requests_total', 'Cacheable commands, by whether the output cache served them', ['result'])
+output_cache_hit_ratio = Gauge('cbash_output_cache_hit_ratio', 'Share of cacheable commands served from the output cache')
+output_cache_bytes = Gauge('cbash_output_cache_bytes', 'Command output held in the output cache')
+# Per session, from its cgroup; series are removed when the session ends
+session_cpu_seconds = Gauge('cbash_session_cpu_seconds', 'CPU time used by a session', ['session'])
+session_cpu_throttled_seconds = Gauge('cbash_session_cpu_throttled_seconds', 'Time a session was held back by its CPU quota', ['session'])
+session_memory_bytes = Gauge('cbash_session_memory_bytes', 'Memory charged to a session', ['session'])
+session_pids = Gauge('cbash_session_pids', 'Processes and threads in a session', ['session'])
+session_oom_kills = Gauge('cbash_session_oom_kills', 'Processes killed for going over the session memory limit', ['session'])
+# This worker process, labelled so workers behind one target can be told apart
+worker_cpu = Gauge('cbash_worker_cpu_percent', 'CPU used by this worker process', ['worker'])
+worker_memory = Gauge('cbash_worker_memory_rss_bytes', 'Resident memory of this worker process', ['worker'])
+worker_threads = Gauge('cbash_worker_threads', 'OS threads in this worker process', ['worker'])
+worker_open_fds = Gauge('cbash_worker_open_fds', 'File descriptors open in this worker process', ['worker'])
+worker_running_commands = Gauge('cbash_worker_running_commands', 'Commands streaming output in this worker', ['worker'])
+
+def command_family(cmd_name):
+    """Bounded metric label for a command name"""
+    return COMMAND_FAMILY_OF.get(os.path.basename(cmd_name), 'other')
+
+def timed_emit(event, payload, to):
+    """socketio.emit, recording how long handing the event over took; returns that"""
+    started = time.perf_counter()
+    socketio.emit(event, payload, to=to)
+    elapsed = time.perf_counter() - started
+    emit_duration.labels(event=event).observe(elapsed)
+    return elapsed
 
 # Global state
-active_sessions_count = 0
-user_sessions = {}
-command_history = []
+user_sessions = OrderedDict()  # Least recently active first
+session_aliases = {}  # Socket id of a reattached client -> its session id
+scrollbacks = {}
+spilled_outputs = {}  # Output id -> full output of a truncated command
+session_states = {}
+command_history = deque(maxlen=1000)  # Recent audit entries, oldest first
+active_streams = {}
+pty_sessions = {}
+
+# Command scheduling: global cap on concurrently running commands and how
+# many commands one session may have waiting behind its current one
+MAX_CONCURRENT_COMMANDS = int(os.environ.get('CBASH_MAX_CONCURRENT_COMMANDS', 32))
+MAX_QUEUED_COMMANDS = int(os.environ.get('CBASH_MAX_QUEUED_COMMANDS', 10))
+
+# Output streaming configuration
+COMMAND_TIMEOUT = 30
+STREAM_CHUNK_SIZE = int(os.environ.get('CBASH_STREAM_CHUNK_SIZE', 4096))
+STREAM_WINDOW_BYTES = int(os.environ.get('CBASH_STREAM_WINDOW_BYTES', 256 * 1024))
+STREAM_ACK_TIMEOUT = float(os.environ.get('CBASH_STREAM_ACK_TIMEOUT', 5))
+# Small writes are coalesced into frames of up to OUTPUT_FRAME_BYTES, sent at
+# most OUTPUT_COALESCE_DELAY seconds after their first byte. Clients that ask
+# for binary frames get raw UTF-8, deflated from DEFLATE_MIN_BYTES up
+OUTPUT_FRAME_BYTES = int(os.environ.get('CBASH_OUTPUT_FRAME_BYTES', 16 * 1024))
+OUTPUT_COALESCE_DELAY = float(os.environ.get('CBASH_OUTPUT_COALESCE_MS', 5)) / 1000
+DEFLATE_MIN_BYTES = int(os.environ.get('CBASH_DEFLATE_MIN_BYTES', 4096))
+# Per-command output budget; past it output is dropped from the terminal and,
+# with spilling on, the whole output goes to a temp file (up to
+# OUTPUT_SPILL_MAX_BYTES) that can be paged through over HTTP for
+# OUTPUT_SPILL_TTL seconds. Output that stays within budget never touches it
+OUTPUT_MAX_BYTES = int(os.environ.get('CBASH_OUTPUT_MAX_BYTES', 1024 * 1024))
+OUTPUT_MAX_LINES = int(os.environ.get('CBASH_OUTPUT_MAX_LINES', 10000))
+OUTPUT_SPILL = os.environ.get('CBASH_OUTPUT_SPILL', '1') == '1'
+OUTPUT_SPILL_DIR = os.environ.get('CBASH_OUTPUT_SPILL_DIR') or None
+OUTPUT_SPILL_MAX_BYTES = int(os.environ.get('CBASH_OUTPUT_SPILL_MAX_BYTES', 64 * 1024 * 1024))
+OUTPUT_SPILL_TTL = float(os.environ.get('CBASH_OUTPUT_SPILL_TTL', 3600))
+OUTPUT_SPILL_MEMORY = 64 * 1024  # Spill files stay in memory up to this size
+OUTPUT_PAGE_BYTES = 256 * 1024
+
+# Output cache (opt-in): successful output of the read-only commands in
+# CBASH_OUTPUT_CACHE_COMMANDS is kept, up to CBASH_OUTPUT_CACHE_BYTES in all,
+# and replayed for the same command in the same directory for as long as the
+# files it names are unchanged, but never past CBASH_OUTPUT_CACHE_TTL seconds
+OUTPUT_CACHE = os.environ.get('CBASH_OUTPUT_CACHE', '0') == '1'
+OUTPUT_CACHE_BYTES = int(os.environ.get('CBASH_OUTPUT_CACHE_BYTES', 32 * 1024 * 1024))
+OUTPUT_CACHE_TTL = float(os.environ.get('CBASH_OUTPUT_CACHE_TTL', 60))
+OUTPUT_CACHE_COMMANDS = [c.strip() for c in os.environ.get(
+    'CBASH_OUTPUT_CACHE_COMMANDS',
+    'ls,cat,head,wc,du,stat,tree,md5sum,sha256sum,git log,git show,git blame'
+).split(',') if c.strip()]
+# mysh builtins that change how later commands behave in ways we can't see
+SHELL_STATE_COMMANDS = {'alias', 'unalias', 'export', 'unset'}
+
+# Persistent session shells
+MYSH_PATH = os.environ.get('CBASH_SHELL_PATH', './mysh')
+SHELL_INTERRUPT_GRACE = 2
+SHELL_MAX_LINE = 1023  # mysh reads lines into a MAX_LINE (1024) byte buffer
+SHELL_HANDSHAKE_TIMEOUT = 5  # For a new shell to answer its first (empty) line
+
+# Warm pool of pre-spawned shells handed out on connect. Shells idle in the
+# pool longer than SHELL_POOL_MAX_IDLE seconds are replaced; a session shell
+# that has run SHELL_MAX_COMMANDS commands is retired (0 = never). A failed
+# spawn is retried after SHELL_POOL_RETRY_MIN seconds, doubling up to
+# SHELL_POOL_RETRY_MAX while it keeps failing
+SHELL_POOL_MIN = int(os.environ.get('CBASH_SHELL_POOL_MIN', 4))
+SHELL_POOL_MAX = int(os.environ.get('CBASH_SHELL_POOL_MAX', 32))
+SHELL_POOL_MAX_IDLE = float(os.environ.get('CBASH_SHELL_POOL_MAX_IDLE', 600))
+SHELL_MAX_COMMANDS = int(os.environ.get('CBASH_SHELL_MAX_COMMANDS', 0))
+SHELL_POOL_RETRY_MIN = 0.5
+SHELL_POOL_RETRY_MAX = 30
+# mysh only splits on whitespace, so anything needing real shell syntax
+# (pipes, redirection, quoting, substitution, chaining, several lines)
+# goes to /bin/sh
+SHELL_SYNTAX = ['|', '>', '<', ';', '&', '"', "'", '`', '$(', '\n', '\r']
+SHELL_SYNTAX_PATTERN = re.compile('|'.join(re.escape(token) for token in SHELL_SYNTAX))
+DEFAULT_SESSION_ENV = {'COLUMNS': '120', 'LINES': '30'}  # Terminal size
+
+# Command policy: CBASH_POLICY_FILE is a JSON file of per-role allow/deny
+# rules, re-read within CBASH_POLICY_RELOAD_INTERVAL seconds of changing.
+# Without one, DEFAULT_POLICY's blocklist applies to every session. Parsed
+# command lines and policy decisions are cached, COMMAND_CACHE_SIZE each
+POLICY_FILE = os.environ.get('CBASH_POLICY_FILE', '')
+POLICY_RELOAD_INTERVAL = float(os.environ.get('CBASH_POLICY_RELOAD_INTERVAL', 2))
+COMMAND_CACHE_SIZE = int(os.environ.get('CBASH_COMMAND_CACHE_SIZE', 10000))
+DEFAULT_POLICY = {
+    'default_role': 'default',
+    'roles': {
+        'default': {
+            'default': 'allow',
+            'deny': [
+                'rm -*r* /',
+                'rm -*r* /[*]',
+                'rm --recursive /',
+                'rm --recursive /[*]',
+                'mkfs*',
+                'dd if=*',
+                'format',
+                r're:(\S+)\s*\(\s*\)\s*\{[^}]*\1\s*\|\s*\1',  # Fork bomb, e.g. :(){ :|:& };:
+            ]
+        }
+    }
+}
+
+# Tab completion: at most COMPLETION_MAX_MATCHES candidates per request;
+# each session keeps its COMPLETION_DIR_CACHE_SIZE most recently completed
+# directory listings, re-read when the directory's mtime changes
+COMPLETION_MAX_MATCHES = int(os.environ.get('CBASH_COMPLETION_MAX_MATCHES', 200))
+COMPLETION_DIR_CACHE_SIZE = int(os.environ.get('CBASH_COMPLETION_DIR_CACHE_SIZE', 8))
+COMPLETION_MAX_LINE = 4096
+
+# PTY mode: with CBASH_PTY_ENABLED=1, clients that ask for it (connect auth
+# ``pty``) get mysh on a pseudo-terminal and send raw keystrokes, so
+# full-screen and interactive programs work. Off by default: line mode is
+# where output budgets, builtins, caching and completion apply. Keystroke
+# messages over PTY_INPUT_MAX_BYTES are dropped
+PTY_ENABLED = os.environ.get('CBASH_PTY_ENABLED', '0') == '1'
+PTY_INPUT_MAX_BYTES = 64 * 1024
+PTY_TERM = 'xterm-256color'
+
+# Resource limits: with CBASH_CGROUP_ROOT set to a cgroup v2 directory the
+# server may manage (delegated to its user), each session's processes run in
+# a child group limited to CBASH_SESSION_CPU cores, CBASH_SESSION_MEMORY_MAX
+# bytes and CBASH_SESSION_PIDS_MAX tasks (0 = no limit). Unset disables it
+CGROUP_ROOT = os.environ.get('CBASH_CGROUP_ROOT', '')
+SESSION_CPU = float(os.environ.get('CBASH_SESSION_CPU', 0.5))
+SESSION_MEMORY_MAX = int(os.environ.get('CBASH_SESSION_MEMORY_MAX', 256 * 1024 * 1024))
+SESSION_PIDS_MAX = int(os.environ.get('CBASH_SESSION_PIDS_MAX', 64))
+CGROUP_CPU_PERIOD = 100000  # Microseconds
+
+# Session reaping: sessions idle longer than SESSION_IDLE_TIMEOUT seconds are
+# evicted, and past MAX_SESSIONS the least recently active one makes room
+SESSION_IDLE_TIMEOUT = float(os.environ.get('CBASH_SESSION_IDLE_TIMEOUT', 1800))
+MAX_SESSIONS = int(os.environ.get('CBASH_MAX_SESSIONS', 500))
+REAPER_INTERVAL = 30
+
+# Reattaching: a dropped client has SESSION_REATTACH_GRACE seconds to come
+# back (0 ends sessions on disconnect) and is sent the output it missed, from
+# the last SCROLLBACK_BYTES bytes of the session's terminal output
+SESSION_REATTACH_GRACE = float(os.environ.get('CBASH_REATTACH_GRACE', 120))
+SCROLLBACK_BYTES = int(os.environ.get('CBASH_SCROLLBACK_BYTES', 64 * 1024))
+
+# Rate limits on the command event, per session and per client IP
+COMMAND_RATE_LIMIT = int(os.environ.get('CBASH_COMMAND_RATE_LIMIT', 50))
+COMMAND_RATE_LIMIT_PER_IP = int(os.environ.get('CBASH_COMMAND_RATE_LIMIT_PER_IP', 200))
+COMMAND_RATE_WINDOW = 60
+RATE_LIMIT_LOCAL_KEYS = 10000  # Buckets kept by the in-process fallback
+
+# Audit logging: entries are buffered in memory and written to Redis in
+# batches of up to AUDIT_BATCH_SIZE, at least every AUDIT_FLUSH_INTERVAL
+# seconds. Past AUDIT_BUFFER_SIZE unwritten entries the oldest are dropped
+AUDIT_BUFFER_SIZE = int(os.environ.get('CBASH_AUDIT_BUFFER_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('CBASH_AUDIT_BATCH_SIZE', 100))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('CBASH_AUDIT_FLUSH_INTERVAL', 1))
+AUDIT_HISTORY_LENGTH = 1000
+
+# Command history in Redis: a stream of audit entries overall, one per
+# session and one per client IP, plus prefix indexes (overall and per
+# session) for search. The overall stream and index keep about
+# HISTORY_MAX_ENTRIES entries and per-session/IP ones HISTORY_SCOPE_ENTRIES;
+# index entries older than HISTORY_RETENTION seconds are pruned, and
+# per-session/IP keys expire that long after their last command
+HISTORY_MAX_ENTRIES = int(os.environ.get('CBASH_HISTORY_MAX_ENTRIES', 1000000))
+HISTORY_SCOPE_ENTRIES = int(os.environ.get('CBASH_HISTORY_SCOPE_ENTRIES', 10000))
+HISTORY_RETENTION = float(os.environ.get('CBASH_HISTORY_RETENTION', 7 * 24 * 3600))
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+HISTORY_SCAN_LIMIT = 5000  # Entries examined per page when filtering
+HISTORY_PRUNE_BATCH = 1000
+
+# System sampling: one task samples host and worker usage every
+# SYSTEM_SAMPLE_INTERVAL seconds into a ring buffer of SYSTEM_HISTORY_SAMPLES
+# samples, and every SYSTEM_FLUSH_INTERVAL seconds writes the new ones to this
+# worker's Redis key, which keeps the last SYSTEM_REDIS_SAMPLES
+SYSTEM_SAMPLE_INTERVAL = float(os.environ.get('CBASH_SYSTEM_SAMPLE_INTERVAL', 10))
+SYSTEM_HISTORY_SAMPLES = int(os.environ.get('CBASH_SYSTEM_HISTORY_SAMPLES', 8640))  # A day at 10s
+SYSTEM_FLUSH_INTERVAL = float(os.environ.get('CBASH_SYSTEM_FLUSH_INTERVAL', 60))
+SYSTEM_REDIS_SAMPLES = 1000
+SYSTEM_HISTORY_MAX_POINTS = 1000
 
 # Note: Shell processes are now managed by ShellManager class
 # shell_process = subprocess.Popen(['./mysh'],
@@ -65,6 +454,17 @@ def generate_session_token(user_id):
     }
     return jwt.encode(payload, app.config['SECRET_KEY'], algorithm='HS256')
 
+def generate_role_token(role):
+    """Token a client presents (connect auth ``role_token``) to get a policy role"""
+    return jwt.encode({'role': role, 'iat': datetime.utcnow()}, app.config['SECRET_KEY'], algorithm='HS256')
+
+def verify_role_token(token):
+    """The role a role token grants, or None"""
+    try:
+        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256']).get('role')
+    except jwt.InvalidTokenError:
+        return None
+
 def verify_session_token(token):
     """Verify JWT token"""
     try:
@@ -75,111 +475,2719 @@ def verify_session_token(token):
     except jwt.InvalidTokenError:
         return None
 
+# Rate limiting
+class RateLimiter:
+    """Sliding-window rate limits kept in Redis, with a local fallback.
+
+    A check against any number of keys is one atomic script call: each key
+    is a sorted set of request timestamps, and the request is only counted
+    if every key is under its limit. Without Redis, per-key token buckets
+    in this process stand in, so limits still apply (per worker).
+    """
+    
+    SCRIPT = """
+local now = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    local limit = tonumber(ARGV[i * 2 + 1])
+    local window = tonumber(ARGV[i * 2 + 2])
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+    if redis.call('ZCARD', key) >= limit then
+        return i
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[2])
+    redis.call('PEXPIRE', key, ARGV[i * 2 + 2])
+end
+return 0
+"""
+    
+    def __init__(self, max_local_keys=RATE_LIMIT_LOCAL_KEYS):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()  # key -> [tokens, updated_at]
+        self.max_local_keys = max_local_keys
+        self.script = None
+        self.script_client = None
+    
+    def allow(self, limits):
+        """Count one request against [(key, max_requests, window)]; False if over"""
+        client = get_redis()
+        if client:
+            try:
+                allowed = self._allow_redis(client, limits)
+                redis_manager.report_success()
+                return allowed
+            except redis.RedisError as e:
+                logger.warning(f"Rate limiter falling back to local buckets: {e}")
+                redis_manager.report_failure(e)
+        return self._allow_local(limits)
+    
+    def _allow_redis(self, client, limits):
+        if self.script_client is not client:
+            self.script = client.register_script(self.SCRIPT)
+            self.script_client = client
+        now_ms = int(time.time() * 1000)
+        args = [now_ms, f"{now_ms}:{secrets.token_hex(4)}"]
+        for _, max_requests, window in limits:
+            args.extend([max_requests, int(window * 1000)])
+        return self.script(keys=[key for key, _, _ in limits], args=args) == 0
+    
+    def _allow_local(self, limits):
+        now = time.monotonic()
+        with self.lock:
+            buckets = []
+            for key, max_requests, window in limits:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = [float(max_requests), now]
+                else:
+                    self.buckets.move_to_end(key)
+                    refill = (now - bucket[1]) * max_requests / window
+                    bucket[0] = min(float(max_requests), bucket[0] + refill)
+                    bucket[1] = now
+                buckets.append(bucket)
+            while len(self.buckets) > self.max_local_keys:
+                self.buckets.popitem(last=False)
+            if any(bucket[0] < 1 for bucket in buckets):
+                return False
+            for bucket in buckets:
+                bucket[0] -= 1
+            return True
+
+rate_limiter = RateLimiter()
+
+def client_ip():
+    """Address of the client behind the current request"""
+    return request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
+
 def rate_limit(max_requests=100, window=60):
     """Rate limiting decorator"""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-            key = f"rate_limit:{client_ip}"
-            
-            if redis_client:
-                current = redis_client.get(key)
-                if current is None:
-                    redis_client.setex(key, window, 1)
-                elif int(current) >= max_requests:
-                    return jsonify({'error': 'Rate limit exceeded'}), 429
-                else:
-                    redis_client.incr(key)
+            key = f"rate_limit:{f.__name__}:{client_ip()}"
+            if not rate_limiter.allow([(key, max_requests, window)]):
+                rate_limited.labels(scope='http').inc()
+                return jsonify({'error': 'Rate limit exceeded'}), 429
             
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
 # System monitoring
-def monitor_system():
-    """Background thread to monitor system metrics"""
-    while True:
+class RingBuffer:
+    """Fixed-size time series, one preallocated array of doubles per field.
+
+    Once full, each sample overwrites the oldest; nothing is allocated per
+    sample. ``total`` counts every sample ever added, so readers can ask
+    for what came after a point they have already seen.
+    """
+
+    def __init__(self, fields, capacity):
+        self.fields = ('time',) + tuple(fields)
+        self.capacity = capacity
+        self.columns = {name: array('d', bytes(8 * capacity)) for name in self.fields}
+        self.next = 0  # Slot the next sample goes in
+        self.count = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, values):
+        with self.lock:
+            i = self.next
+            self.columns['time'][i] = timestamp
+            for name in self.fields[1:]:
+                self.columns[name][i] = values[name]
+            self.next = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.total += 1
+
+    def latest(self):
+        """The newest sample as a dict, or None"""
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.next - 1) % self.capacity
+            return {name: column[i] for name, column in self.columns.items()}
+
+    def since(self, total):
+        """(current total, samples added after the ``total``-th), oldest first"""
+        with self.lock:
+            n = min(self.total - total, self.count)
+            rows = []
+            for k in range(n):
+                i = (self.next - n + k) % self.capacity
+                rows.append({name: column[i] for name, column in self.columns.items()})
+            return self.total, rows
+
+    def series(self, start=0, points=None):
+        """Samples from time ``start`` on, oldest first, as one list per field.
+
+        With ``points``, consecutive samples are averaged so at most that
+        many are returned (each bucket keeps the time of its first sample).
+        """
+        with self.lock:
+            if self.count < self.capacity:
+                ordered = {name: column[:self.count] for name, column in self.columns.items()}
+            else:
+                ordered = {name: column[self.next:] + column[:self.next] for name, column in self.columns.items()}
+        first = bisect.bisect_left(ordered['time'], start)
+        n = len(ordered['time']) - first
+        step = -(-n // points) if points and n > points else 1
+        result = {}
+        for name, column in ordered.items():
+            values = column[first:]
+            if step == 1:
+                result[name] = values.tolist()
+            elif name == 'time':
+                result[name] = values[::step].tolist()
+            else:
+                result[name] = [sum(values[i:i + step]) / len(values[i:i + step]) for i in range(0, n, step)]
+        return result
+
+class SystemSampler:
+    """Samples host and worker usage from one background task.
+
+    Handlers read the latest sample rather than calling psutil on every
+    request, and history is served from the ring buffer. Samples are
+    written to Redis in batches, one pipelined round trip per flush, under
+    a key per worker so workers don't write over each other.
+    """
+
+    FIELDS = ('cpu', 'memory', 'disk', 'worker_cpu', 'worker_rss')
+
+    def __init__(self, interval=SYSTEM_SAMPLE_INTERVAL, capacity=SYSTEM_HISTORY_SAMPLES,
+                 flush_interval=SYSTEM_FLUSH_INTERVAL):
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.buffer = RingBuffer(self.FIELDS, capacity)
+        self.flushed = 0  # buffer.total as of the last successful flush
+        self.key = f"cbash:metrics:{WORKER_ID}"
+        self.process = psutil.Process()
+        self.lock = threading.Lock()
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        """Start the sampling task (done lazily on first connect or read)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            # Whichever process starts sampling is the one measured, even
+            # if this object was created before a fork
+            self.key = f"cbash:metrics:{WORKER_ID}"
+            self.process = psutil.Process()
+        socketio.start_background_task(self._run)
+
+    def stop(self):
+        """Stop sampling and write out what Redis hasn't seen yet"""
+        self.stopped = True
+        if self.started:
+            self.flush()
+
+    def sample(self):
+        """Take a sample now and record it; returns it"""
+        with self.process.oneshot():
+            worker_cpu_percent = self.process.cpu_percent()
+            worker_rss = self.process.memory_info().rss
+            worker_threads.labels(worker=WORKER_ID).set(self.process.num_threads())
+            worker_open_fds.labels(worker=WORKER_ID).set(self.process.num_fds())
+        sample = {
+            'time': time.time(),
+            'cpu': psutil.cpu_percent(),  # Since the previous sample
+            'memory': psutil.virtual_memory().percent,
+            'disk': psutil.disk_usage('/').percent,
+            'worker_cpu': worker_cpu_percent,
+            'worker_rss': worker_rss
+        }
+        self.buffer.append(sample['time'], sample)
+        system_cpu.set(sample['cpu'])
+        system_memory.set(sample['memory'])
+        worker_cpu.labels(worker=WORKER_ID).set(worker_cpu_percent)
+        worker_memory.labels(worker=WORKER_ID).set(worker_rss)
+        worker_running_commands.labels(worker=WORKER_ID).set(len(active_streams))
+        return sample
+
+    def latest(self):
+        """The most recent sample, taking one if there is none yet"""
+        if not self.started:
+            self.start()
+        return self.buffer.latest() or self.sample()
+
+    def history(self, seconds, points):
+        if not self.started:
+            self.start()
+        return self.buffer.series(start=time.time() - seconds, points=points)
+
+    def flush(self):
+        """Write samples not yet in Redis in one round trip; False if Redis is unavailable"""
+        client = get_redis()
+        if client is None:
+            return False
+        total, rows = self.buffer.since(self.flushed)
+        if not rows:
+            return True
         try:
-            cpu_percent = psutil.cpu_percent()
-            memory_percent = psutil.virtual_memory().percent
-            
-            system_cpu.set(cpu_percent)
-            system_memory.set(memory_percent)
-            
-            # Store metrics in Redis for historical data
-            if redis_client:
-                timestamp = int(time.time())
-                redis_client.zadd('metrics:cpu', {timestamp: cpu_percent})
-                redis_client.zadd('metrics:memory', {timestamp: memory_percent})
-                
-                # Keep only last 1000 data points
-                redis_client.zremrangebyrank('metrics:cpu', 0, -1001)
-                redis_client.zremrangebyrank('metrics:memory', 0, -1001)
-                
+            pipe = client.pipeline(transaction=False)
+            pipe.zadd(self.key, {json.dumps(row): row['time'] for row in rows})
+            pipe.zremrangebyrank(self.key, 0, -SYSTEM_REDIS_SAMPLES - 1)
+            # Stopped workers' history goes away on its own
+            pipe.expire(self.key, int(max(SYSTEM_REDIS_SAMPLES * self.interval, self.flush_interval * 2)))
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.error(f"System metrics flush failed: {e}")
+            redis_manager.report_failure(e)
+            return False
+        self.flushed = total
+        return True
+
+    def _run(self):
+        last_flush = time.time()
+        while not self.stopped:
+            try:
+                self.sample()
+                if time.time() - last_flush >= self.flush_interval:
+                    last_flush = time.time()
+                    self.flush()
+            except Exception as e:
+                logger.error(f"System monitoring error: {e}")
+            socketio.sleep(self.interval)
+
+system_sampler = SystemSampler()
+
+# Audit logging
+class AuditLog:
+    """Buffers command audit entries and writes them to Redis in the background.
+
+    Recording never touches the network, so command latency doesn't depend
+    on Redis. Recent entries are also kept in command_history, which serves
+    readers whenever Redis isn't available.
+    
+    In Redis each entry goes to the ``cbash:history`` stream and to streams
+    for its session and client IP, so listing a session or address reads
+    only its own entries. Prefix indexes are sorted sets of equal score,
+    so ZRANGEBYLEX finds the commands starting with a prefix in O(log n);
+    a companion set scored by time lets old members be pruned.
+    """
+    
+    STREAM = 'cbash:history'
+    PRUNE_SCRIPT = """
+local old = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. ARGV[1], 'LIMIT', 0, ARGV[3])
+local excess = redis.call('ZCARD', KEYS[2]) - #old - tonumber(ARGV[2])
+if excess > 0 then
+    local extra = redis.call('ZRANGE', KEYS[2], #old, #old + math.min(excess, tonumber(ARGV[3])) - 1)
+    for _, member in ipairs(extra) do
+        old[#old + 1] = member
+    end
+end
+if #old > 0 then
+    redis.call('ZREM', KEYS[1], unpack(old))
+    redis.call('ZREM', KEYS[2], unpack(old))
+end
+return #old
+"""
+    
+    def __init__(self, capacity=AUDIT_BUFFER_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 flush_interval=AUDIT_FLUSH_INTERVAL):
+        self.pending = deque(maxlen=capacity)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.condition = threading.Condition()
+        self.started = False
+        self.stopped = False
+        self.dropped = 0
+        self.recorded = 0
+        self.script = None
+        self.script_client = None
+    
+    def start(self):
+        """Start the flush task (done lazily on first record)"""
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+        socketio.start_background_task(self._run)
+    
+    def stop(self):
+        """Stop the flush task and write out what is still buffered"""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        while self.pending and self.flush():
+            pass
+    
+    def record(self, entry):
+        """Queue an audit entry; never blocks on Redis"""
+        command_history.append(entry)
+        self.recorded += 1
+        if not get_redis():
+            return
+        if not self.started:
+            self.start()
+        with self.condition:
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped += 1
+                audit_dropped.inc()
+            self.pending.append(json.dumps(entry))
+            audit_pending.set(len(self.pending))
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify()
+    
+    def flush(self):
+        """Write one batch to Redis; returns how many entries were written"""
+        client = get_redis()
+        if not client:
+            return 0
+        with self.condition:
+            batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+        if not batch:
+            return 0
+        if self.script_client is not client:
+            self.script = client.register_script(self.PRUNE_SCRIPT)
+            self.script_client = client
+        try:
+            # One round trip: the entries, their indexes, expiries and pruning
+            pipe = client.pipeline(transaction=False)
+            scopes = {self.STREAM}
+            for data in batch:
+                entry = json.loads(data)
+                streams = [(self.STREAM, HISTORY_MAX_ENTRIES)]
+                indexes = [self.STREAM]
+                if entry.get('session_id'):
+                    session_key = f"{self.STREAM}:session:{entry['session_id']}"
+                    streams.append((session_key, HISTORY_SCOPE_ENTRIES))
+                    indexes.append(session_key)
+                if entry.get('client_ip'):
+                    streams.append((f"{self.STREAM}:ip:{entry['client_ip']}", HISTORY_SCOPE_ENTRIES))
+                for key, maxlen in streams:
+                    pipe.xadd(key, {'entry': data}, maxlen=maxlen, approximate=True)
+                    scopes.add(key)
+                member = self.index_member(entry, data)
+                for key in indexes:
+                    pipe.zadd(f"{key}:prefix", {member: 0})
+                    pipe.zadd(f"{key}:prefix:age", {member: entry_time_ms(entry)})
+            cutoff = int((time.time() - HISTORY_RETENTION) * 1000)
+            for key in scopes:
+                if key != self.STREAM:
+                    for suffix in ('', ':prefix', ':prefix:age'):
+                        pipe.expire(key + suffix, int(HISTORY_RETENTION))
+                if key == self.STREAM or ':session:' in key:
+                    limit = HISTORY_MAX_ENTRIES if key == self.STREAM else HISTORY_SCOPE_ENTRIES
+                    self.script(keys=[f"{key}:prefix", f"{key}:prefix:age"],
+                                args=[cutoff, limit, HISTORY_PRUNE_BATCH], client=pipe)
+            pipe.execute()
+            redis_manager.report_success()
+        except Exception as e:
+            logger.error(f"Audit log flush failed: {e}")
+            if isinstance(e, redis.RedisError):
+                redis_manager.report_failure(e)
+            # Put the batch back for the next attempt, unless newer entries
+            # have filled the buffer in the meantime
+            with self.condition:
+                for entry in reversed(batch):
+                    if len(self.pending) == self.pending.maxlen:
+                        self.dropped += 1
+                        audit_dropped.inc()
+                        continue
+                    self.pending.appendleft(entry)
+            return 0
+        finally:
+            audit_pending.set(len(self.pending))
+        return len(batch)
+    
+    @staticmethod
+    def index_member(entry, data):
+        """Prefix index member: command, then newest first, then the entry itself"""
+        return f"{entry.get('command', '')}\x00{HISTORY_TIME_LIMIT - entry_time_ms(entry):013d}\x00{data}"
+    
+    def query(self, session_id=None, client_ip=None, prefix=None, since=None, until=None,
+              cursor=None, limit=HISTORY_PAGE_SIZE):
+        """One page of history, newest first, as (entries, next cursor or None).
+
+        ``since``/``until`` are epoch seconds. With a ``prefix`` the prefix
+        index is read instead, so results are grouped by command (newest
+        first within each).
+        """
+        since_ms = int(since * 1000) if since is not None else None
+        until_ms = int(until * 1000) if until is not None else None
+        client = get_redis()
+        if client:
+            try:
+                if prefix:
+                    page = self._query_index(client, session_id, client_ip, prefix, since_ms, until_ms, cursor, limit)
+                else:
+                    page = self._query_stream(client, session_id, client_ip, since_ms, until_ms, cursor, limit)
+                redis_manager.report_success()
+                return page
+            except redis.RedisError as e:
+                redis_manager.report_failure(e)
+        return self._query_memory(session_id, client_ip, prefix, since_ms, until_ms, cursor, limit)
+    
+    def _query_stream(self, client, session_id, client_ip, since_ms, until_ms, cursor, limit):
+        if session_id:
+            key = f"{self.STREAM}:session:{session_id}"
+        elif client_ip:
+            key = f"{self.STREAM}:ip:{client_ip}"
+        else:
+            key = self.STREAM
+        if cursor:
+            high = previous_stream_id(cursor)
+        else:
+            high = str(until_ms) if until_ms is not None else '+'
+        low = str(since_ms) if since_ms is not None else '-'
+        entries = []
+        scanned = 0
+        last_id = None
+        while high is not None and len(entries) < limit and scanned < HISTORY_SCAN_LIMIT:
+            rows = client.xrevrange(key, max=high, min=low, count=limit - len(entries))
+            if not rows:
+                return entries, None
+            for stream_id, fields in rows:
+                scanned += 1
+                entry = json.loads(fields['entry'])
+                if client_ip and entry.get('client_ip') != client_ip:
+                    continue
+                entries.append(entry)
+            last_id = rows[-1][0]
+            high = previous_stream_id(last_id)
+        return entries, last_id
+    
+    def _query_index(self, client, session_id, client_ip, prefix, since_ms, until_ms, cursor, limit):
+        key = f"{self.STREAM}:session:{session_id}:prefix" if session_id else f"{self.STREAM}:prefix"
+        start = b'(' + base64.urlsafe_b64decode(cursor.encode()) if cursor else b'[' + prefix.encode()
+        end = b'[' + prefix.encode() + b'\xff'
+        entries = []
+        scanned = 0
+        while len(entries) < limit and scanned < HISTORY_SCAN_LIMIT:
+            members = client.zrangebylex(key, start, end, start=0, num=limit - len(entries))
+            if not members:
+                return entries, None
+            for member in members:
+                scanned += 1
+                member = member.encode()
+                entry = json.loads(member.split(b'\x00', 2)[2])
+                if history_entry_matches(entry, None, client_ip, since_ms, until_ms):
+                    entries.append(entry)
+            start = b'(' + member
+        return entries, base64.urlsafe_b64encode(member).decode()
+    
+    def recent_for_session(self, session_id, prefix=None, limit=HISTORY_PAGE_SIZE):
+        """This worker's latest entries for a session, newest first, flushed or not"""
+        return self._query_memory(session_id, None, prefix, None, None, None, limit)[0]
+    
+    def _query_memory(self, session_id, client_ip, prefix, since_ms, until_ms, cursor, limit):
+        if limit <= 0:
+            return [], None
+        # Positions count every entry ever recorded, so they survive rotation
+        history = list(command_history)
+        first_position = self.recorded - len(history)
+        end = len(history)
+        if cursor:
+            try:
+                end = min(max(int(cursor) - first_position, 0), end)
+            except ValueError:
+                end = 0
+        entries = []
+        for i in range(end - 1, -1, -1):
+            entry = history[i]
+            if prefix and not entry.get('command', '').startswith(prefix):
+                continue
+            if history_entry_matches(entry, session_id, client_ip, since_ms, until_ms):
+                entries.append(entry)
+                if len(entries) == limit:
+                    return entries, str(first_position + i) if i > 0 else None
+        return entries, None
+    
+    def _run(self):
+        while not self.stopped:
+            with self.condition:
+                if len(self.pending) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+            if self.stopped or not get_redis():
+                continue
+            if self.flush() == 0 and self.pending:
+                # Redis is failing; back off instead of spinning
+                socketio.sleep(self.flush_interval)
+            # Drain any backlog before waiting again
+            while len(self.pending) >= self.batch_size and self.flush():
+                pass
+
+audit_log = AuditLog()
+
+HISTORY_TIME_LIMIT = 10 ** 13 - 1  # Milliseconds, for newest-first index order
+
+def entry_time_ms(entry):
+    """An audit entry's timestamp in epoch milliseconds"""
+    try:
+        stamp = datetime.fromisoformat(entry['timestamp'].rstrip('Z'))
+    except (KeyError, TypeError, ValueError):
+        return 0
+    return int((stamp - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+def history_entry_matches(entry, session_id, client_ip, since_ms, until_ms):
+    if session_id and entry.get('session_id') != session_id:
+        return False
+    if client_ip and entry.get('client_ip') != client_ip:
+        return False
+    if since_ms is not None or until_ms is not None:
+        stamp = entry_time_ms(entry)
+        if since_ms is not None and stamp < since_ms:
+            return False
+        if until_ms is not None and stamp > until_ms:
+            return False
+    return True
+
+def previous_stream_id(stream_id):
+    """The greatest stream id below ``stream_id`` (an exclusive XREVRANGE bound), or None"""
+    ms, _, seq = stream_id.partition('-')
+    ms, seq = int(ms), int(seq or 0)
+    if seq > 0:
+        return f"{ms}-{seq - 1}"
+    if ms > 0:
+        return f"{ms - 1}-18446744073709551615"
+    return None
+
+# Command scheduling
+class CommandScheduler:
+    """Admission control in front of command execution.
+
+    Every session gets a FIFO queue, so its commands run in order and one
+    at a time. A fixed pool of workers serves sessions that have work in
+    round-robin order, which caps how many commands run at once across
+    the server and stops one busy session from starving the others.
+    """
+
+    def __init__(self, workers=MAX_CONCURRENT_COMMANDS, max_queued=MAX_QUEUED_COMMANDS):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.queues = {}        # session_id -> deque of (task, enqueued_at)
+        self.ready = deque()    # sessions with queued work and nothing running
+        self.running = set()    # sessions with a command in progress
+        self.condition = threading.Condition()
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        """Start the worker pool (done lazily on first submit)"""
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+        for _ in range(self.workers):
+            socketio.start_background_task(self._worker)
+
+    def submit(self, session_id, task):
+        """Queue a task for a session; returns False if its queue is full"""
+        if not self.started:
+            self.start()
+        with self.condition:
+            queue = self.queues.setdefault(session_id, deque())
+            if len(queue) >= self.max_queued:
+                return False
+            queue.append((task, time.time()))
+            if len(queue) == 1 and session_id not in self.running:
+                self.ready.append(session_id)
+            command_queue_length.inc()
+            self.condition.notify()
+        return True
+
+    def run_now(self, session_id, task):
+        """Run a task on the calling thread if nothing of the session's is
+        queued or running; returns False, without running it, otherwise"""
+        with self.condition:
+            if session_id in self.running or self.queues.get(session_id):
+                return False
+            self.running.add(session_id)
+        try:
+            task()
         except Exception as e:
-            logger.error(f"System monitoring error: {e}")
+            logger.error(f"Command task failed for session {session_id}: {e}")
+        finally:
+            self._finish(session_id)
+        return True
+
+    def cancel(self, session_id):
+        """Drop a session's queued commands (the running one finishes)"""
+        with self.condition:
+            queue = self.queues.pop(session_id, None)
+            if queue:
+                command_queue_length.dec(len(queue))
+                if session_id in self.ready:
+                    self.ready.remove(session_id)
+
+    def queue_depth(self, session_id):
+        return len(self.queues.get(session_id, ()))
+
+    def stop(self):
+        """Let workers exit once idle; queued commands are dropped"""
+        with self.condition:
+            self.stopped = True
+            for session_id in list(self.queues):
+                self.queues[session_id].clear()
+            self.ready.clear()
+            command_queue_length.set(0)
+            self.condition.notify_all()
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.ready:
+                    if self.stopped:
+                        return
+                    self.condition.wait()
+                session_id = self.ready.popleft()
+                task, enqueued_at = self.queues[session_id].popleft()
+                self.running.add(session_id)
+                command_queue_length.dec()
+            command_stages.labels(stage='queue').observe(time.time() - enqueued_at)
+            
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"Command task failed for session {session_id}: {e}")
+            finally:
+                self._finish(session_id)
+
+    def _finish(self, session_id):
+        with self.condition:
+            self.running.discard(session_id)
+            queue = self.queues.get(session_id)
+            if queue:
+                self.ready.append(session_id)  # Back of the line
+                self.condition.notify()
+            elif queue is not None:
+                del self.queues[session_id]
+
+command_scheduler = CommandScheduler()
+
+# Output streaming
+class OutputStream:
+    """Chunked output channel for one running command.
+
+    Output is held to a byte and line budget; past it, output is counted
+    but not sent, and finish() reports what was left out. With spilling on,
+    the full output of a truncated command is kept so it can be fetched
+    later: output within the budget is held in memory, and only once the
+    budget is exceeded does it move to a spill file with the rest. Line endings are
+    normalized to ``\\n`` as output passes through.
+
+    Writes are coalesced into frames, sent once ``frame_bytes`` have built
+    up or ``coalesce_delay`` after the first unsent byte (the reader calls
+    flush() if the command goes quiet first). Clients that asked for binary
+    framing get ``output_frame`` events with raw, possibly deflated, UTF-8;
+    others get ``output_chunk`` events with text. Both carry the cumulative
+    byte count, which the client acknowledges with ``output_ack``. Once more
+    than ``window`` bytes are unacknowledged the writer blocks, which stops
+    us reading the child's pipe and lets the kernel push back on the child
+    instead of buffering its output in server memory.
+    """
+
+    def __init__(self, session_id, window=STREAM_WINDOW_BYTES, ack_timeout=STREAM_ACK_TIMEOUT,
+                 frame_bytes=OUTPUT_FRAME_BYTES, coalesce_delay=OUTPUT_COALESCE_DELAY,
+                 max_bytes=OUTPUT_MAX_BYTES, max_lines=OUTPUT_MAX_LINES, spill=OUTPUT_SPILL):
+        self.session_id = session_id
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.written_bytes = 0
+        self.written_lines = 0
+        self.omitted_bytes = 0
+        self.truncated = False
+        self.carriage_return = False  # A '\r' held back in case '\n' follows
+        self.spill = None
+        self.head = [] if spill else None  # Output kept before any spill file exists
+        self.spill_size = 0
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.frame_bytes = frame_bytes
+        self.coalesce_delay = coalesce_delay
+        self.seq = 0
+        self.sent_bytes = 0
+        self.acked_bytes = 0
+        self.pending = []
+        self.pending_size = 0
+        self.pending_since = None
+        self.offset = None
+        self.started_at = time.time()
+        self.first_byte_at = None
+        self.ends_with_newline = True
+        self.captured = None  # Output kept for the cache, see capture()
+        self.captured_size = 0
+        self.processing_time = 0.0  # In write(), less emitting and waiting on acks
+        self.emit_time = 0.0
+        self.blocked_time = 0.0
+        self.condition = threading.Condition()
+
+    def write(self, text):
+        """Queue command output, within the budget, for the client"""
+        started = time.perf_counter()
+        elsewhere = self.emit_time + self.blocked_time
+        if self.carriage_return:
+            text = '\r' + text
+            self.carriage_return = False
+        if text.endswith('\r'):
+            text = text[:-1]
+            self.carriage_return = True
+        self._append(text.replace('\r\n', '\n'))
+        self.processing_time += (time.perf_counter() - started
+                                 - (self.emit_time + self.blocked_time - elsewhere))
+
+    def capture(self):
+        """Also keep the output written from here on, while it is within budget"""
+        self.captured = []
+        self.captured_size = 0
+
+    def _append(self, text):
+        if not text:
+            return
+        data = text.encode('utf-8')
+        
+        if self.captured is not None:
+            self.captured_size += len(data)
+            if self.captured_size > self.max_bytes:
+                self.captured = None  # Truncated output isn't worth keeping
+            else:
+                self.captured.append(text)
+        if (self.head is not None or self.spill is not None) and self.spill_size < OUTPUT_SPILL_MAX_BYTES:
+            kept = data[:OUTPUT_SPILL_MAX_BYTES - self.spill_size]
+            if self.spill is not None:
+                self.spill.write(kept)
+            else:
+                self.head.append(kept)
+            self.spill_size += len(kept)
+        if self.truncated:
+            self.omitted_bytes += len(data)
+            return
+        
+        lines = text.count('\n')
+        if self.written_bytes + len(data) > self.max_bytes or self.written_lines + lines > self.max_lines:
+            # Send what still fits, up to whichever limit comes first
+            head = data[:self.max_bytes - self.written_bytes].decode('utf-8', errors='ignore')
+            room = self.max_lines - self.written_lines
+            cut = -1
+            for _ in range(room):
+                cut = head.find('\n', cut + 1)
+                if cut < 0:
+                    break
+            else:
+                head = head[:cut + 1]
+            self.truncated = True
+            self._start_spill()
+            self.omitted_bytes += len(data) - len(head.encode('utf-8'))
+            text = head
+            if not text:
+                return
+        self.written_bytes += len(text.encode('utf-8'))
+        self.written_lines += text.count('\n')
+        self.send(text)
+
+    def _start_spill(self):
+        """Move the output kept so far into a spill file, now that it is needed"""
+        if self.head is None:
+            return
+        self.spill = tempfile.SpooledTemporaryFile(OUTPUT_SPILL_MEMORY, dir=OUTPUT_SPILL_DIR)
+        self.spill.write(b''.join(self.head))
+        self.head = None
+
+    def notice(self, text):
+        """Send a server message to the terminal, outside the output budget"""
+        self.send(text)
+
+    def finish(self):
+        """End of output: report truncation and send anything still queued.
+
+        Returns the id of the spilled full output, or None.
+        """
+        if self.carriage_return:
+            self.carriage_return = False
+            self._append('\r')
+        output_id = None
+        if self.truncated:
+            output_truncated.inc()
+            output_omitted_bytes.inc(self.omitted_bytes)
+            if self.spill is not None:
+                output_id = secrets.token_urlsafe(12)
+                spilled_outputs[output_id] = {
+                    'file': self.spill,
+                    'size': self.spill_size,
+                    'session_id': self.session_id,
+                    'created_at': time.time(),
+                    'lock': threading.Lock()
+                }
+                self.spill = None
+                where = f"; full output: /api/output/{output_id}"
+            else:
+                where = ''
+            newline = '' if self.ends_with_newline else '\n'
+            self.notice(f"{newline}[output truncated: {self.omitted_bytes} bytes omitted{where}]\n")
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.head = None
+        self.flush()
+        return output_id
+
+    def send(self, text):
+        """Queue text for the client, waiting for it if it is behind"""
+        if not text:
+            return
+        data = text.encode('utf-8')
+        offset = record_output(self.session_id, text)
+        self._wait_for_window()
+        with self.condition:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            self.offset = offset
+            self.ends_with_newline = text.endswith('\n')
+            now = time.time()
+            if self.pending_since is None:
+                self.pending_since = now
+            due = (self.pending_size >= self.frame_bytes
+                   or now - self.pending_since >= self.coalesce_delay)
+        if due:
+            self.flush()
+
+    def _wait_for_window(self):
+        with self.condition:
+            if not self.window or self.sent_bytes + self.pending_size - self.acked_bytes < self.window:
+                return
+        # The client can only acknowledge what it has been sent
+        self.flush()
+        started = time.perf_counter()
+        with self.condition:
+            deadline = time.time() + self.ack_timeout
+            while self.window and self.sent_bytes - self.acked_bytes >= self.window:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # Client isn't acknowledging (old client or stalled socket);
+                    # stop throttling rather than hanging the command.
+                    logger.warning(f"No output ack from {self.session_id}, disabling flow control")
+                    self.window = None
+                    break
+                self.condition.wait(remaining)
+        self.blocked_time += time.perf_counter() - started
+
+    def flush_timeout(self):
+        """Seconds until queued output is due, or None if nothing is queued"""
+        with self.condition:
+            if self.pending_since is None:
+                return None
+            return max(0.0, self.pending_since + self.coalesce_delay - time.time())
+
+    def flush(self):
+        """Send queued output as one frame"""
+        with self.condition:
+            if not self.pending:
+                return
+            data = b''.join(self.pending)
+            self.pending = []
+            self.pending_size = 0
+            self.pending_since = None
+            self.seq += 1
+            self.sent_bytes += len(data)
+            frame = {'seq': self.seq, 'bytes': self.sent_bytes, 'offset': self.offset}
+        if self.first_byte_at is None:
+            self.first_byte_at = time.time()
         
-        time.sleep(10)
+        framing = user_sessions.get(self.session_id, {}).get('framing', {})
+        if framing.get('binary'):
+            encoding = 'binary'
+            if framing.get('deflate') and DEFLATE_MIN_BYTES and len(data) >= DEFLATE_MIN_BYTES:
+                deflated = zlib.compress(data, 1)
+                if len(deflated) < len(data):
+                    data = deflated
+                    encoding = 'deflate'
+            frame['deflated'] = encoding == 'deflate'
+            frame['data'] = data
+            self.emit_time += timed_emit('output_frame', frame, self.session_id)
+        else:
+            encoding = 'text'
+            frame['data'] = data.decode('utf-8')
+            self.emit_time += timed_emit('output_chunk', frame, self.session_id)
+        output_frames.labels(encoding=encoding).inc()
+        output_wire_bytes.inc(len(data))
+
+    def ack(self, acked_bytes):
+        """Record how many bytes the client has written to its terminal"""
+        with self.condition:
+            self.acked_bytes = max(self.acked_bytes, acked_bytes)
+            self.condition.notify_all()
+
+    @property
+    def time_to_first_byte(self):
+        if self.first_byte_at is None:
+            return None
+        return self.first_byte_at - self.started_at
+
+def read_spilled_output(output_id, offset=0, limit=OUTPUT_PAGE_BYTES):
+    """A page of a spilled output as (bytes, total size), or None if unknown.
+
+    Pages end on a character boundary, so each decodes on its own.
+    """
+    entry = spilled_outputs.get(output_id)
+    if entry is None:
+        return None
+    with entry['lock']:
+        entry['file'].seek(offset)
+        data = entry['file'].read(limit)
+    if offset + len(data) < entry['size']:
+        # Leave a character cut off by the page end for the next page
+        for back in range(1, min(4, len(data)) + 1):
+            byte = data[-back]
+            if byte & 0xC0 != 0x80:  # First byte of a character
+                if byte < 0x80:
+                    length = 1
+                elif byte < 0xE0:
+                    length = 2
+                elif byte < 0xF0:
+                    length = 3
+                else:
+                    length = 4
+                if length > back:
+                    data = data[:-back]
+                break
+    return data, entry['size']
+
+def discard_spilled_outputs(session_id=None, older_than=None):
+    """Close spilled outputs of a session, or those created before a time"""
+    for output_id, entry in list(spilled_outputs.items()):
+        if (session_id is not None and entry['session_id'] == session_id) or \
+                (older_than is not None and entry['created_at'] < older_than):
+            spilled_outputs.pop(output_id, None)
+            with entry['lock']:
+                entry['file'].close()
+
+def wait_readable(fd, timeout, stream):
+    """select() on ``fd``, flushing the stream's queued output if it falls due first"""
+    due = stream.flush_timeout() if isinstance(stream, OutputStream) else None
+    if due is not None and due < timeout:
+        ready, _, _ = select.select([fd], [], [], due)
+        if not ready:
+            stream.flush()
+        return bool(ready)
+    ready, _, _ = select.select([fd], [], [], timeout)
+    return bool(ready)
+
+class Scrollback:
+    """The last ``max_bytes`` bytes of a session's terminal output.
+
+    Offsets count bytes since the session started, so a client that knows
+    how far it got can be sent exactly what it missed.
+    """
+
+    def __init__(self, max_bytes=SCROLLBACK_BYTES):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.start = 0  # Offset of the first byte still held
+        self.lock = threading.Lock()
+
+    @property
+    def end(self):
+        return self.start + self.size
+
+    def append(self, text):
+        """Add output; returns the offset just past it"""
+        data = text.encode('utf-8')
+        with self.lock:
+            self.chunks.append(data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                excess = self.size - self.max_bytes
+                first = self.chunks[0]
+                if len(first) <= excess:
+                    self.chunks.popleft()
+                    dropped = len(first)
+                else:
+                    self.chunks[0] = first[excess:]
+                    dropped = excess
+                self.size -= dropped
+                self.start += dropped
+            return self.start + self.size
+
+    def clear(self):
+        """Forget held output; offsets carry on from where they were"""
+        with self.lock:
+            self.start += self.size
+            self.chunks.clear()
+            self.size = 0
+
+    def read(self, offset=0):
+        """Output from ``offset`` on, as (start offset, text)"""
+        with self.lock:
+            start = min(max(offset, self.start), self.end)
+            data = b''.join(self.chunks)[start - self.start:]
+        # The oldest bytes may have been cut mid-character
+        return start, data.decode('utf-8', errors='ignore')
+
+def record_output(session_id, text):
+    """Add text written to a session's terminal to its scrollback"""
+    scrollback = scrollbacks.get(session_id)
+    if scrollback is None:
+        return None
+    return scrollback.append(text)
+
+def send_response(session_id, payload):
+    """Emit a ``response`` event, keeping what it displays in the scrollback"""
+    output = payload.get('output') or ''
+    if output and not output.endswith('\n'):
+        output += '\n'
+    payload['offset'] = record_output(session_id, output + payload.get('prompt', ''))
+    timed_emit('response', payload, session_id)
+
+def stream_subprocess(args, stream, shell=False, cwd=None, env=None, timeout=COMMAND_TIMEOUT, preexec_fn=None):
+    """Run a command, forwarding its output to ``stream`` as it is produced.
+
+    Returns the exit code. Raises subprocess.TimeoutExpired after killing
+    the command's process group if it runs longer than ``timeout``.
+    """
+    spawn_started = time.perf_counter()
+    process = subprocess.Popen(
+        args,
+        shell=shell,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        cwd=cwd,
+        env=env,
+        start_new_session=True,  # So a timeout can kill the whole pipeline
+        preexec_fn=preexec_fn
+    )
+    command_stages.labels(stage='spawn').observe(time.perf_counter() - spawn_started)
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    fd = process.stdout.fileno()
+    deadline = time.time() + timeout
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                raise subprocess.TimeoutExpired(args, timeout)
+            if not wait_readable(fd, remaining, stream):
+                continue
+            data = os.read(fd, STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            stream.write(decoder.decode(data))
+        stream.write(decoder.decode(b'', final=True))
+        try:
+            return process.wait(timeout=max(deadline - time.time(), 0))
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+            raise
+    finally:
+        process.stdout.close()
+
+# Per-session state
+class SessionState:
+    """Working directory and environment of one terminal session.
+
+    Kept per session instead of in the server process (no os.chdir), so
+    concurrent sessions can't see each other's directory changes.
+    """
+
+    def __init__(self, cwd=None, env=None):
+        self.cwd = cwd or os.getcwd()
+        self.oldpwd = None
+        self.env = dict(DEFAULT_SESSION_ENV, **(env or {}))
+        self._environ = None
+        self.shell_customized = False  # Aliases or variables set inside mysh
+        self.listings = OrderedDict()  # Directory listings for completion, least recent first
+
+    def resolve(self, path):
+        """Absolute, normalized form of a path relative to the session cwd"""
+        return os.path.normpath(os.path.join(self.cwd, os.path.expanduser(path)))
+
+    def chdir(self, path):
+        """Change the session's directory; raises OSError like os.chdir"""
+        if path == '-':
+            if self.oldpwd is None:
+                raise OSError('OLDPWD not set')
+            target = self.oldpwd
+        else:
+            target = self.resolve(path)
+        if not os.path.exists(target):
+            raise FileNotFoundError(f"[Errno 2] No such file or directory: '{path}'")
+        if not os.path.isdir(target):
+            raise NotADirectoryError(f"[Errno 20] Not a directory: '{path}'")
+        if not os.access(target, os.X_OK):
+            raise PermissionError(f"[Errno 13] Permission denied: '{path}'")
+        self.oldpwd, self.cwd = self.cwd, target
+
+    def setenv(self, name, value):
+        self.env[name] = value
+        self._environ = None
+
+    def environ(self):
+        """Environment for commands run in this session (built once, then cached)"""
+        if self._environ is None:
+            self._environ = dict(os.environ, **self.env)
+        return self._environ
+
+    @property
+    def prompt(self):
+        return f'{self.cwd} $ '
+
+def get_session_state(session_id):
+    """Session's cwd/env state, created on first use"""
+    state = session_states.get(session_id)
+    if state is None:
+        state = session_states.setdefault(session_id, SessionState())
+    return state
+
+def fits_shell_line(cmd):
+    """Whether mysh reads a command as the single line it was sent as"""
+    return not LINE_BREAKS.search(cmd) and len(cmd.encode('utf-8')) < SHELL_MAX_LINE
+
+def needs_system_shell(cmd):
+    """Whether a command needs /bin/sh rather than the session's mysh"""
+    body = cmd.rstrip()
+    if body.endswith('&') and not body.endswith('&&'):
+        body = body[:-1]  # mysh runs `cmd &` as a background job itself
+    return SHELL_SYNTAX_PATTERN.search(body) is not None
+
+# Command parsing and policy
+CommandLine = namedtuple('CommandLine', ['text', 'tokens', 'argv', 'needs_shell', 'words', 'segments'])
+
+SHELL_OPERATOR_CHARS = '();<>|&'
+LINE_BREAK_CHARS = '\r\n'
+LINE_BREAKS = re.compile('[\r\n]')
+SHORT_FLAGS = re.compile(r'-[A-Za-z0-9]+\Z')
+REPEATED_SLASHES = re.compile(r'/{2,}')
+# Commands that run a string argument (or, fed by a pipe, their input) as a script
+SCRIPT_SHELLS = {'sh', 'bash', 'dash', 'ash', 'ksh', 'mksh', 'zsh', 'busybox'}
+PIPE_OPERATORS = ('|', '|&')
+
+class CommandParser:
+    """Command lines tokenized once and remembered.
+
+    Everything that looks at a command's words (the policy, builtins, the
+    output cache, execution) asks here, so a line is only split once
+    however many of them look at it, and not again when it is repeated.
+    ``tokens`` splits shell operators off as tokens of their own and
+    ``argv`` is the plain word list mysh or exec would see; both are None
+    if the quoting is unbalanced. ``words`` and ``segments`` are the
+    normalized forms the policy matches (see ``normalize_tokens`` and
+    ``policy_segments``).
+    """
+
+    def __init__(self, max_entries=COMMAND_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def parse(self, cmd):
+        with self.lock:
+            parsed = self.entries.get(cmd)
+            if parsed is not None:
+                self.entries.move_to_end(cmd)
+                return parsed
+        # A line break ends a command like ';' does, unless escaped to continue the line
+        body = cmd.replace('\\\n', '')
+        lexer = shlex.shlex(body, posix=True, punctuation_chars=SHELL_OPERATOR_CHARS + LINE_BREAK_CHARS)
+        lexer.whitespace = ' \t'
+        lexer.whitespace_split = True
+        try:
+            tokens = tuple(map(line_break_operator, lexer))
+        except ValueError:
+            tokens = None
+        argv = tokens
+        if tokens is not None and any(char in cmd for char in SHELL_OPERATOR_CHARS + LINE_BREAK_CHARS):
+            argv = tuple(shlex.split(cmd))  # Operators are only split off above
+        # Unbalanced quotes: the shell will refuse it, but match its words anyway
+        # (line by line, as sh may run the lines before the broken one)
+        if tokens is None:
+            words = normalize_tokens(map(line_break_operator, re.findall(r'[\r\n]+|[^\s]+', body)))
+        else:
+            words = normalize_tokens(tokens)
+        parsed = CommandLine(cmd, tokens, argv, needs_system_shell(cmd), words, policy_segments(words))
+        with self.lock:
+            self.entries[cmd] = parsed
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return parsed
+
+command_parser = CommandParser()
+
+def parse_command(cmd):
+    return command_parser.parse(cmd)
+
+def is_operator(token):
+    return bool(token) and all(char in SHELL_OPERATOR_CHARS for char in token)
+
+def line_break_operator(token):
+    """A lexer token with its line breaks read as the shell does: the
+    end of a command, or nothing after an operator like ``|`` or ``&&``"""
+    if not LINE_BREAKS.search(token) or not all(char in SHELL_OPERATOR_CHARS + LINE_BREAK_CHARS for char in token):
+        return token
+    return LINE_BREAKS.sub('', token) or ';'
+
+def normalize_tokens(tokens):
+    """A token list in the form the policy matches.
+
+    Command names lose their directory, runs of short flags are merged
+    and sorted, so ``/bin/rm -r -f`` and ``rm -fr`` read the same, and
+    absolute paths are normalized, so ``//``, ``/.`` and ``/tmp/..`` all
+    read ``/``.
+    """
+    words = []
+    command_start = True
+    for token in tokens:
+        if is_operator(token):
+            command_start = True
+        elif SHORT_FLAGS.match(token) and not command_start:
+            flags = set(token[1:])
+            if SHORT_FLAGS.match(words[-1]):
+                flags.update(words.pop()[1:])
+            token = '-' + ''.join(sorted(flags))
+        elif command_start:
+            token = os.path.basename(token) or token
+            command_start = False
+        elif token.startswith('/'):
+            token = os.path.normpath(REPEATED_SLASHES.sub('/', token))
+        words.append(token)
+    return tuple(words)
+
+def command_segments(words):
+    """The simple commands in a normalized token list"""
+    segments = []
+    current = []
+    for word in words:
+        if is_operator(word):
+            if current:
+                segments.append(current)
+            current = []
+        else:
+            current.append(word)
+    if current:
+        segments.append(current)
+    return segments
+
+def embedded_scripts(tokens):
+    """Command lines a token list hands to another shell to run.
+
+    The string after ``sh -c`` (or ``bash -ec``, ...), the arguments of
+    ``eval``, and the arguments of a command piped into a shell reading
+    its input, as in ``echo 'rm -rf /' | sh``.
+    """
+    scripts = []
+    previous = None
+    operator = None
+    current = []
+    for token in tuple(tokens) + (';',):
+        if not is_operator(token):
+            current.append(token)
+            continue
+        for i, word in enumerate(current):
+            name = os.path.basename(word)
+            if name == 'eval':
+                scripts.append(' '.join(current[i + 1:]))
+                break
+            if name in SCRIPT_SHELLS:
+                flags = [j for j in range(i + 1, len(current)) if SHORT_FLAGS.match(current[j]) and 'c' in current[j]]
+                if flags:
+                    scripts.extend(current[flags[0] + 1:flags[0] + 2])
+                elif operator in PIPE_OPERATORS and previous:
+                    scripts.extend(previous[1:])
+                break
+        if current:
+            previous = current
+        operator = token
+        current = []
+    return scripts
+
+def policy_segments(words):
+    """Simple commands of a normalized line, including those of embedded scripts"""
+    segments = command_segments(words)
+    for script in embedded_scripts(words):
+        segments.extend(parse_command(script).segments)
+    return segments
+
+class PolicyRules:
+    """One role's allow or deny rules, indexed by their first token.
+
+    A token rule is a sequence of glob patterns matching, in order but not
+    necessarily adjacent, tokens of one simple command. Unanchored rules
+    may start at any token (``rm -*r* /`` matches ``sudo rm -rf /``);
+    anchored ones only at the command name. Rules starting ``re:`` are
+    regular expressions searched in the normalized words, joined by spaces.
+    Unanchored (deny) rules match short flags regardless of case, so
+    ``rm -*r* /`` also catches ``rm -Rf /``.
+    """
+
+    GLOB_CHARS = re.compile(r'[*?\[]')
+
+    def __init__(self, rules, anchored):
+        self.anchored = anchored
+        self.index = {}       # First token -> [(rule, matchers for the rest)]
+        self.wildcards = []   # Rules whose first token is a glob
+        self.patterns = []    # (rule, compiled regular expression)
+        for rule in rules:
+            if rule.startswith('re:'):
+                self.patterns.append((rule, re.compile(rule[3:])))
+                continue
+            segments = command_segments(parse_command(rule).words)
+            if len(segments) != 1:
+                raise ValueError(f"policy rule must be one simple command: {rule!r}")
+            head, *rest = segments[0]
+            matchers = [self._matcher(token) for token in rest]
+            if self.GLOB_CHARS.search(head):
+                self.wildcards.append((rule, self._matcher(head), matchers))
+            else:
+                self.index.setdefault(head, []).append((rule, matchers))
+
+    def __len__(self):
+        return sum(map(len, self.index.values())) + len(self.wildcards) + len(self.patterns)
+
+    def _matcher(self, token):
+        fold = not self.anchored and token.startswith('-') and not token.startswith('--')
+        if self.GLOB_CHARS.search(token):
+            if fold:
+                # Short flags only: -*r* shouldn't read --force as containing r
+                matches = re.compile(fnmatch.translate(token), re.IGNORECASE).match
+                return lambda candidate: candidate[:2] != '--' and matches(candidate)
+            return re.compile(fnmatch.translate(token)).match
+        if fold:
+            flags = sorted(token.lower())
+            return lambda candidate: candidate[:1] == '-' and sorted(candidate.lower()) == flags
+        return token.__eq__
+
+    @staticmethod
+    def _follows(matchers, segment, start):
+        position = start
+        for matches in matchers:
+            while position < len(segment) and not matches(segment[position]):
+                position += 1
+            if position == len(segment):
+                return False
+            position += 1
+        return True
+
+    def match(self, segments, text):
+        """The first rule matching any of the segments, or None"""
+        for segment in segments:
+            for start in range(1 if self.anchored else len(segment)):
+                token = segment[start]
+                for rule, matchers in self.index.get(token, ()):
+                    if self._follows(matchers, segment, start + 1):
+                        return rule
+                for rule, head, matchers in self.wildcards:
+                    if head(token) and self._follows(matchers, segment, start + 1):
+                        return rule
+        if self.patterns:
+            for rule, pattern in self.patterns:
+                if pattern.search(text):
+                    return rule
+        return None
+
+class CommandPolicy:
+    """Per-role command policy, compiled once and hot-reloaded.
+
+    Each role has deny rules, allow rules and a default. Deny rules win;
+    otherwise a role whose default is deny needs every simple command on
+    the line to match one of its allow rules (anchored at the command
+    name). Roles can ``inherit`` another role's rules. Decisions are cached
+    per role and command line, so a repeated command costs a dict lookup
+    whatever the size of the rule set.
+    """
 
-# Start monitoring thread
-monitoring_thread = threading.Thread(target=monitor_system, daemon=True)
-monitoring_thread.start()
+    def __init__(self, path=POLICY_FILE, reload_interval=POLICY_RELOAD_INTERVAL, max_entries=COMMAND_CACHE_SIZE):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.decisions = OrderedDict()
+        self.mtime = None
+        self.checked_at = time.monotonic()
+        self.load(DEFAULT_POLICY)
+        if path:
+            self.reload()
+
+    def load(self, config):
+        """Compile a policy from its config dict; raises ValueError if invalid"""
+        raw_roles = config.get('roles') or {}
+        roles = {}
+        
+        def rules_of(name, kind, seen=()):
+            role = raw_roles.get(name)
+            if role is None or name in seen:
+                raise ValueError(f"unknown or circular role {name!r}")
+            inherited = rules_of(role['inherit'], kind, seen + (name,)) if role.get('inherit') else []
+            return inherited + list(role.get(kind, []))
+        
+        try:
+            for name, role in raw_roles.items():
+                default = role.get('default', 'allow')
+                if default not in ('allow', 'deny'):
+                    raise ValueError(f"role {name!r}: default must be 'allow' or 'deny'")
+                roles[name] = (default == 'allow', PolicyRules(rules_of(name, 'deny'), anchored=False),
+                               PolicyRules(rules_of(name, 'allow'), anchored=True))
+            default_role = config.get('default_role', 'default')
+            if default_role not in roles:
+                raise ValueError(f"default_role {default_role!r} is not defined")
+        except (TypeError, AttributeError, re.error) as e:
+            raise ValueError(f"invalid policy: {e}")
+        with self.lock:
+            self.roles = roles
+            self.default_role = default_role
+            self.decisions.clear()
+
+    def reload(self):
+        """Load the policy file if it changed; a broken file keeps the old policy"""
+        self.checked_at = time.monotonic()
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            with open(self.path) as f:
+                self.load(json.load(f))
+            logger.info(f"Loaded command policy from {self.path}")
+        except (OSError, ValueError) as e:
+            logger.error(f"Command policy {self.path} not loaded: {e}")
+
+    def check(self, cmd, role=None):
+        """(allowed, rule) for a command line; rule is the one that decided, if any"""
+        started = time.perf_counter()
+        if self.path and started - self.checked_at >= self.reload_interval:
+            self.reload()
+        role = role if role in self.roles else self.default_role
+        parsed = parse_command(cmd)
+        key = (role, parsed.words)  # Spellings that normalize the same share an entry
+        with self.lock:
+            decision = self.decisions.get(key)
+            if decision is not None:
+                self.decisions.move_to_end(key)
+        if decision is None:
+            decision = self._decide(parsed, role)
+            with self.lock:
+                self.decisions[key] = decision
+                if len(self.decisions) > self.max_entries:
+                    self.decisions.popitem(last=False)
+            policy_misses.observe(time.perf_counter() - started)
+        else:
+            policy_hits.observe(time.perf_counter() - started)
+        return decision
+
+    def _decide(self, parsed, role):
+        default_allow, deny, allow = self.roles[role]
+        segments = parsed.segments
+        text = ' '.join(parsed.words)
+        rule = deny.match(segments, text)
+        if rule is not None:
+            return False, rule
+        if default_allow or not segments:
+            return True, None
+        for segment in segments:
+            rule = allow.match([segment], text)
+            if rule is None:
+                return False, f"{segment[0]} is not allowed"
+        return True, rule
+
+policy_hits = policy_duration.labels(cache='hit')
+policy_misses = policy_duration.labels(cache='miss')
+command_policy = CommandPolicy()
+
+# Output cache
+class OutputCache:
+    """Output of read-only commands, replayed instead of running them again.
+
+    Entries are keyed on the command line, the session's directory and its
+    environment, and are shared between sessions. Each carries a fingerprint
+    of the stat() results (inode, size, mtime) of the directory, the paths
+    named on the command line and, for git, the repository's HEAD, index
+    and refs, taken before the command ran; a hit needs the fingerprint to
+    still match. Changes below a named directory don't show up in it, so
+    entries also expire after ``ttl`` seconds. Least recently used entries
+    are dropped to stay within ``max_bytes``.
+    """
+
+    GLOB = re.compile(r'[*?\[$]')
+    GIT_FILES = ('HEAD', 'index', 'packed-refs', os.path.join('logs', 'HEAD'))
+
+    def __init__(self, enabled=OUTPUT_CACHE, max_bytes=OUTPUT_CACHE_BYTES, ttl=OUTPUT_CACHE_TTL,
+                 commands=OUTPUT_CACHE_COMMANDS):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.commands = {tuple(c.split()) for c in commands}
+        self.entries = OrderedDict()  # Least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, cmd, state):
+        """Cache key for a command, or None if its output can't be cached"""
+        if not self.enabled or state.shell_customized:
+            return None
+        parsed = parse_command(cmd)
+        argv = parsed.argv
+        if parsed.needs_shell or not argv or self.GLOB.search(cmd):
+            return None
+        if (tuple(argv[:1]) not in self.commands and tuple(argv[:2]) not in self.commands):
+            return None
+        return (tuple(argv), state.cwd, tuple(sorted(state.env.items())))
+
+    def fingerprint(self, key):
+        """stat() results of everything the command's output depends on"""
+        argv, cwd, _ = key
+        paths = [cwd] + [os.path.join(cwd, os.path.expanduser(arg)) for arg in argv[1:] if not arg.startswith('-')]
+        if argv[0] == 'git':
+            git_dir = self._find_git_dir(cwd)
+            if git_dir:
+                paths.extend(os.path.join(git_dir, name) for name in self.GIT_FILES)
+        stats = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stats.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns))
+            except OSError:
+                stats.append(None)
+        return tuple(stats)
+
+    @staticmethod
+    def _find_git_dir(path):
+        while True:
+            candidate = os.path.join(path, '.git')
+            if os.path.isdir(candidate):
+                return candidate
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+    def get(self, key, fingerprint):
+        """The cached entry if it is still valid, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry['fingerprint'] != fingerprint
+                                      or time.time() - entry['stored_at'] > self.ttl):
+                self._discard(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            output_cache_hit_ratio.set(self.hits / (self.hits + self.misses))
+        output_cache_requests.labels(result='miss' if entry is None else 'hit').inc()
+        return entry
+
+    def put(self, key, fingerprint, output, exit_code):
+        """Keep a command's output, evicting old entries to make room"""
+        size = len(output.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            self._discard(key)
+            self.entries[key] = {
+                'fingerprint': fingerprint,
+                'output': output,
+                'exit_code': exit_code,
+                'size': size,
+                'stored_at': time.time()
+            }
+            self.size += size
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self.entries)))
+            output_cache_bytes.set(self.size)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            output_cache_bytes.set(0)
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry['size']
+
+output_cache = OutputCache()
+
+# Resource limits
+class CgroupManager:
+    """Per-session cgroup v2 groups holding CPU, memory and task limits.
+
+    Each session gets ``<root>/session-<id>``, created on first use. Its
+    mysh is moved in when the session is given it; one-off commands and
+    PTY shells join from the child before exec. Anything they fork lands
+    in the same group, so a runaway loop or fork bomb only starves its own
+    session, and the group's counters give the session's usage.
+    """
+
+    CONTROLLERS = ('cpu', 'memory', 'pids')
+
+    def __init__(self, root=CGROUP_ROOT, cpu=SESSION_CPU, memory_max=SESSION_MEMORY_MAX, pids_max=SESSION_PIDS_MAX):
+        self.root = root
+        self.limits = {
+            'cpu.max': f"{int(cpu * CGROUP_CPU_PERIOD)} {CGROUP_CPU_PERIOD}" if cpu > 0 else 'max',
+            'memory.max': str(memory_max) if memory_max > 0 else 'max',
+            'pids.max': str(pids_max) if pids_max > 0 else 'max'
+        }
+        self.groups = {}
+        self.available = None  # Checked on first use
+
+    def _check(self):
+        if self.available is None:
+            self.available = self._prepare()
+        return self.available
+
+    def _prepare(self):
+        if not self.root:
+            return False
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            controllers = self._read(self.root, 'cgroup.controllers').split()
+            missing = [c for c in self.CONTROLLERS if c not in controllers]
+            if missing:
+                logger.warning(f"cgroup {self.root} lacks controllers {missing}; session limits disabled")
+                return False
+            # Let the session groups below use them
+            self._write(self.root, 'cgroup.subtree_control', ' '.join('+' + c for c in self.CONTROLLERS))
+        except OSError as e:
+            logger.warning(f"Can't manage cgroup {self.root} ({e}); session limits disabled")
+            return False
+        logger.info(f"Session limits enabled under {self.root}: {self.limits}")
+        return True
+
+    def path(self, session_id):
+        """The session's group, created with its limits; None when disabled"""
+        group = self.groups.get(session_id)
+        if group is not None or not self._check():
+            return group
+        group = os.path.join(self.root, 'session-' + re.sub(r'[^A-Za-z0-9_-]', '_', session_id))
+        try:
+            os.makedirs(group, exist_ok=True)
+            for name, value in self.limits.items():
+                self._write(group, name, value)
+        except OSError as e:
+            logger.error(f"Failed to set up cgroup for {session_id}: {e}")
+            return None
+        self.groups[session_id] = group
+        return group
+
+    def attach(self, session_id, pid):
+        """Move a process into the session's group (children it already has stay put)"""
+        group = self.path(session_id)
+        if group is None:
+            return False
+        try:
+            self._write(group, 'cgroup.procs', str(pid))
+        except OSError as e:
+            logger.error(f"Failed to move {pid} into cgroup of {session_id}: {e}")
+            return False
+        return True
+
+    def preexec(self, session_id, then=None):
+        """A preexec_fn that joins the session's group, then calls ``then``"""
+        group = self.path(session_id)
+        if group is None:
+            return then
+        procs = os.path.join(group, 'cgroup.procs')
+
+        def join_group():
+            with open(procs, 'w') as f:
+                f.write('0')  # The writing process
+            if then is not None:
+                then()
+        return join_group
+
+    def usage(self, session_id):
+        """The group's usage counters, or None"""
+        group = self.groups.get(session_id)
+        if group is None:
+            return None
+        try:
+            cpu = self._read_keyed(group, 'cpu.stat')
+            return {
+                'cpu_seconds': cpu.get('usage_usec', 0) / 1e6,
+                'cpu_throttled_seconds': cpu.get('throttled_usec', 0) / 1e6,
+                'memory_bytes': int(self._read(group, 'memory.current')),
+                'pids': int(self._read(group, 'pids.current')),
+                'oom_kills': self._read_keyed(group, 'memory.events').get('oom_kill', 0)
+            }
+        except (OSError, ValueError):
+            return None
+
+    def collect(self):
+        """Publish every session's usage as metrics"""
+        for session_id in list(self.groups):
+            usage = self.usage(session_id)
+            if usage is None:
+                continue
+            session_cpu_seconds.labels(session=session_id).set(usage['cpu_seconds'])
+            session_cpu_throttled_seconds.labels(session=session_id).set(usage['cpu_throttled_seconds'])
+            session_memory_bytes.labels(session=session_id).set(usage['memory_bytes'])
+            session_pids.labels(session=session_id).set(usage['pids'])
+            session_oom_kills.labels(session=session_id).set(usage['oom_kills'])
+
+    def remove(self, session_id):
+        """Kill whatever is left in the session's group and delete it.
+
+        Never waits: if the group is still draining, a background task
+        deletes it once the last process has exited.
+        """
+        group = self.groups.pop(session_id, None)
+        if group is None:
+            return
+        for gauge in (session_cpu_seconds, session_cpu_throttled_seconds, session_memory_bytes,
+                      session_pids, session_oom_kills):
+            try:
+                gauge.remove(session_id)
+            except KeyError:
+                pass
+        try:
+            self._write(group, 'cgroup.kill', '1')
+        except OSError:
+            pass  # Kernels before 5.14; the session's process groups are killed anyway
+        if not self._rmdir(group):
+            socketio.start_background_task(self._drain, group)
+
+    @staticmethod
+    def _rmdir(group):
+        """Delete an empty group; False while processes are still in it"""
+        try:
+            os.rmdir(group)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+        return True
+
+    def _drain(self, group):
+        for _ in range(10):
+            socketio.sleep(0.1)  # Busy until the last process has exited
+            if self._rmdir(group):
+                return
+        logger.warning(f"Could not remove cgroup {group}")
+
+    @staticmethod
+    def _read(group, name):
+        with open(os.path.join(group, name)) as f:
+            return f.read().strip()
+
+    @staticmethod
+    def _write(group, name, value):
+        with open(os.path.join(group, name), 'w') as f:
+            f.write(value)
+
+    @classmethod
+    def _read_keyed(cls, group, name):
+        fields = {}
+        for line in cls._read(group, name).splitlines():
+            key, _, value = line.partition(' ')
+            fields[key] = int(value)
+        return fields
+
+cgroup_manager = CgroupManager()
 
 # Enhanced shell process management
+class ShellPool:
+    """Pre-spawned mysh processes handed out to new sessions.
+
+    A background task keeps at least ``min_size`` idle shells ready,
+    growing the target towards ``max_size`` when connects drain the pool,
+    so a reconnect wave doesn't turn into a fork storm on the handler
+    threads. Shells idle for longer than ``max_idle`` seconds are replaced
+    and the target shrinks back towards ``min_size``.
+    """
+
+    def __init__(self, spawn, min_size=SHELL_POOL_MIN, max_size=SHELL_POOL_MAX, max_idle=SHELL_POOL_MAX_IDLE,
+                 available=lambda: True):
+        self.spawn = spawn
+        self.available = available  # False once spawning can never succeed
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.max_idle = max_idle
+        self.target = min_size
+        self.idle = deque()
+        self.condition = threading.Condition()
+        self.started = False
+        self.stopped = False
+
+    def start(self):
+        """Start the refill task (done lazily on first acquire)"""
+        with self.condition:
+            if self.started or self.max_size <= 0:
+                return
+            self.started = True
+        socketio.start_background_task(self._refill)
+
+    def acquire(self):
+        """Take a ready shell, or None if the pool is empty"""
+        if not self.started:
+            self.start()
+        with self.condition:
+            while self.idle:
+                shell_info = self.idle.popleft()
+                if shell_info['process'].poll() is None:
+                    shell_pool_requests.labels(result='hit').inc()
+                    shell_pool_size.set(len(self.idle))
+                    self.condition.notify()
+                    return shell_info
+            # Demand outran the pool; keep more shells ready from now on
+            self.target = min(self.max_size, max(self.target * 2, 1))
+            shell_pool_requests.labels(result='miss').inc()
+            self.condition.notify()
+        return None
+
+    def stop(self):
+        """Stop refilling and kill the idle shells"""
+        with self.condition:
+            self.stopped = True
+            idle, self.idle = list(self.idle), deque()
+            shell_pool_size.set(0)
+            self.condition.notify()
+        for shell_info in idle:
+            shell_info['process'].kill()
+            shell_info['process'].wait()
+
+    def _expire(self):
+        """Drop shells that sat in the pool too long (caller holds the lock)"""
+        expired = []
+        now = time.time()
+        while self.idle and now - self.idle[0]['spawned_at'] > self.max_idle:
+            expired.append(self.idle.popleft())
+            self.target = max(self.min_size, self.target - 1)
+        return expired
+
+    def _refill(self):
+        retry_delay = SHELL_POOL_RETRY_MIN
+        while True:
+            with self.condition:
+                if self.stopped:
+                    return
+                expired = self._expire()
+                missing = self.target - len(self.idle)
+                if not expired and missing <= 0:
+                    self.condition.wait(timeout=min(self.max_idle, 5))
+                    continue
+            for shell_info in expired:
+                shell_info['process'].kill()
+                shell_info['process'].wait()
+            if missing <= 0:
+                continue
+            
+            shell_info = self.spawn()
+            if shell_info is None:
+                if not self.available():
+                    logger.error("Shell pool cannot spawn shells, stopping refill")
+                    return
+                # Transient (EAGAIN, EMFILE, ENOMEM under a fork storm); back off
+                logger.warning(f"Shell pool spawn failed, retrying in {retry_delay}s")
+                with self.condition:
+                    if not self.stopped:
+                        self.condition.wait(timeout=retry_delay)
+                retry_delay = min(retry_delay * 2, SHELL_POOL_RETRY_MAX)
+                continue
+            retry_delay = SHELL_POOL_RETRY_MIN
+            with self.condition:
+                self.idle.append(shell_info)
+                shell_pool_size.set(len(self.idle))
+
 class ShellManager:
-    def __init__(self):
+    """Owns one long-lived mysh process per session.
+
+    Commands are written to the shell's stdin, one line each; mysh ends
+    each line's output with a line of the form ``<sentinel> <line> <exit
+    status> <cwd>``, where the sentinel is a random per-shell marker and
+    ``line`` counts the lines it has read, so we can frame the output
+    without spawning a process per command and tell which line it
+    belongs to. New sessions are
+    given a pre-spawned shell from a ShellPool where possible.
+    """
+
+    def __init__(self, shell_path=MYSH_PATH, pool_min=SHELL_POOL_MIN, pool_max=SHELL_POOL_MAX, max_commands=SHELL_MAX_COMMANDS):
+        self.shell_path = shell_path
         self.shells = {}
+        self.available = True
+        self.max_commands = max_commands
+        self.default_env = dict(os.environ, **DEFAULT_SESSION_ENV)
+        self.pool = ShellPool(self.spawn_shell, min_size=pool_min, max_size=pool_max,
+                              available=lambda: self.available)
     
-    def create_shell(self, session_id):
-        """Create a new shell process for a session"""
+    def spawn_shell(self, cwd=None, env=None):
+        """Start a mysh process; returns its shell info, or None on failure"""
+        cwd = cwd or os.getcwd()
         try:
+            sentinel = f"__CBASH_{secrets.token_hex(8)}__"
             shell_process = subprocess.Popen(
-                ['./mysh'],
+                [self.shell_path],
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-                cwd=os.getcwd(),
+                bufsize=0,
+                cwd=cwd,
+                env=dict(env or self.default_env, MYSH_SENTINEL=sentinel),
                 preexec_fn=os.setsid  # Create new process group
             )
-            self.shells[session_id] = {
+            shell_info = {
                 'process': shell_process,
-                'cwd': os.getcwd(),
-                'env': dict(os.environ),
-                'history': [],
-                'created_at': datetime.utcnow()
+                'sentinel': sentinel.encode(),
+                'lock': threading.Lock(),
+                'lines': 0,     # Lines written to the shell
+                'answered': 0,  # Last line the shell reported on
+                'cwd': cwd,
+                'env': dict(env or self.default_env),
+                'commands': 0,
+                'created_at': datetime.utcnow(),
+                'spawned_at': time.time()
             }
-            return shell_process
         except Exception as e:
-            logger.error(f"Failed to create shell for session {session_id}: {e}")
+            if isinstance(e, OSError) and e.errno in (errno.ENOENT, errno.EACCES, errno.ENOEXEC):
+                # Missing or unrunnable binary; don't retry it on every command
+                self.available = False
+            logger.error(f"Failed to spawn shell: {e}")
+            return None
+        if not self._handshake(shell_info):
+            # Some other program, or a mysh built from older source: it
+            # would never end a command's output where we expect
+            self.available = False
+            self._signal_group(shell_process, signal.SIGKILL)
+            shell_process.wait()
+            logger.error(f"{self.shell_path} does not answer with the MYSH_SENTINEL status line; "
+                         f"build it from enhanced_shell.c (gcc -O2 -o mysh enhanced_shell.c). "
+                         f"Commands will run as one-off subprocesses")
+            return None
+        return shell_info
+    
+    def _handshake(self, shell_info, timeout=SHELL_HANDSHAKE_TIMEOUT):
+        """Whether a new shell answers an empty line with the sentinel line for line 1"""
+        process = shell_info['process']
+        sentinel = shell_info['sentinel']
+        try:
+            process.stdin.write(b'\n')
+        except OSError:
+            return False
+        fd = process.stdout.fileno()
+        pending = b''
+        deadline = time.time() + timeout
+        while True:
+            marker = pending.find(sentinel)
+            line_end = pending.find(b'\n', marker) if marker >= 0 else -1
+            if line_end >= 0:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0 or not wait_readable(fd, remaining, None):
+                return False
+            data = os.read(fd, STREAM_CHUNK_SIZE)
+            if not data:
+                return False
+            pending += data
+        fields = pending[marker + len(sentinel):line_end].split(b' ', 3)
+        if len(fields) != 4 or fields[1] != b'1':
+            return False
+        shell_info['lines'] = shell_info['answered'] = 1
+        return True
+    
+    def assign_shell(self, session_id):
+        """Give a session a pooled shell without spawning; False if none ready"""
+        if not self.available:
+            return False
+        shell_info = self.pool.acquire()
+        if shell_info is None:
+            return False
+        self.shells[session_id] = shell_info
+        cgroup_manager.attach(session_id, shell_info['process'].pid)
+        return True
+    
+    def create_shell(self, session_id, cwd=None, env=None):
+        """Create a new shell process for a session"""
+        started = time.perf_counter()
+        shell_info = None
+        if env is None or env == self.default_env:
+            # Pooled shells start in the server directory; execute() moves
+            # them to the session's cwd before the first command
+            shell_info = self.pool.acquire()
+        if shell_info is None:
+            shell_info = self.spawn_shell(cwd=cwd, env=env)
+        if shell_info is None:
+            logger.error(f"Failed to create shell for session {session_id}")
             return None
+        self.shells[session_id] = shell_info
+        # Still idle, so nothing it starts can escape the group
+        cgroup_manager.attach(session_id, shell_info['process'].pid)
+        command_stages.labels(stage='shell_start').observe(time.perf_counter() - started)
+        return shell_info['process']
     
-    def get_shell(self, session_id):
+    def get_shell(self, session_id, cwd=None, env=None):
         """Get shell for session, create if doesn't exist"""
-        if session_id not in self.shells:
-            self.create_shell(session_id)
+        if session_id not in self.shells and self.available:
+            self.create_shell(session_id, cwd=cwd, env=env)
         return self.shells.get(session_id)
     
+    def is_alive(self, session_id):
+        """Whether the session has a running shell to send commands to"""
+        shell_info = self.shells.get(session_id)
+        return shell_info is not None and shell_info['process'].poll() is None
+    
+    def get_cwd(self, session_id):
+        """Working directory last reported by the session's shell"""
+        shell_info = self.shells.get(session_id)
+        return shell_info['cwd'] if shell_info else None
+    
+    def execute(self, session_id, cmd, stream, timeout=COMMAND_TIMEOUT, cwd=None, env=None):
+        """Run a command in the session's shell, streaming its output.
+
+        If ``cwd`` is given and the shell is elsewhere, the shell is moved
+        there first; likewise variables in ``env`` the shell doesn't have
+        yet are exported to it. Returns the exit code, or None if the session has no
+        usable shell (the caller should then run the command some other
+        way). Raises subprocess.TimeoutExpired if the command outlives
+        ``timeout``.
+        """
+        shell_info = self.shells.get(session_id)
+        if shell_info is None or not fits_shell_line(cmd):
+            return None
+        
+        with shell_info['lock']:
+            if shell_info['process'].poll() is not None:
+                self.cleanup_shell(session_id)
+                return None
+            if cwd and cwd != shell_info['cwd']:
+                # mysh can't take a quoted path, so such directories fall back
+                if any(char.isspace() for char in cwd) or not fits_shell_line(f'cd {cwd}'):
+                    return None
+                if self._send(session_id, shell_info, f'cd {cwd}', None, timeout) != 0:
+                    return None
+            for name, value in (env or {}).items():
+                if shell_info['env'].get(name) == value:
+                    continue
+                # Nor a quoted value
+                if any(char.isspace() for char in value) or not fits_shell_line(f'export {name}={value}'):
+                    return None
+                if self._send(session_id, shell_info, f'export {name}={value}', None, timeout) != 0:
+                    return None
+                shell_info['env'][name] = value
+            exit_code = self._send(session_id, shell_info, cmd, stream, timeout)
+            shell_info['commands'] += 1
+            if self.max_commands and shell_info['commands'] >= self.max_commands:
+                # Retire long-lived shells; the next command gets a fresh one
+                self.cleanup_shell(session_id)
+            return exit_code
+    
+    def _send(self, session_id, shell_info, cmd, stream, timeout):
+        """Write one command line to the shell and read up to its sentinel"""
+        process = shell_info['process']
+        write = stream.write if stream else (lambda text: None)
+        try:
+            process.stdin.write(cmd.encode('utf-8') + b'\n')
+        except (BrokenPipeError, OSError):
+            self.cleanup_shell(session_id)
+            return None
+        shell_info['lines'] += 1
+        line = shell_info['lines']
+        
+        sentinel = shell_info['sentinel']
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        fd = process.stdout.fileno()
+        pending = b''
+        deadline = time.time() + timeout
+        interrupted = False
+        
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                if interrupted:
+                    # Shell didn't come back after SIGINT; replace it
+                    self.cleanup_shell(session_id)
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+                # Interrupt the foreground job; mysh survives SIGINT and
+                # reports the command's status as usual
+                os.killpg(process.pid, signal.SIGINT)
+                interrupted = True
+                deadline = time.time() + SHELL_INTERRUPT_GRACE
+                continue
+            
+            if not wait_readable(fd, remaining, stream):
+                continue
+            data = os.read(fd, STREAM_CHUNK_SIZE)
+            if not data:
+                # Shell exited (e.g. the user typed `exit`)
+                if shell_info['answered'] == line - 1:
+                    write(decoder.decode(pending, final=True))
+                exit_code = process.wait()
+                self.cleanup_shell(session_id)
+                return exit_code
+            pending += data
+            
+            while True:
+                marker = pending.find(sentinel)
+                line_end = pending.find(b'\n', marker) if marker >= 0 else -1
+                if line_end < 0:
+                    break  # No status line yet, or the rest of it still to come
+                fields = pending[marker + len(sentinel):line_end].decode('utf-8', 'replace').split(' ', 3)
+                answered = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else line
+                if answered < line:
+                    # An earlier line's status; it and its output aren't ours
+                    logger.warning(f"Discarding output of line {answered} from the shell of session {session_id}")
+                    shell_info['answered'] = answered
+                    pending = pending[line_end + 1:]
+                    continue
+                shell_info['answered'] = answered
+                write(decoder.decode(pending[:marker], final=True))
+                exit_code = int(fields[2]) if len(fields) > 2 and fields[2].lstrip('-').isdigit() else -1
+                if len(fields) > 3 and fields[3]:
+                    shell_info['cwd'] = fields[3]
+                if interrupted:
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+                return exit_code
+            
+            # Hold back anything that could be the start of the sentinel
+            safe = marker if marker >= 0 else len(pending) - len(sentinel) + 1
+            if safe > 0:
+                if shell_info['answered'] == line - 1:
+                    write(decoder.decode(pending[:safe]))
+                pending = pending[safe:]
+    
+    def stop(self):
+        """Kill the pooled shells and every session's shell"""
+        self.pool.stop()
+        for session_id in list(self.shells):
+            self.cleanup_shell(session_id)
+    
     def cleanup_shell(self, session_id):
         """Clean up shell process"""
-        if session_id in self.shells:
+        shell_info = self.shells.pop(session_id, None)
+        if shell_info is not None:
+            process = shell_info['process']
             try:
-                shell_info = self.shells[session_id]
-                shell_info['process'].terminate()
-                shell_info['process'].wait(timeout=5)
+                # mysh leads its own process group, so this also takes down
+                # anything it left running in the background
+                self._signal_group(process, signal.SIGTERM)
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    self._signal_group(process, signal.SIGKILL)
+                    process.wait(timeout=5)
             except Exception as e:
                 logger.error(f"Error cleaning up shell {session_id}: {e}")
             finally:
-                del self.shells[session_id]
+                process.stdin.close()
+                process.stdout.close()
+    
+    @staticmethod
+    def _signal_group(process, sig):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            # Group already gone; make sure the leader itself is signalled
+            if process.poll() is None:
+                process.send_signal(sig)
 
 shell_manager = ShellManager()
 
+# PTY sessions
+LINE_BREAK = re.compile(r'([\r\n])')
+ESCAPE_SEQUENCE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|O.|[^\r\n])?')
+
+class PtySession:
+    """mysh on a pseudo-terminal, for clients in PTY mode.
+
+    Keystrokes from the client are written to the terminal as they come
+    and everything the shell writes is streamed back untouched, so the
+    shell's own line editing, full-screen programs and job control work.
+    There is no sentinel framing here: mysh sees a terminal and prompts
+    like it would for a local user. If the shell exits a new one is
+    started in its place.
+    """
+
+    def __init__(self, session_id, cwd=None, env=None, cols=80, rows=24, shell_path=MYSH_PATH):
+        self.session_id = session_id
+        self.cwd = cwd or os.getcwd()
+        self.env = dict(env or os.environ)
+        # The terminal reports its own size; stale values would override it
+        self.env.pop('COLUMNS', None)
+        self.env.pop('LINES', None)
+        self.env['TERM'] = PTY_TERM
+        self.env.pop('MYSH_SENTINEL', None)
+        self.cols = cols
+        self.rows = rows
+        self.shell_path = shell_path
+        self.process = None
+        self.master = None
+        self.stream = OutputStream(session_id, spill=False)  # Fed through send(), unbudgeted
+        self.line = ''  # Input typed since the last Enter, for the audit log
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        """Spawn the shell; False on failure. Output waits for relay()"""
+        return self._spawn()
+
+    def relay(self):
+        """Start streaming the terminal's output to the client"""
+        socketio.start_background_task(self._run)
+
+    def _spawn(self):
+        master, slave = pty.openpty()
+        try:
+            self._set_size(slave, self.cols, self.rows)
+            self.process = subprocess.Popen(
+                [self.shell_path],
+                stdin=slave,
+                stdout=slave,
+                stderr=slave,
+                cwd=self.cwd,
+                env=self.env,
+                start_new_session=True,
+                preexec_fn=cgroup_manager.preexec(self.session_id, then=_acquire_controlling_tty)
+            )
+        except Exception as e:
+            os.close(master)
+            logger.error(f"Failed to spawn PTY shell for {self.session_id}: {e}")
+            return False
+        finally:
+            os.close(slave)
+        # Writes must never block a socket handler on a shell that isn't reading
+        fcntl.fcntl(master, fcntl.F_SETFL, fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.master = master
+        return True
+
+    def _run(self):
+        while not self.closed:
+            self._relay()
+            status = self.process.wait()
+            with self.lock:
+                if self.closed:
+                    return
+                os.close(self.master)
+                self.master = None
+            self.stream.send(f"\r\n[shell exited with status {status}; starting a new one]\r\n")
+            self.stream.flush()
+            if not self._spawn():
+                return
+
+    def _relay(self):
+        """Copy terminal output to the client until the shell closes it"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        fd = self.master
+        while not self.closed:
+            try:
+                if not wait_readable(fd, 1, self.stream):
+                    continue
+                data = os.read(fd, STREAM_CHUNK_SIZE)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                break  # EIO once the shell and its children have exited
+            if not data:
+                break
+            self.stream.send(decoder.decode(data))
+        self.stream.send(decoder.decode(b'', final=True))
+        self.stream.flush()
+
+    def write(self, data, admit=None):
+        """Send keystrokes to the terminal; returns the lines submitted.
+
+        While the shell is reading a line (the terminal is in canonical
+        mode and the shell's process group has it), each Enter is held
+        back until ``admit(line)`` approves the line typed before it; a
+        refused line is erased with the terminal's kill character instead
+        of being submitted. Programs that take the terminal raw, like vim
+        or a REPL, get their keystrokes untouched.
+        """
+        if not self._reading_lines():
+            self.line = ''
+            self._send(data)
+            return []
+        submitted = []
+        for piece in LINE_BREAK.split(data):
+            if not piece:
+                continue
+            lines = self._track_lines(piece)
+            if lines and admit is not None and not admit(lines[0]):
+                piece = '\x15' + piece
+            elif lines:
+                submitted.extend(lines)
+            if not self._send(piece):
+                break
+        return submitted
+
+    def _reading_lines(self):
+        with self.lock:
+            if self.master is None or self.process is None:
+                return True
+            try:
+                canonical = termios.tcgetattr(self.master)[3] & termios.ICANON
+                foreground = os.tcgetpgrp(self.master)
+            except (OSError, termios.error):
+                return True  # Can't tell; screen to be safe
+        # mysh leads its own session, so its process group id is its pid
+        return bool(canonical) and foreground == self.process.pid
+
+    def _send(self, data):
+        with self.lock:
+            if self.master is None:
+                return False
+            try:
+                os.write(self.master, data.encode('utf-8'))
+            except BlockingIOError:
+                logger.warning(f"PTY input buffer full for {self.session_id}, dropping input")
+                return False
+        return True
+
+    def _track_lines(self, data):
+        # Escape sequences (arrows, function keys) neither end nor add to a line
+        lines = []
+        for char in ESCAPE_SEQUENCE.sub('', data):
+            if char in '\r\n':
+                if self.line.strip():
+                    lines.append(self.line.strip())
+                self.line = ''
+            elif char in '\x7f\b':
+                self.line = self.line[:-1]
+            elif char in '\x03\x15':  # Ctrl-C, Ctrl-U
+                self.line = ''
+            elif char >= ' ':
+                self.line += char
+        return lines
+
+    def resize(self, cols, rows):
+        """Set the terminal size; the kernel sends the shell SIGWINCH"""
+        self.cols, self.rows = cols, rows
+        with self.lock:
+            if self.master is not None:
+                self._set_size(self.master, cols, rows)
+
+    @staticmethod
+    def _set_size(fd, cols, rows):
+        fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+    def close(self):
+        """Kill the shell's process group and release the terminal"""
+        with self.lock:
+            self.closed = True
+            master, self.master = self.master, None
+        process = self.process
+        if process is not None:
+            try:
+                ShellManager._signal_group(process, signal.SIGHUP)
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    ShellManager._signal_group(process, signal.SIGKILL)
+                    process.wait(timeout=5)
+            except Exception as e:
+                logger.error(f"Error cleaning up PTY shell {self.session_id}: {e}")
+        if master is not None:
+            os.close(master)
+        with self.stream.condition:
+            # Release a relay blocked on a client that will never ack
+            self.stream.window = None
+            self.stream.condition.notify_all()
+
+def _acquire_controlling_tty():
+    # Runs in the child after setsid(): make the PTY (stdin) its terminal
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+def start_pty_session(session_id, state, size):
+    """Give a session a PTY shell, not yet relaying; False if it couldn't start"""
+    pty_session = PtySession(session_id, cwd=state.cwd, env=state.environ(), cols=size[0], rows=size[1],
+                             shell_path=shell_manager.shell_path)
+    if not pty_session.start():
+        return False
+    pty_sessions[session_id] = pty_session
+    return True
+
+def close_pty_session(session_id):
+    """Shut down a session's PTY shell, if it has one"""
+    pty_session = pty_sessions.pop(session_id, None)
+    if pty_session is not None:
+        pty_session.close()
+
+# Session registry
+class SessionRegistry:
+    """Sessions across all workers, kept in Redis.
+
+    Each worker still owns its sessions' shells (clients are routed back to
+    it); the registry is what makes session listings and the session count
+    global. Registering and unregistering update the count atomically with
+    the registry, so a session is only counted once however often it is
+    re-registered. Without Redis it reports this worker's sessions only.
+    """
+    
+    SESSIONS_KEY = 'cbash:sessions'
+    COUNT_KEY = 'cbash:active_sessions'
+    WORKER_KEY = 'cbash:worker:{}'
+    
+    REGISTER_SCRIPT = """
+if redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+    return redis.call('INCR', KEYS[2])
+end
+return tonumber(redis.call('GET', KEYS[2]) or 0)
+"""
+    UNREGISTER_SCRIPT = """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('DECR', KEYS[2])
+end
+return tonumber(redis.call('GET', KEYS[2]) or 0)
+"""
+    
+    def __init__(self, worker_id=WORKER_ID, heartbeat_ttl=REAPER_INTERVAL * 3):
+        self.worker_id = worker_id
+        self.heartbeat_ttl = heartbeat_ttl
+        self.beat_at = None  # time.monotonic() of the last heartbeat
+        self.scripts = None
+        self.scripts_client = None
+    
+    def _scripts(self, client):
+        if self.scripts_client is not client:
+            self.scripts = (client.register_script(self.REGISTER_SCRIPT),
+                            client.register_script(self.UNREGISTER_SCRIPT))
+            self.scripts_client = client
+        return self.scripts
+    
+    def _entry(self, info):
+        return json.dumps({
+            'worker': self.worker_id,
+            'connected_at': info['connected_at'].isoformat(),
+            'last_activity': info['last_activity'].isoformat(),
+            'command_count': info['command_count']
+        })
+    
+    def heartbeat(self, client):
+        """Mark this worker alive, so others keep its sessions registered"""
+        client.set(self.WORKER_KEY.format(self.worker_id), int(time.time()), ex=self.heartbeat_ttl)
+        self.beat_at = time.monotonic()
+    
+    def register(self, session_id, info):
+        """Record a session; returns the total session count"""
+        client = get_redis()
+        if client:
+            try:
+                register, _ = self._scripts(client)
+                if self.beat_at is None or time.monotonic() - self.beat_at >= self.heartbeat_ttl / 3:
+                    self.heartbeat(client)  # Before sync() has run, e.g. just after start
+                return register(keys=[self.SESSIONS_KEY, self.COUNT_KEY],
+                                args=[session_id, self._entry(info)])
+            except redis.RedisError as e:
+                redis_manager.report_failure(e)
+        return len(user_sessions)
+    
+    def unregister(self, session_id):
+        """Forget a session; returns the total session count"""
+        client = get_redis()
+        if client:
+            try:
+                _, unregister = self._scripts(client)
+                return unregister(keys=[self.SESSIONS_KEY, self.COUNT_KEY], args=[session_id])
+            except redis.RedisError as e:
+                redis_manager.report_failure(e)
+        return len(user_sessions)
+    
+    def count(self):
+        client = get_redis()
+        if client:
+            try:
+                return int(client.get(self.COUNT_KEY) or 0)
+            except redis.RedisError as e:
+                redis_manager.report_failure(e)
+        return len(user_sessions)
+    
+    def sessions(self):
+        """All registered sessions as {session_id: info}"""
+        client = get_redis()
+        if client:
+            try:
+                return {sid: json.loads(entry) for sid, entry in client.hgetall(self.SESSIONS_KEY).items()}
+            except redis.RedisError as e:
+                redis_manager.report_failure(e)
+        return {sid: json.loads(self._entry(info)) for sid, info in list(user_sessions.items())}
+    
+    def sync(self):
+        """Heartbeat, refresh this worker's sessions and drop dead workers' ones.
+
+        Entries under this worker's id for sessions it doesn't have are
+        dropped too: they were left by an earlier process with the same id
+        (a restart on the same host and pid, or a fixed CBASH_WORKER_ID).
+        """
+        client = get_redis()
+        if not client:
+            return
+        try:
+            register, unregister = self._scripts(client)
+            pipe = client.pipeline(transaction=False)
+            self.heartbeat(pipe)
+            for session_id, info in list(user_sessions.items()):
+                # Also re-adds sessions that connected while Redis was down
+                register(keys=[self.SESSIONS_KEY, self.COUNT_KEY],
+                         args=[session_id, self._entry(info)], client=pipe)
+            pipe.hgetall(self.SESSIONS_KEY)
+            registered = pipe.execute()[-1]
+            
+            owners = {sid: json.loads(entry)['worker'] for sid, entry in registered.items()}
+            workers = sorted(set(owners.values()) - {self.worker_id})
+            alive = client.mget([self.WORKER_KEY.format(worker) for worker in workers]) if workers else []
+            dead = {worker for worker, beat in zip(workers, alive) if beat is None}
+            stale = [sid for sid, worker in owners.items()
+                     if worker in dead or (worker == self.worker_id and sid not in user_sessions)]
+            if stale:
+                pipe = client.pipeline(transaction=False)
+                for session_id in stale:
+                    unregister(keys=[self.SESSIONS_KEY, self.COUNT_KEY], args=[session_id], client=pipe)
+                pipe.execute()
+                logger.info(f"Dropped {len(stale)} sessions of dead workers {sorted(dead)} "
+                            f"or an earlier {self.worker_id}")
+            active_sessions.set(self.count())
+        except redis.RedisError as e:
+            redis_manager.report_failure(e)
+
+session_registry = SessionRegistry()
+
+# Session reaping
+def evict_session(session_id, reason):
+    """Drop everything held for a session and close its socket"""
+    logger.info(f"Evicting session {session_id} ({reason})")
+    command_scheduler.cancel(session_id)
+    shell_manager.cleanup_shell(session_id)
+    close_pty_session(session_id)
+    cgroup_manager.remove(session_id)
+    session_states.pop(session_id, None)
+    info = user_sessions.pop(session_id, None) or {}
+    scrollbacks.pop(session_id, None)
+    discard_spilled_outputs(session_id=session_id)
+    sid = info.get('sid', session_id)
+    session_aliases.pop(sid, None)
+    active_sessions.set(session_registry.unregister(session_id))
+    sessions_reaped.labels(reason=reason).inc()
+    sessions_alive.set(len(user_sessions))
+    try:
+        socketio.server.disconnect(sid, namespace='/')
+    except Exception as e:
+        logger.error(f"Error disconnecting evicted session {session_id}: {e}")
+
+class SessionReaper:
+    """Evicts idle sessions and kills shells whose session is gone.
+
+    Dropped connections don't always produce a disconnect event, so without
+    this their shells and session entries would live as long as the worker.
+    """
+    
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT, interval=REAPER_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.started = False
+        self.stopped = False
+        self.suspects = set()
+    
+    def start(self):
+        """Start the reaper task (done lazily on first connect)"""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        socketio.start_background_task(self._run)
+    
+    def reap(self):
+        """One pass; returns the number of sessions and shells reaped"""
+        reaped = 0
+        if self.idle_timeout > 0:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.idle_timeout)
+            for session_id, info in list(user_sessions.items()):
+                if info['last_activity'] >= cutoff:
+                    # Ordered by activity, so everything after is newer
+                    break
+                if session_id in active_streams:
+                    continue  # Still producing output
+                evict_session(session_id, 'idle')
+                reaped += 1
+        
+        # Shells whose session vanished without a disconnect. A shell is only
+        # reaped once it has been orphaned for a whole pass, so one being
+        # set up for a session that is still connecting is left alone
+        orphans = {sid for sid in list(shell_manager.shells) if sid not in user_sessions}
+        for session_id in orphans & self.suspects:
+            shell_manager.cleanup_shell(session_id)
+            sessions_reaped.labels(reason='orphan').inc()
+            reaped += 1
+        self.suspects = orphans - self.suspects
+        for session_id in [sid for sid in list(pty_sessions) if sid not in user_sessions]:
+            close_pty_session(session_id)
+            sessions_reaped.labels(reason='orphan').inc()
+            reaped += 1
+        for session_id in [sid for sid in list(cgroup_manager.groups) if sid not in user_sessions]:
+            cgroup_manager.remove(session_id)
+        
+        discard_spilled_outputs(older_than=time.time() - OUTPUT_SPILL_TTL)
+        sessions_alive.set(len(user_sessions))
+        shells_alive.set(len(shell_manager.shells))
+        session_registry.sync()
+        return reaped
+    
+    def stop(self):
+        self.stopped = True
+    
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            if self.stopped:
+                return
+            try:
+                self.reap()
+            except Exception as e:
+                logger.error(f"Session reaper error: {e}")
+
+session_reaper = SessionReaper()
+
+# Application lifecycle
+#
+# Importing this module has no side effects beyond defining things: Redis
+# is connected to and background tasks are started on first use, or all at
+# once by start_subsystems(). Under a pre-forking server call it (and
+# after_fork()) in each worker, never in the parent, so no thread or
+# connection is forked into children.
+def after_fork():
+    """Take on this process's identity in a freshly forked worker"""
+    global WORKER_ID
+    if not os.environ.get('CBASH_WORKER_ID'):
+        WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+    session_registry.worker_id = WORKER_ID
+    session_registry.beat_at = None
+
+def start_subsystems():
+    """Start Redis health checks and every background task now"""
+    redis_manager.start()
+    session_registry.sync()  # Heartbeat now rather than a reaper interval from now
+    system_sampler.start()
+    audit_log.start()
+    command_scheduler.start()
+    shell_manager.pool.start()
+    session_reaper.start()
+
+def stop_subsystems():
+    """Stop background tasks, flush buffered writes and kill shells"""
+    session_reaper.stop()
+    command_scheduler.stop()
+    for session_id in list(pty_sessions):
+        close_pty_session(session_id)
+    shell_manager.stop()
+    audit_log.stop()
+    system_sampler.stop()
+    redis_manager.stop()
+
+def create_app(config=None):
+    """The application, configured for serving.
+
+    ``config`` is merged into ``app.config``. With ``START_SUBSYSTEMS``
+    set, subsystems are started now and stopped at exit; otherwise each
+    starts on first use.
+    """
+    app.config.update(config or {})
+    if app.config.get('START_SUBSYSTEMS'):
+        start_subsystems()
+        atexit.register(stop_subsystems)
+    return app
+
 # Routes
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('enhanced_index.html')
 
 @app.route('/health')
 def health_check():
@@ -187,185 +3195,701 @@ def health_check():
     return jsonify({
         'status': 'healthy',
         'timestamp': datetime.utcnow().isoformat(),
-        'active_sessions': active_sessions_count,
+        'active_sessions': session_registry.count(),
+        'worker': WORKER_ID,
+        'redis': redis_manager.state,
         'uptime': time.time() - start_time
     })
 
 @app.route('/metrics')
 def metrics():
     """Prometheus metrics endpoint"""
+    cgroup_manager.collect()
     return generate_latest()
 
 @app.route('/api/system-info')
 @rate_limit(max_requests=10, window=60)
 def system_info():
     """Get system information"""
+    sample = system_sampler.latest()
     return jsonify({
-        'cpu_percent': psutil.cpu_percent(),
-        'memory_percent': psutil.virtual_memory().percent,
-        'disk_percent': psutil.disk_usage('/').percent,
-        'active_sessions': active_sessions_count,
+        'cpu_percent': sample['cpu'],
+        'memory_percent': sample['memory'],
+        'disk_percent': sample['disk'],
+        'sampled_at': sample['time'],
+        'active_sessions': session_registry.count(),
         'uptime': time.time() - start_time
     })
 
+@app.route('/api/system-history')
+@rate_limit(max_requests=30, window=60)
+def system_history():
+    """This worker's recent system samples, averaged down to at most ``points``"""
+    try:
+        seconds = float(request.args.get('seconds', 3600))
+        points = min(max(int(request.args.get('points', 120)), 1), SYSTEM_HISTORY_MAX_POINTS)
+    except ValueError:
+        return jsonify({'error': 'seconds and points must be numbers'}), 400
+    return jsonify({
+        'worker': WORKER_ID,
+        'interval': system_sampler.interval,
+        'series': system_sampler.history(seconds, points)
+    })
+
 @app.route('/api/command-history')
-@rate_limit(max_requests=20, window=60)
+@rate_limit(max_requests=120, window=60)
 def get_command_history():
-    """Get command history"""
-    if redis_client:
-        history = redis_client.lrange('command_history', 0, 99)
-        return jsonify([json.loads(cmd) for cmd in history])
-    return jsonify(command_history[-100:])
+    """A page of command history, newest first, optionally filtered"""
+    args = request.args
+    try:
+        limit = min(max(int(args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_PAGE_SIZE)
+        since = float(args['since']) if args.get('since') else None
+        until = float(args['until']) if args.get('until') else None
+    except ValueError:
+        return jsonify({'error': 'limit, since and until must be numbers'}), 400
+    try:
+        entries, cursor = audit_log.query(
+            session_id=args.get('session') or None,
+            client_ip=args.get('ip') or None,
+            prefix=args.get('prefix') or None,
+            since=since,
+            until=until,
+            cursor=args.get('cursor') or None,
+            limit=limit
+        )
+    except (ValueError, binascii.Error):
+        return jsonify({'error': 'Invalid cursor'}), 400
+    return jsonify({'entries': entries, 'next_cursor': cursor})
+
+@app.route('/api/output/<output_id>')
+@rate_limit(max_requests=120, window=60)
+def get_spilled_output(output_id):
+    """Page through the full output of a truncated command"""
+    token = request.headers.get('X-Session-Token') or request.args.get('token', '')
+    entry = spilled_outputs.get(output_id)
+    if entry is None or verify_session_token(token) != entry['session_id']:
+        return jsonify({'error': 'Output not found'}), 404
+    try:
+        offset = max(int(request.args.get('offset', 0)), 0)
+        limit = min(max(int(request.args.get('limit', OUTPUT_PAGE_BYTES)), 1), OUTPUT_PAGE_BYTES)
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    page = read_spilled_output(output_id, offset, limit)
+    if page is None:
+        return jsonify({'error': 'Output not found'}), 404
+    data, size = page
+    return jsonify({
+        'output_id': output_id,
+        'offset': offset,
+        'next_offset': offset + len(data),
+        'size': size,
+        'eof': offset + len(data) >= size,
+        'data': data.decode('utf-8', errors='replace')
+    })
 
 # Socket events
+def current_session_id():
+    """Session of the socket handling this event (differs after a reattach)"""
+    return session_aliases.get(request.sid, request.sid)
+
+def client_framing(auth):
+    """Output framing the client asked for in its connection auth"""
+    if not isinstance(auth, dict):
+        return {}
+    return {'binary': bool(auth.get('binary')), 'deflate': bool(auth.get('deflate'))}
+
+def client_role(auth):
+    """Policy role granted by the connection's role token, or None for the default"""
+    if not isinstance(auth, dict) or not isinstance(auth.get('role_token'), str):
+        return None
+    return verify_role_token(auth['role_token'])
+
+def terminal_size(data):
+    """(cols, rows) from a client message, or None if it doesn't carry a sane size"""
+    if not isinstance(data, dict):
+        return None
+    try:
+        cols, rows = int(data.get('cols')), int(data.get('rows'))
+    except (TypeError, ValueError):
+        return None
+    if not (0 < cols <= 1000 and 0 < rows <= 1000):
+        return None
+    return cols, rows
+
+def reattach_session(auth):
+    """Hand a reconnecting client its old session; False if it can't have it"""
+    if not isinstance(auth, dict) or not auth.get('token'):
+        return False
+    session_id = verify_session_token(auth['token'])
+    info = user_sessions.get(session_id)
+    if info is None or session_id not in scrollbacks:
+        return False
+    
+    sid = request.sid
+    previous_sid = info.get('sid', session_id)
+    info['sid'] = sid
+    info['framing'] = client_framing(auth)
+    was_detached = info.pop('detached_at', None) is not None
+    info['last_activity'] = datetime.utcnow()
+    user_sessions.move_to_end(session_id)
+    if sid != session_id:
+        session_aliases[sid] = session_id
+    join_room(session_id)
+    if previous_sid != sid and not was_detached:
+        # The old connection may not have noticed it is gone yet
+        session_aliases.pop(previous_sid, None)
+        try:
+            socketio.server.disconnect(previous_sid, namespace='/')
+        except Exception:
+            pass
+    
+    try:
+        offset = int(auth.get('offset') or 0)
+    except (TypeError, ValueError):
+        offset = 0
+    start, data = scrollbacks[session_id].read(offset)
+    emit('session_resumed', {
+        'session_id': session_id,
+        'connected_at': info['connected_at'].isoformat(),
+        'data': data,
+        'start': start,
+        'offset': start + len(data.encode('utf-8')),
+        'running': session_id in active_streams,
+        'mode': info.get('mode', 'line')
+    })
+    logger.info(f"Client reattached to {session_id}")
+    return True
+
 @socketio.on('connect')
-def handle_connect():
-    global active_sessions_count
-    active_sessions_count += 1
-    active_sessions.set(active_sessions_count)
+def handle_connect(auth=None):
+    if reattach_session(auth):
+        return
     
     session_id = request.sid
+    # Make room by evicting the least recently active sessions
+    while len(user_sessions) >= MAX_SESSIONS:
+        evict_session(next(iter(user_sessions)), 'lru')
     user_sessions[session_id] = {
         'connected_at': datetime.utcnow(),
         'command_count': 0,
-        'last_activity': datetime.utcnow()
+        'last_activity': datetime.utcnow(),
+        'sid': session_id,
+        'framing': client_framing(auth),
+        'role': client_role(auth)
     }
+    scrollbacks[session_id] = Scrollback()
+    active_sessions.set(session_registry.register(session_id, user_sessions[session_id]))
+    sessions_alive.set(len(user_sessions))
+    session_reaper.start()
+    system_sampler.start()
     
     join_room(session_id)
     
-    # Create shell for this session
-    shell_manager.create_shell(session_id)
-    
-    # Send initial prompt with current working directory
-    cwd = os.getcwd()
-    initial_prompt = f'{cwd} $ '
-    logger.info(f"Sending initial prompt to {session_id}: {initial_prompt}")
-    emit('initial_prompt', initial_prompt)
+    state = get_session_state(session_id)
+    size = terminal_size(auth) if isinstance(auth, dict) and auth.get('pty') else None
+    if size and PTY_ENABLED and start_pty_session(session_id, state, size):
+        mode = 'pty'  # The shell prints its own prompt
+    else:
+        # Hand the session a pre-spawned shell; if the pool is empty one is
+        # spawned by the first command instead of on this handler thread
+        mode = 'line'
+        shell_manager.assign_shell(session_id)
+        
+        # Send initial prompt with current working directory
+        initial_prompt = state.prompt
+        logger.info(f"Sending initial prompt to {session_id}: {initial_prompt}")
+        emit('initial_prompt', initial_prompt)
+        record_output(session_id, initial_prompt)
+    user_sessions[session_id]['mode'] = mode
     emit('session_info', {
         'session_id': session_id,
-        'connected_at': user_sessions[session_id]['connected_at'].isoformat()
+        'connected_at': user_sessions[session_id]['connected_at'].isoformat(),
+        'token': generate_session_token(session_id),
+        'offset': scrollbacks[session_id].end,
+        'mode': mode
     })
+    if mode == 'pty':
+        # Only now, so the client knows the mode before the first output
+        pty_sessions[session_id].relay()
     
     logger.info(f"Client connected: {session_id}")
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    global active_sessions_count
-    active_sessions_count = max(0, active_sessions_count - 1)
-    active_sessions.set(active_sessions_count)
+    sid = request.sid
+    session_id = session_aliases.pop(sid, sid)
+    leave_room(session_id)
     
-    session_id = request.sid
+    info = user_sessions.get(session_id)
+    if info is not None and info.get('sid', session_id) != sid:
+        return  # Another connection has taken the session over
+    if info is not None and SESSION_REATTACH_GRACE > 0:
+        # Keep the shell and anything running in it for the client to come back to
+        info['detached_at'] = detached_at = time.time()
+        socketio.start_background_task(expire_detached_session, session_id, detached_at)
+        logger.info(f"Client detached: {session_id}")
+        return
     
     # Clean up shell process
+    command_scheduler.cancel(session_id)
     shell_manager.cleanup_shell(session_id)
+    close_pty_session(session_id)
+    cgroup_manager.remove(session_id)
+    session_states.pop(session_id, None)
     
     if session_id in user_sessions:
         session_duration = (datetime.utcnow() - user_sessions[session_id]['connected_at']).total_seconds()
         logger.info(f"Client disconnected: {session_id}, duration: {session_duration}s")
-        del user_sessions[session_id]
-    
-    leave_room(session_id)
+        user_sessions.pop(session_id, None)
+        active_sessions.set(session_registry.unregister(session_id))
+    scrollbacks.pop(session_id, None)
+    discard_spilled_outputs(session_id=session_id)
+    sessions_alive.set(len(user_sessions))
+
+def expire_detached_session(session_id, detached_at):
+    """End a detached session once its reattach grace period is over"""
+    socketio.sleep(SESSION_REATTACH_GRACE)
+    info = user_sessions.get(session_id)
+    if info is not None and info.get('detached_at') == detached_at:
+        evict_session(session_id, 'detached')
 
 start_time = time.time()
 
+# Builtin commands
+Builtin = namedtuple('Builtin', ['name', 'handler', 'usage', 'help', 'shadowable', 'accepts'])
+
+class BuiltinRegistry:
+    """Commands run in-process instead of in the session's shell.
+
+    Dispatch is one dict lookup on the command name. A handler is called as
+    ``handler(state, args, session_id)`` with the arguments split as the
+    shell would and returns ``(exit_code, output)``; output None means it
+    has sent its own response. ``accepts`` can turn down a command line
+    the builtin wouldn't handle the way the shell does, which then runs in
+    the shell as before. Shadowable builtins also step aside once the
+    session has defined aliases, which might redefine them.
+    """
+
+    def __init__(self):
+        self.commands = {}
+
+    def register(self, name, usage=None, help='', shadowable=True, accepts=None):
+        """Decorator registering a handler under ``name``"""
+        def decorator(handler):
+            self.commands[name] = Builtin(name, handler, usage or name, help, shadowable, accepts)
+            return handler
+        return decorator
+
+    def get(self, name):
+        return self.commands.get(name)
+
+    def help_text(self):
+        entries = [entry for entry in self.commands.values() if entry.help]
+        width = max((len(entry.usage) for entry in entries), default=0)
+        return '\n'.join(f"  {entry.usage:<{width}}  {entry.help}" for entry in entries)
+
+builtin_commands = BuiltinRegistry()
+cbash_commands = BuiltinRegistry()
+
+# Quotes are fine: arguments are split with shlex
+BUILTIN_UNSUPPORTED_SYNTAX = [token for token in SHELL_SYNTAX if token not in ('"', "'")]
+VARIABLE_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+
+def resolve_builtin(cmd, state):
+    """The builtin that should run ``cmd`` and its arguments, or None"""
+    parts = cmd.split(maxsplit=1)
+    entry = builtin_commands.get(parts[0] if parts else '')
+    if entry is None or (entry.shadowable and state.shell_customized):
+        return None
+    if any(token in cmd for token in BUILTIN_UNSUPPORTED_SYNTAX):
+        return None
+    if entry.accepts and not entry.accepts(cmd):
+        return None
+    argv = parse_command(cmd).argv
+    if argv is None:
+        return None  # Unbalanced quotes; let the shell report them
+    # Whole-word $NAME, as mysh expands it
+    environ = state.environ()
+    args = [environ.get(arg[1:], arg) if arg.startswith('$') else arg for arg in argv[1:]]
+    return entry, args
+
+def session_history(session_id, limit, prefix=None):
+    """The session's latest commands, oldest first.
+
+    Entries reach Redis only once the audit log flushes, so the latest come
+    from this worker's memory and Redis only supplies older ones.
+    """
+    limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+    if limit <= 0:
+        return []
+    entries = audit_log.recent_for_session(session_id, prefix, limit)
+    if len(entries) < limit:
+        until = (entry_time_ms(entries[-1]) - 1) / 1000 if entries else None
+        older, _ = audit_log.query(session_id=session_id, prefix=prefix, until=until, limit=limit - len(entries))
+        entries += older
+    return [entry['command'] for entry in reversed(entries)]
+
+@builtin_commands.register('', shadowable=False)
+def builtin_empty_line(state, args, session_id):
+    return 0, ''  # Just a new prompt
+
+@builtin_commands.register('cd', usage='cd [dir]', help='Change directory', shadowable=False)
+def builtin_cd(state, args, session_id):
+    try:
+        state.chdir(args[0] if args else '~')
+    except Exception as e:
+        return 1, f"cd: {e}"
+    return 0, ''
+
+@builtin_commands.register('clear', help='Clear the terminal', shadowable=False)
+def builtin_clear(state, args, session_id):
+    scrollback = scrollbacks.get(session_id)
+    if scrollback is not None:
+        scrollback.clear()
+    offset = record_output(session_id, state.prompt)
+    timed_emit('clear_terminal', {'cwd': state.cwd, 'offset': offset}, session_id)
+    return 0, None
+
+@builtin_commands.register('pwd', help='Print the working directory')
+def builtin_pwd(state, args, session_id):
+    return 0, state.cwd
+
+# Single quotes would stop expansion and globs need the filesystem; -n and
+# -e change the output format
+@builtin_commands.register('echo', usage='echo [text]', help='Print text',
+                          accepts=lambda cmd: not re.search(r"['*?\[]|^echo\s+-[ne]", cmd))
+def builtin_echo(state, args, session_id):
+    return 0, ' '.join(args)
+
+@builtin_commands.register('true', help='Succeed')
+def builtin_true(state, args, session_id):
+    return 0, ''
+
+@builtin_commands.register('false', help='Fail')
+def builtin_false(state, args, session_id):
+    return 1, ''
+
+@builtin_commands.register('export', usage='export [NAME=value]', help='Set a variable for later commands',
+                          shadowable=False)
+def builtin_export(state, args, session_id):
+    if not args:
+        return 0, '\n'.join(f"export {name}={value}" for name, value in sorted(state.env.items()))
+    for arg in args:
+        name, assign, value = arg.partition('=')
+        if not VARIABLE_NAME.match(name):
+            return 1, f"export: '{arg}': not a valid identifier"
+        if assign:
+            state.setenv(name, value)
+    return 0, ''
+
+@builtin_commands.register('env', help='Print the environment', accepts=lambda cmd: cmd.strip() == 'env')
+def builtin_env(state, args, session_id):
+    return 0, '\n'.join(f"{name}={value}" for name, value in sorted(state.environ().items()))
+
+@builtin_commands.register('history', usage='history [n]', help="Show this session's commands")
+def builtin_history(state, args, session_id):
+    limit = int(args[0]) if args and args[0].isdigit() else HISTORY_PAGE_SIZE
+    return 0, '\n'.join(f"{i:5}  {command}" for i, command in enumerate(session_history(session_id, limit), 1))
+
+@builtin_commands.register('cbash', usage='cbash <command>', help='CBash server commands', shadowable=False)
+def builtin_cbash(state, args, session_id):
+    entry = cbash_commands.get(args[0]) if args else None
+    if entry is None:
+        return (1 if args else 0), cbash_help()
+    return entry.handler(state, args[1:], session_id)
+
+def cbash_help():
+    return (f"Available CBash commands:\n{cbash_commands.help_text()}\n\n"
+            f"Built-in commands (run without a shell):\n{builtin_commands.help_text()}")
+
+@cbash_commands.register('status', help='Server and session status')
+def cbash_status(state, args, session_id):
+    sample = system_sampler.latest()
+    return 0, json.dumps({
+        'session_id': session_id,
+        'uptime': time.time() - start_time,
+        'commands_executed': user_sessions.get(session_id, {}).get('command_count', 0),
+        'cpu_usage': sample['cpu'],
+        'memory_usage': sample['memory'],
+        'session_resources': cgroup_manager.usage(session_id)
+    }, indent=2)
+
+@cbash_commands.register('history', usage='history [n] [prefix]',
+                         help="This session's last n commands (default 20), optionally by prefix")
+def cbash_history(state, args, session_id):
+    limit = int(args[0]) if args and args[0].isdigit() else 20
+    commands = session_history(session_id, limit, prefix=' '.join(args[1:]) or None)
+    return 0, '\n'.join(f"{i}: {command}" for i, command in enumerate(commands, 1))
+
+@cbash_commands.register('sessions', help='Active sessions on all workers')
+def cbash_sessions(state, args, session_id):
+    sessions_info = []
+    for sid, info in session_registry.sessions().items():
+        # Counts of other workers' sessions are as of their last sync
+        sessions_info.append({
+            'session_id': sid[:8] + '...',
+            'connected_at': info['connected_at'],
+            'command_count': info['command_count'],
+            'worker': info['worker']
+        })
+    return 0, json.dumps(sessions_info, indent=2)
+
+@cbash_commands.register('help', help='Show this help')
+def cbash_help_command(state, args, session_id):
+    return 0, cbash_help()
+
+# Tab completion
+class Listing:
+    """Sorted names in one directory, for prefix lookups by bisection.
+
+    Dot files and directories are also kept in lists of their own, so
+    neither a bare prefix nor ``cd`` walks past entries it can't offer.
+    """
+
+    def __init__(self, mtime, names, dirs):
+        self.mtime = mtime
+        self.dirs = dirs
+        self.names = self._split(names)
+        self.dir_names = self._split(dirs)
+
+    @staticmethod
+    def _split(names):
+        """(visible, hidden) names, each sorted"""
+        names = sorted(names)
+        hidden = [name for name in names if name.startswith('.')]
+        return [name for name in names if not name.startswith('.')], hidden
+
+    @classmethod
+    def scan(cls, path, mtime, keep=None):
+        names = []
+        dirs = set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                    if keep is not None and not keep(entry, is_dir):
+                        continue
+                except OSError:
+                    continue
+                names.append(entry.name)
+                if is_dir:
+                    dirs.add(entry.name)
+        return cls(mtime, names, dirs)
+
+    def matching(self, prefix, limit, dirs_only=False):
+        names = (self.dir_names if dirs_only else self.names)[prefix.startswith('.')]
+        matches = []
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            if len(matches) == limit or not names[i].startswith(prefix):
+                break
+            matches.append(names[i])
+        return matches
+
+def is_executable(entry, is_dir):
+    return not is_dir and os.access(entry.path, os.X_OK)
+
+class Completer:
+    """Completions for the word being typed at the end of a command line.
+
+    Command names come from the builtins and an index of the executables
+    on PATH, one listing per PATH directory, rescanned when the
+    directory's mtime changes. Paths are completed from listings cached
+    per session (``SessionState.listings``), relative to the session's
+    cwd. Lookups bisect sorted names, so large directories cost one scan.
+    """
+
+    def __init__(self, max_matches=COMPLETION_MAX_MATCHES, dir_cache_size=COMPLETION_DIR_CACHE_SIZE):
+        self.max_matches = max_matches
+        self.dir_cache_size = dir_cache_size
+        self.executables = {}  # PATH directory -> Listing of its executables
+        self.lock = threading.Lock()
+
+    def complete(self, line, state):
+        """``(kind, start, matches)``: candidates for the word starting at ``start``"""
+        start = max(line.rfind(char) for char in WORD_BREAKS) + 1
+        word = line[start:]
+        words = COMMAND_BREAKS.split(line[:start])[-1].split()  # This simple command's words so far
+        if not words:
+            if '/' in word:
+                return 'path', start, self.paths(word, state, commands=True)
+            return 'command', start, self.commands(word, state)
+        if words == ['cbash']:
+            return 'cbash', start, sorted(name for name in cbash_commands.commands if name.startswith(word))
+        return 'path', start, self.paths(word, state, dirs_only=words[0] == 'cd')
+
+    def commands(self, prefix, state):
+        names = {name for name in builtin_commands.commands if name and name.startswith(prefix)}
+        for directory in state.environ().get('PATH', os.defpath).split(os.pathsep):
+            listing = self.path_listing(directory or '.')
+            if listing is not None:
+                names.update(listing.matching(prefix, self.max_matches))
+        return sorted(names)[:self.max_matches]
+
+    def path_listing(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        listing = self.executables.get(directory)
+        if listing is None or listing.mtime != mtime:
+            try:
+                listing = Listing.scan(directory, mtime, keep=is_executable)
+            except OSError:
+                return None
+            with self.lock:
+                self.executables[directory] = listing
+        return listing
+
+    def paths(self, word, state, dirs_only=False, commands=False):
+        head, _, prefix = word.rpartition('/')
+        if word.startswith('/') and not head:
+            head = '/'
+        directory = state.resolve(head) if head else state.cwd
+        listing = self.listing(directory, state)
+        if listing is None:
+            return []
+        base = word[:len(word) - len(prefix)]
+        matches = []
+        # Bounded even for commands, where some candidates turn out not executable
+        for name in listing.matching(prefix, self.max_matches, dirs_only):
+            if name in listing.dirs:
+                matches.append(base + name + '/')
+            elif not dirs_only and not (commands and not os.access(os.path.join(directory, name), os.X_OK)):
+                matches.append(base + name)
+        return matches
+
+    def listing(self, directory, state):
+        """The session's cached listing of a directory, rescanned if it changed"""
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        listings = state.listings
+        with self.lock:
+            listing = listings.get(directory)
+            if listing is not None and listing.mtime == mtime:
+                listings.move_to_end(directory)
+                return listing
+        try:
+            listing = Listing.scan(directory, mtime)
+        except OSError:
+            return None
+        with self.lock:
+            listings[directory] = listing
+            listings.move_to_end(directory)
+            while len(listings) > self.dir_cache_size:
+                listings.popitem(last=False)
+        return listing
+
+WORD_BREAKS = ' \t|;&<>()'
+COMMAND_BREAKS = re.compile(r'[|;&()]')
+completer = Completer()
+
+def common_prefix(matches):
+    return os.path.commonprefix(matches) if matches else ''
+
+def screen_command(session_id, cmd, **audit_fields):
+    """Rate-limit, audit and policy-check a command line before it runs.
+
+    Returns None if it may run, else ``(reason, message)`` with reason
+    ``rate_limited`` or ``blocked``.
+    """
+    # One check covers both the session's and the client address's limits
+    if not rate_limiter.allow([
+        (f"rate_limit:command:session:{session_id}", COMMAND_RATE_LIMIT, COMMAND_RATE_WINDOW),
+        (f"rate_limit:command:ip:{client_ip()}", COMMAND_RATE_LIMIT_PER_IP, COMMAND_RATE_WINDOW)
+    ]):
+        rate_limited.labels(scope='command').inc()
+        return 'rate_limited', 'Error: Rate limit exceeded, slow down'
+    
+    # Log command for security audit
+    command_log = {
+        'session_id': session_id,
+        'command': cmd,
+        'timestamp': datetime.utcnow().isoformat(),
+        'client_ip': client_ip(),
+        **audit_fields
+    }
+    allowed, rule = command_policy.check(cmd, user_sessions.get(session_id, {}).get('role'))
+    if not allowed:
+        command_log['blocked'] = rule
+    
+    # Written to Redis in the background, off the command's path
+    audit_log.record(command_log)
+    
+    if not allowed:
+        cmd_name = cmd.split()[0] if cmd else ''
+        command_counter.labels(family=command_family(cmd_name), status='blocked').inc()
+        return 'blocked', f"Error: Command blocked by policy ({rule})"
+    return None
+
 @socketio.on('command')
 def handle_command(data):
     start_time_cmd = time.time()
-    session_id = request.sid
+    session_id = current_session_id()
     cmd = data.strip()
+    record_output(session_id, cmd + '\n')  # The client's echo of the line
     
     # Update session activity
     if session_id in user_sessions:
         user_sessions[session_id]['last_activity'] = datetime.utcnow()
         user_sessions[session_id]['command_count'] += 1
+        user_sessions.move_to_end(session_id)
     
-    # Log command for security audit
-    command_log = {
-        'session_id': session_id,
-        'command': cmd,
-        'timestamp': datetime.utcnow().isoformat(),
-        'client_ip': request.environ.get('HTTP_X_FORWARDED_FOR', request.remote_addr)
-    }
+    refusal = screen_command(session_id, cmd)
+    if refusal is not None:
+        reason, message = refusal
+        response = {'output': message, 'prompt': get_session_state(session_id).prompt}
+        if reason == 'rate_limited':
+            response['busy'] = True
+        send_response(session_id, response)
+        return
     
-    # Store in Redis for persistence
-    if redis_client:
-        redis_client.lpush('command_history', json.dumps(command_log))
-        redis_client.ltrim('command_history', 0, 999)  # Keep last 1000 commands
-    else:
-        command_history.append(command_log)
-        if len(command_history) > 1000:
-            command_history.pop(0)
+    # Builtins finish in microseconds, so they run right here unless the
+    # session has commands ahead of them
+    builtin = resolve_builtin(cmd, get_session_state(session_id))
+    if builtin is not None and command_scheduler.run_now(
+            session_id, lambda: execute_command(cmd, session_id, start_time_cmd, builtin)):
+        return
     
+    # Queue behind the session's earlier commands; refuse if it's too far behind
+    if not command_scheduler.submit(session_id, lambda: execute_command(cmd, session_id, start_time_cmd)):
+        cmd_name = cmd.split()[0] if cmd else ''
+        command_counter.labels(family=command_family(cmd_name), status='rejected').inc()
+        send_response(session_id, {
+            'output': f"Error: Server busy, {command_scheduler.max_queued} commands already queued for this session",
+            'prompt': get_session_state(session_id).prompt,
+            'busy': True
+        })
+
+LINE_ENDINGS = re.compile(r'\r\n?')
+BLANK_LINE_RUNS = re.compile(r'\n{4,}')
+
+def execute_command(cmd, session_id, start_time_cmd, builtin=None):
+    """Run one command for a session (from a scheduler worker, or inline
+    for a builtin already resolved by the caller)"""
     output_lines = []
     
     try:
-        # Enhanced command processing
-        if cmd.startswith('cd'):
-            parts = cmd.split(maxsplit=1)
-            try:
-                if len(parts) == 1:
-                    os.chdir(os.path.expanduser("~"))
-                else:
-                    os.chdir(os.path.expanduser(parts[1]))
-                output_lines.append('')
-                command_counter.labels(command='cd', status='success').inc()
-            except Exception as e:
-                output_lines.append(f"cd: {e}")
-                command_counter.labels(command='cd', status='error').inc()
-                
-        elif cmd.strip() == 'clear':
-            cwd = os.getcwd()
-            emit('clear_terminal', {'cwd': cwd})
-            command_counter.labels(command='clear', status='success').inc()
-            return
-            
-        elif cmd.startswith('cbash '):
-            # Custom CBash commands
-            handle_cbash_command(cmd[6:], session_id)
-            return
+        if builtin is None:
+            builtin = resolve_builtin(cmd, get_session_state(session_id))
+        if builtin is not None:
+            entry, args = builtin
+            exit_code, output = entry.handler(get_session_state(session_id), args, session_id)
+            if entry.name:
+                command_counter.labels(family=command_family(entry.name),
+                                       status='success' if exit_code == 0 else 'error').inc()
+            if output is None:
+                return  # The builtin responded itself
+            output_lines.append(output)
             
         else:
             # Execute command with enhanced error handling
             cmd_name = cmd.strip().split()[0] if cmd.strip() else ''
             
-            try:
-                # Security: Prevent dangerous commands
-                dangerous_commands = ['rm -rf /', 'mkfs', 'dd if=', 'format', ':(){:|:&};:']
-                if any(danger in cmd for danger in dangerous_commands):
-                    output_lines.append("Error: Dangerous command blocked for security")
-                    command_counter.labels(command=cmd_name, status='blocked').inc()
-                else:
-                    # Enhanced command execution with timeout
-                    result = subprocess.run(
-                        shlex.split(cmd) if not any(char in cmd for char in ['|', '>', '<', '&']) else cmd,
-                        shell=any(char in cmd for char in ['|', '>', '<', '&']),
-                        capture_output=True,
-                        text=True,
-                        cwd=os.getcwd(),
-                        timeout=30,  # 30 second timeout
-                        env=dict(os.environ, COLUMNS='120', LINES='30')  # Set terminal size
-                    )
-                    
-                    if result.stdout:
-                        clean_output = result.stdout
-                        # Keep proper line breaks and formatting
-                        clean_output = clean_output.replace('\r\n', '\n').replace('\r', '\n')
-                        # Don't remove control characters that are needed for formatting
-                        output_lines.append(clean_output)
-                    
-                    if result.stderr:
-                        error_msg = result.stderr.strip()
-                        output_lines.append(error_msg)
-                    
-                    status = 'success' if result.returncode == 0 else 'error'
-                    command_counter.labels(command=cmd_name, status=status).inc()
-                    
-            except subprocess.TimeoutExpired:
-                output_lines.append("Error: Command timed out (30s limit)")
-                command_counter.labels(command=cmd_name, status='timeout').inc()
-            except Exception as e:
-                output_lines.append(f"Error: {e}")
-                command_counter.labels(command=cmd_name, status='error').inc()
+            if cmd_name:
+                run_streaming_command(cmd, cmd_name, session_id, start_time_cmd)
+                return
     
     except Exception as e:
         output_lines.append(f"System error: {e}")
@@ -373,82 +3897,208 @@ def handle_command(data):
     
     # Record command execution time
     execution_time = time.time() - start_time_cmd
-    command_duration.observe(execution_time)
+    command_duration.labels(family=command_family(cmd.split()[0] if cmd.split() else '')).observe(execution_time)
     
     output = '\n'.join(output_lines)
-    cwd = os.getcwd()
+    cwd = get_session_state(session_id).cwd
     
-    # Clean output but preserve formatting
+    # Clean output but preserve formatting: normalize line endings and cap
+    # runs of empty lines, one linear pass each
     if output:
-        # Only normalize line endings, don't remove other characters
-        output = output.replace('\r\n', '\n').replace('\r', '\n')
-        # Remove excessive empty lines only
-        while '\n\n\n\n' in output:
-            output = output.replace('\n\n\n\n', '\n\n\n')
+        output = LINE_ENDINGS.sub('\n', output)
+        output = BLANK_LINE_RUNS.sub('\n\n\n', output)
     
-    emit('response', {
+    send_response(session_id, {
         'output': output,
         'prompt': f'{cwd} $ ',
-        'execution_time': round(execution_time, 3),
-        'command': cmd
+        'execution_time': round(execution_time, 3)
     })
 
-def handle_cbash_command(cmd, session_id):
-    """Handle custom CBash commands"""
-    parts = cmd.split()
-    command = parts[0] if parts else ''
-    
-    if command == 'status':
-        emit('response', {
-            'output': json.dumps({
-                'session_id': session_id,
-                'uptime': time.time() - start_time,
-                'commands_executed': user_sessions.get(session_id, {}).get('command_count', 0),
-                'cpu_usage': psutil.cpu_percent(),
-                'memory_usage': psutil.virtual_memory().percent
-            }, indent=2),
-            'prompt': f'{os.getcwd()} $ '
-        })
-    elif command == 'history':
-        limit = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 20
-        if redis_client:
-            history = redis_client.lrange('command_history', 0, limit-1)
-            history_data = [json.loads(cmd) for cmd in history]
-        else:
-            history_data = command_history[-limit:]
+def run_streaming_command(cmd, cmd_name, session_id, start_time_cmd):
+    """Execute an external command, streaming its output to the session.
+
+    Plain commands go to the session's persistent mysh so they share its
+    aliases, variables and jobs; commands that need shell syntax mysh
+    doesn't support (or sessions without a live shell) get a subprocess.
+    """
+    parsed = parse_command(cmd)
+    use_shell = parsed.needs_shell
+    state = get_session_state(session_id)
+    stream = OutputStream(session_id)
+    active_streams[session_id] = stream
+    exit_code = None
+    cached = None
+    
+    # Fingerprint before running, so changes made meanwhile invalidate the result
+    cache_key = output_cache.key(cmd, state)
+    if cache_key is not None:
+        fingerprint = output_cache.fingerprint(cache_key)
+        cached = output_cache.get(cache_key, fingerprint)
+    if cmd_name in SHELL_STATE_COMMANDS and not use_shell:
+        state.shell_customized = True
+    
+    run_started = time.perf_counter()
+    shell_time = 0.0
+    try:
+        if cached is not None:
+            stream.write(cached['output'])
+            exit_code = cached['exit_code']
+        elif cache_key is not None:
+            stream.capture()
         
-        output = '\n'.join([f"{i+1}: {cmd['command']}" for i, cmd in enumerate(history_data)])
-        emit('response', {
-            'output': output,
-            'prompt': f'{os.getcwd()} $ '
-        })
-    elif command == 'sessions':
-        sessions_info = []
-        for sid, info in user_sessions.items():
-            sessions_info.append({
-                'session_id': sid[:8] + '...',
-                'connected_at': info['connected_at'].isoformat(),
-                'command_count': info['command_count']
-            })
-        emit('response', {
-            'output': json.dumps(sessions_info, indent=2),
-            'prompt': f'{os.getcwd()} $ '
-        })
-    else:
-        emit('response', {
-            'output': 'Available CBash commands: status, history [n], sessions',
-            'prompt': f'{os.getcwd()} $ '
-        })
+        if exit_code is None and not use_shell:
+            shell_started = time.perf_counter()
+            shell = shell_manager.get_shell(session_id, cwd=state.cwd, env=state.environ())
+            shell_time = time.perf_counter() - shell_started  # The shell_start stage, if it made one
+            if shell:
+                exit_code = shell_manager.execute(session_id, cmd, stream, timeout=COMMAND_TIMEOUT,
+                                                  cwd=state.cwd, env=state.env)
+                if exit_code is not None and shell_manager.get_cwd(session_id):
+                    state.cwd = shell_manager.get_cwd(session_id)  # e.g. an alias that cd's
+        
+        if exit_code is None:
+            # Enhanced command execution with timeout
+            exit_code = stream_subprocess(
+                cmd if use_shell else list(parsed.argv),
+                stream,
+                shell=use_shell,
+                cwd=state.cwd,
+                timeout=COMMAND_TIMEOUT,
+                env=state.environ(),
+                preexec_fn=cgroup_manager.preexec(session_id)
+            )
+        status = 'success' if exit_code == 0 else 'error'
+    except subprocess.TimeoutExpired:
+        stream.notice(f"\nError: Command timed out ({COMMAND_TIMEOUT}s limit)\n")
+        status = 'timeout'
+    except Exception as e:
+        stream.notice(f"Error: {e}\n")
+        status = 'error'
+    finally:
+        output_id = stream.finish()
+        active_streams.pop(session_id, None)
+        # Stages don't overlap: execution is what's left once starting the
+        # session's shell, output handling, emits and waiting for the
+        # client to ack output are taken out
+        command_stages.labels(stage='execute').observe(
+            max(time.perf_counter() - run_started - shell_time - stream.processing_time
+                - stream.emit_time - stream.blocked_time, 0))
+        command_stages.labels(stage='output').observe(stream.processing_time)
+    
+    if cache_key is not None and cached is None and exit_code == 0 and stream.captured is not None \
+            and not stream.truncated:
+        output_cache.put(cache_key, fingerprint, ''.join(stream.captured), exit_code)
+    family = command_family(cmd_name)
+    command_counter.labels(family=family, status=status).inc()
+    command_output_bytes.labels(family=family).observe(stream.written_bytes + stream.omitted_bytes)
+    
+    # Record command execution time
+    execution_time = time.time() - start_time_cmd
+    command_duration.labels(family=family).observe(execution_time)
+    
+    ttfb = stream.time_to_first_byte
+    tail = state.prompt if stream.ends_with_newline else '\n' + state.prompt
+    done_emit_time = timed_emit('command_done', {
+        'exit_code': exit_code,
+        'execution_time': round(execution_time, 3),
+        'time_to_first_byte': round(ttfb * 1000, 1) if ttfb is not None else None,
+        'bytes': stream.sent_bytes,
+        'truncated': stream.truncated,
+        'omitted_bytes': stream.omitted_bytes,
+        'output_id': output_id,
+        'cached': cached is not None,
+        'prompt': state.prompt,
+        'offset': record_output(session_id, tail)
+    }, session_id)
+    command_stages.labels(stage='emit').observe(stream.emit_time + done_emit_time)
+
+@socketio.on('output_ack')
+def handle_output_ack(data):
+    """Client has written output up to the given byte count"""
+    session_id = current_session_id()
+    stream = active_streams.get(session_id)
+    if stream is None and session_id in pty_sessions:
+        stream = pty_sessions[session_id].stream
+    if stream is None or not isinstance(data, dict):
+        return
+    acked = data.get('bytes')
+    if isinstance(acked, int) and not isinstance(acked, bool) and acked >= 0:
+        stream.ack(acked)
+
+@socketio.on('pty_input')
+def handle_pty_input(data):
+    """Keystrokes for a PTY-mode session, passed to its terminal as typed"""
+    session_id = current_session_id()
+    pty_session = pty_sessions.get(session_id)
+    if pty_session is None or not isinstance(data, str) or not data:
+        return
+    if len(data) > PTY_INPUT_MAX_BYTES:
+        logger.warning(f"Dropping oversized PTY input from {session_id}")
+        return
+    
+    info = user_sessions.get(session_id)
+    if info is not None:
+        info['last_activity'] = datetime.utcnow()
+        user_sessions.move_to_end(session_id)
+    
+    def admit(line):
+        refusal = screen_command(session_id, line, mode='pty')
+        if refusal is not None:
+            pty_session.stream.send(f"\r\n{refusal[1]}\r\n")
+            return False
+        if info is not None:
+            info['command_count'] += 1
+        return True
+    
+    # Lines are as typed, so edits made with the cursor keys aren't reflected
+    pty_session.write(data, admit)
+
+@socketio.on('pty_resize')
+def handle_pty_resize(data):
+    """The client's terminal changed size"""
+    pty_session = pty_sessions.get(current_session_id())
+    size = terminal_size(data)
+    if pty_session is not None and size:
+        pty_session.resize(*size)
+
+@socketio.on('complete')
+def handle_complete(data):
+    """Completions for the end of a line-mode command line, returned as the ack.
+
+    ``id`` is echoed back so the client can drop answers to requests it
+    has moved past.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('line'), str):
+        return {'error': 'invalid request'}
+    line = data['line'][-COMPLETION_MAX_LINE:]
+    offset = len(data['line']) - len(line)
+    state = get_session_state(current_session_id())
+    started = time.perf_counter()
+    try:
+        kind, start, matches = completer.complete(line, state)
+    except Exception as e:
+        logger.error(f"Completion error: {e}")
+        kind, start, matches = 'error', len(line), []
+    completion_duration.labels(kind=kind).observe(time.perf_counter() - started)
+    return {
+        'id': data.get('id'),
+        'start': offset + start,
+        'matches': matches,
+        'common': common_prefix(matches),
+        'prompt': state.prompt
+    }
 
 if __name__ == '__main__':
     # Get port from environment variable (for deployment platforms)
     port = int(os.environ.get('PORT', 8000))
     
-    print(f"🚀 Starting CBash server on port {port}")
+    print(f"🚀 Starting CBash server on port {port} ({ASYNC_MODE} mode)")
     print(f"📊 Metrics available at: http://localhost:{port}/metrics")
     print(f"🏥 Health check at: http://localhost:{port}/health")
     print(f"🖥️  Web terminal at: http://localhost:{port}/")
     
+    create_app({'START_SUBSYSTEMS': True})
+    
     # Listen on all IP addresses (0.0.0.0) so others can connect
     socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
 
@@ -1,7 +1,14 @@
+import os
+
+# Async backend: 'threading' or 'eventlet' (see server.py)
+ASYNC_MODE = os.environ.get('CBASH_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
 from flask import Flask, render_template, jsonify, request
 from flask_socketio import SocketIO, emit
 import subprocess
-import os
 import shlex
 import time
 import json
@@ -10,7 +17,7 @@ from datetime import datetime
 # Simple, fast Flask app configuration
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'cbash-secret-key'
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE)
 
 # Global state - simplified for performance
 active_sessions = {}
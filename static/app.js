@@ -6,6 +6,22 @@ let terminal;
 let currentTheme = 'dark';
 let commandHistory = [];
 let historyIndex = -1;
+let outputEndsWithNewline = true;
+// Bytes of session output shown so far; sent when reattaching so the server
+// only replays what we missed
+let scrollbackOffset = 0;
+let lastCommand = '';
+// In PTY mode keystrokes go straight to a terminal on the server, which
+// echoes them and does the line editing itself
+let ptyMode = false;
+// Ctrl-R reverse search: local history first, then the server's prefix index
+let historySearch = null;
+const HISTORY_SEARCH_DELAY = 150;
+// Tab completion: asked of the server once Tab presses pause; any other
+// key cancels a pending request and makes late answers stale
+let completion = null;
+let completionSeq = 0;
+const COMPLETION_DELAY = 30;
 let sessionStats = {
   commandCount: 0,
   startTime: Date.now(),
@@ -71,7 +87,20 @@ function initializeApp() {
 
 // Socket.IO initialization
 function initializeSocket() {
-  socket = io();
+  socket = io({
+    auth: cb => cb({
+      token: sessionStorage.getItem('cbash-session-token'),
+      offset: scrollbackOffset,
+      // Output as raw UTF-8 frames, deflated when large if we can inflate
+      binary: true,
+      deflate: typeof DecompressionStream !== 'undefined',
+      // Raw keystrokes to a server-side terminal, if enabled there; opt in
+      // with localStorage 'cbash-pty' = '1'
+      pty: localStorage.getItem('cbash-pty') === '1',
+      cols: terminal ? terminal.cols : 80,
+      rows: terminal ? terminal.rows : 24
+    })
+  });
   
   socket.on('connect', function() {
     updateConnectionStatus('connected');
@@ -83,45 +112,178 @@ function initializeSocket() {
     showNotification('🔴 Disconnected from server', 'error');
   });
   
-  socket.on('initial_prompt', function(prompt) {
+  socket.on('initial_prompt', inOrder(function(prompt) {
+    if (scrollbackOffset > 0) {
+      // We had a session but the server couldn't resume it
+      terminal.write('\r\n[session ended, started a new one]\r\n');
+      showNotification('⚠️ Previous session has ended', 'warning');
+    }
     terminal.write(prompt);
-  });
+  }));
   
-  socket.on('response', function(data) {
+  // Reattached to our session after a reconnect or page reload: write the
+  // output we haven't shown yet
+  socket.on('session_resumed', inOrder(function(data) {
+    setMode(data.mode);
+    let text = data.data;
+    if (scrollbackOffset > 0 && data.start > scrollbackOffset) {
+      text = '\r\n[earlier output not available]\r\n' + text;
+    }
+    terminal.write(text);
+    if (data.data) {
+      outputEndsWithNewline = data.data.endsWith('\n');
+    }
+    scrollbackOffset = data.offset;
+    sessionStats.sessionId = data.session_id;
+    sessionStats.startTime = new Date(data.connected_at).getTime();
+    showNotification(data.running ? '🔄 Session resumed, command still running' : '🔄 Session resumed', 'success');
+  }));
+  
+  socket.on('response', inOrder(function(data) {
     if (typeof data === 'object') {
-      if (data.output) {
-        // Write output with proper formatting
-        terminal.write(data.output);
-        if (!data.output.endsWith('\n')) {
-          terminal.write('\r\n');
-        }
-      }
-      if (data.prompt) {
-        terminal.write(data.prompt);
+      let text = data.output || '';
+      if (text && !text.endsWith('\n')) {
+        text += '\n';
       }
+      terminal.write(text + (data.prompt || ''));
       if (data.execution_time) {
-        updateExecutionStats(data.execution_time, data.command);
+        updateExecutionStats(data.execution_time, lastCommand);
+      }
+      if (data.offset) {
+        scrollbackOffset = data.offset;
       }
     } else {
       terminal.write(data);
     }
     sessionStats.commandCount++;
     updateSessionStats();
-  });
+  }));
+  
+  // Streamed command output: write each frame as it arrives and acknowledge
+  // it so the server keeps sending (it pauses once too much is unacknowledged)
+  socket.on('output_frame', inOrder(async function(frame) {
+    let bytes = new Uint8Array(frame.data);
+    if (frame.deflated) {
+      bytes = await inflate(bytes);
+    }
+    terminal.write(bytes);
+    outputEndsWithNewline = bytes.length === 0 || bytes[bytes.length - 1] === 10;
+    trackOutput(frame);
+  }));
+  
+  // Text frames, sent to clients that don't ask for binary ones
+  socket.on('output_chunk', inOrder(function(chunk) {
+    terminal.write(chunk.data);
+    outputEndsWithNewline = chunk.data.endsWith('\n');
+    trackOutput(chunk);
+  }));
   
-  socket.on('clear_terminal', function(data) {
+  socket.on('command_done', inOrder(function(data) {
+    terminal.write((outputEndsWithNewline ? '' : '\n') + (data.prompt || ''));
+    outputEndsWithNewline = true;
+    if (data.execution_time) {
+      updateExecutionStats(data.execution_time, lastCommand);
+    }
+    if (data.output_id) {
+      showNotification(`✂️ Output truncated; CBash.downloadOutput('${data.output_id}') saves all of it`, 'warning', 8000);
+    }
+    if (data.offset) {
+      scrollbackOffset = data.offset;
+    }
+    sessionStats.commandCount++;
+    updateSessionStats();
+  }));
+  
+  socket.on('clear_terminal', inOrder(function(data) {
     terminal.clear();
     if (data.cwd) {
       terminal.write(data.cwd + ' $ ');
     }
-  });
+    if (data.offset) {
+      scrollbackOffset = data.offset;
+    }
+  }));
   
   socket.on('session_info', function(data) {
+    setMode(data.mode);
     sessionStats.sessionId = data.session_id;
     sessionStats.startTime = new Date(data.connected_at).getTime();
+    scrollbackOffset = data.offset || 0;
+    if (data.token) {
+      // Per tab, so a reload reattaches but a new tab gets its own session
+      sessionStorage.setItem('cbash-session-token', data.token);
+    }
   });
 }
 
+// Inflating a frame is asynchronous, so terminal events are handled one at a
+// time in arrival order
+let terminalEvents = Promise.resolve();
+
+function inOrder(handler) {
+  return function(data) {
+    terminalEvents = terminalEvents
+      .then(() => handler(data))
+      .catch(error => console.error('Failed to handle terminal event:', error));
+  };
+}
+
+async function inflate(bytes) {
+  const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+  return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+function trackOutput(frame) {
+  if (frame.offset) {
+    scrollbackOffset = frame.offset;
+  }
+  socket.emit('output_ack', { bytes: frame.bytes });
+}
+
+// Fetch the full output of a truncated command page by page and save it
+async function downloadOutput(outputId) {
+  const token = sessionStorage.getItem('cbash-session-token');
+  const pages = [];
+  let offset = 0;
+  while (true) {
+    const response = await fetch(`/api/output/${outputId}?offset=${offset}`, {
+      headers: { 'X-Session-Token': token }
+    });
+    if (!response.ok) {
+      showNotification('❌ Output is no longer available', 'error');
+      return;
+    }
+    const page = await response.json();
+    pages.push(page.data);
+    offset = page.next_offset;
+    if (page.eof) break;
+  }
+  const link = document.createElement('a');
+  link.href = URL.createObjectURL(new Blob(pages, { type: 'text/plain' }));
+  link.download = `cbash-output-${outputId}.txt`;
+  link.click();
+  URL.revokeObjectURL(link.href);
+}
+
+function sendCommand(cmd) {
+  lastCommand = cmd;
+  if (ptyMode) {
+    socket.emit('pty_input', cmd + '\r');
+  } else {
+    socket.emit('command', cmd);
+  }
+}
+
+function setMode(mode) {
+  ptyMode = mode === 'pty';
+  // A real terminal sends \r\n itself; line mode output uses bare \n
+  terminal.options.convertEol = !ptyMode;
+  if (ptyMode) {
+    // The size may have changed since we connected
+    socket.emit('pty_resize', { cols: terminal.cols, rows: terminal.rows });
+  }
+}
+
 // Terminal initialization
 function initializeTerminal() {
   terminal = new Terminal({
@@ -130,6 +292,7 @@ function initializeTerminal() {
     fontFamily: 'SF Mono, Monaco, Inconsolata, Roboto Mono, monospace',
     theme: themes[currentTheme],
     scrollback: 1000,
+    convertEol: true, // Line mode output uses bare \n line endings
     allowTransparency: true,
     rightClickSelectsWord: true,
     wordSeparator: ' ()[]{}\'",;'
@@ -158,17 +321,69 @@ function initializeTerminal() {
   
   terminal.open(document.getElementById('terminal'));
   
+  terminal.onResize(size => {
+    if (ptyMode) {
+      socket.emit('pty_resize', { cols: size.cols, rows: size.rows });
+    }
+  });
+  
   // Handle terminal input
   let currentLine = '';
+  const replaceLine = text => {
+    for (let i = 0; i < currentLine.length; i++) {
+      terminal.write('\b \b');
+    }
+    currentLine = text;
+    terminal.write(text);
+  };
   terminal.onData(data => {
+    if (ptyMode) {
+      socket.emit('pty_input', data);
+      return;
+    }
+    if (data === '\t') {
+      if (!historySearch) {
+        requestCompletion(currentLine, replaceLine);
+      }
+      return;
+    }
+    cancelCompletion();
+    if (historySearch) {
+      if (data === '\r' || data === '\u001b' || data === '\u0007') { // Accept, or cancel with Esc/Ctrl+G
+        const match = data === '\r' ? historySearch.match : historySearch.original;
+        endHistorySearch();
+        replaceLine(match || '');
+        return;
+      }
+      if (data === '\u007F') {
+        historySearch.query = historySearch.query.slice(0, -1);
+      } else if (data === '\u0012') { // Ctrl+R again: next older match
+        historySearch.skip++;
+      } else if (data.length === 1 && data.charCodeAt(0) >= 32) {
+        historySearch.query += data;
+        historySearch.skip = 0;
+      } else {
+        return;
+      }
+      updateHistorySearch(replaceLine);
+      return;
+    }
+    if (data === '\u0012') { // Ctrl+R
+      historySearch = { query: '', skip: 0, match: '', original: currentLine, timer: null, request: null };
+      updateHistorySearch(replaceLine);
+      return;
+    }
     if (data === '\r') { // Enter key
+      terminal.write('\r\n');
       if (currentLine.trim()) {
         commandHistory.push(currentLine);
         historyIndex = commandHistory.length;
-        socket.emit('command', currentLine);
+        sendCommand(currentLine);
         
         // Save command history to localStorage
         saveCommandHistory();
+      } else {
+        sendCommand(''); // Empty line, just get a new prompt
       }
       currentLine = '';
     } else if (data === '\u007F') { // Backspace
@@ -206,9 +421,9 @@ function initializeTerminal() {
     } else if (data === '\u0003') { // Ctrl+C
       terminal.write('^C\r\n');
       currentLine = '';
-      socket.emit('command', ''); // Send empty command to get new prompt
+      sendCommand(''); // Send empty command to get new prompt
     } else if (data === '\u0004') { // Ctrl+D
-      socket.emit('command', 'exit');
+      sendCommand('exit');
     } else if (data.length === 1 && data.charCodeAt(0) >= 32) { // Printable characters
       currentLine += data;
       terminal.write(data);
@@ -219,6 +434,98 @@ function initializeTerminal() {
   terminal.focus();
 }
 
+// Tab completion
+function requestCompletion(line, replaceLine) {
+  cancelCompletion();
+  const id = ++completionSeq;
+  completion = {
+    id,
+    timer: setTimeout(() => {
+      socket.emit('complete', { id, line }, result => {
+        if (completion && completion.id === id && result && result.id === id) {
+          completion = null;
+          applyCompletion(line, result, replaceLine);
+        }
+      });
+    }, COMPLETION_DELAY)
+  };
+}
+
+function cancelCompletion() {
+  if (completion) {
+    clearTimeout(completion.timer);
+    completion = null;  // Any answer still on its way is ignored
+  }
+}
+
+function applyCompletion(line, result, replaceLine) {
+  const { matches, start } = result;
+  const word = line.slice(start);
+  if (matches.length === 1) {
+    const match = matches[0];
+    replaceLine(line.slice(0, start) + match + (match.endsWith('/') ? '' : ' '));
+  } else if (result.common.length > word.length) {
+    replaceLine(line.slice(0, start) + result.common);
+  } else if (matches.length > 1) {
+    // Nothing more to fill in: list the candidates and redraw the line
+    terminal.write('\r\n' + matches.join('  ') + '\r\n' + result.prompt + line);
+  }
+}
+
+// Reverse history search
+function historySearchLine() {
+  return `(reverse-i-search)\`${historySearch.query}': ${historySearch.match}`;
+}
+
+function updateHistorySearch(replaceLine) {
+  const search = historySearch;
+  clearTimeout(search.timer);
+  if (search.request) {
+    search.request.abort();
+    search.request = null;
+  }
+  const local = [];
+  for (let i = commandHistory.length - 1; i >= 0; i--) {
+    const cmd = commandHistory[i];
+    if (search.query && cmd.startsWith(search.query) && !local.includes(cmd)) {
+      local.push(cmd);
+    }
+  }
+  search.match = local[search.skip] || '';
+  replaceLine(historySearchLine());
+  if (search.match || !search.query || !sessionStats.sessionId) {
+    return;
+  }
+  // Nothing local; ask the server once typing pauses
+  search.timer = setTimeout(async () => {
+    search.request = new AbortController();
+    const params = new URLSearchParams({
+      session: sessionStats.sessionId,
+      prefix: search.query,
+      limit: local.length + search.skip + 20
+    });
+    try {
+      const response = await fetch(`/api/command-history?${params}`, { signal: search.request.signal });
+      const { entries } = await response.json();
+      const remote = [...new Set(entries.map(entry => entry.command))].filter(cmd => !local.includes(cmd));
+      if (historySearch === search && remote[search.skip - local.length]) {
+        search.match = remote[search.skip - local.length];
+        replaceLine(historySearchLine());
+      }
+    } catch (error) {
+      // Aborted by a newer keystroke, or the server is unreachable
+    }
+  }, HISTORY_SEARCH_DELAY);
+}
+
+function endHistorySearch() {
+  clearTimeout(historySearch.timer);
+  if (historySearch.request) {
+    historySearch.request.abort();
+  }
+  historySearch = null;
+}
+
 // UI initialization
 function initializeUI() {
   // Sidebar toggle
@@ -249,7 +556,7 @@ function initializeUI() {
     btn.addEventListener('click', () => {
       const cmd = btn.getAttribute('data-cmd');
       if (cmd && socket) {
-        socket.emit('command', cmd);
+        sendCommand(cmd);
         commandHistory.push(cmd);
         historyIndex = commandHistory.length;
         saveCommandHistory();
@@ -394,7 +701,7 @@ function handleCommandPaletteKeydown(e) {
   if (e.key === 'Enter') {
     const query = e.target.value.trim();
     if (query && socket) {
-      socket.emit('command', query);
+      sendCommand(query);
       commandHistory.push(query);
       historyIndex = commandHistory.length;
       saveCommandHistory();
@@ -439,7 +746,7 @@ function updateCommandPaletteResults(query) {
 
 function executeFromPalette(cmd) {
   if (socket) {
-    socket.emit('command', cmd);
+    sendCommand(cmd);
     commandHistory.push(cmd);
     historyIndex = commandHistory.length;
     saveCommandHistory();
@@ -777,5 +1084,6 @@ window.CBash = {
   toggleSidebar,
   toggleCommandPalette,
   showNotification,
-  executeFromPalette
+  executeFromPalette,
+  downloadOutput
 };
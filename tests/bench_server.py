@@ -0,0 +1,525 @@
+"""Offline benchmark of the Socket.IO command path.
+
+Starts server.py in a child process with fake backends in place of Redis
+and the shell, so it runs anywhere and measures CBash itself rather than
+the commands:
+
+* the fake Redis answers every call after --redis-latency seconds, and
+* the fake shell simulates commands in-process: ``echo`` prints its
+  arguments, ``cat`` prints --large-bytes of output, ``sleep`` sleeps.
+
+Then it opens --sessions Socket.IO sessions and replays a command mix on
+each of them:
+
+* tiny: ``echo hello``
+* large: ``cat large.log`` (--large-bytes of output, acked as it arrives)
+* long: ``sleep <--long-seconds>``
+* burst: --burst empty lines (Enter pressed repeatedly) sent back to back
+
+and prints a JSON report: server import, subsystem start and boot time and
+the first connect, connects/s, commands/s, p50/p99 end-to-end latency and
+time to first byte (overall and per kind), server RSS per session and
+Redis round trips per command.
+
+    python tests/bench_server.py --sessions 50 --commands 20 --output bench.json
+    python tests/bench_server.py --baseline bench.json
+
+With --baseline it exits non-zero if throughput, p99 latency or memory per
+session got more than --tolerance worse. --backend mysh runs commands in
+real mysh shells instead (set CBASH_SHELL_PATH); --redis none runs without
+Redis, on the in-process fallbacks.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MIXES = {
+    'default': {'tiny': 70, 'large': 10, 'long': 10, 'burst': 10},
+    'tiny': {'tiny': 100},
+    'output': {'tiny': 50, 'large': 50},
+}
+
+DONE_EVENTS = ('command_done', 'response', 'clear_terminal')
+ERROR_PREFIXES = ('Error:', 'System error:')
+
+# Regressions --baseline checks for: report key, and whether higher is better
+GATES = [
+    ('commands_per_s', True),
+    ('connects_per_s', True),
+    ('latency_p99_ms', False),
+    ('ttfb_p99_ms', False),
+    ('rss_per_session_kb', False),
+]
+
+
+# Server side: runs in the child process
+class FakeRedis:
+    """Just enough of redis.Redis for the server, with a fixed round trip.
+
+    Scripts return 0 (rate limits allow, counts are zero), reads return
+    nothing, and writes are dropped.
+    """
+
+    RESULTS = {'hgetall': dict, 'xrevrange': list, 'zrangebylex': list, 'zrange': list,
+               'ping': lambda: True}
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def result(self, name, args):
+        if name == 'mget':
+            return [None] * len(args[0])
+        factory = self.RESULTS.get(name)
+        return factory() if factory else None
+
+    def register_script(self, script):
+        def run(keys=None, args=None, client=None):
+            if isinstance(client, FakePipeline):
+                client.calls.append(('evalsha', ()))
+                return client
+            self.round_trip()
+            return 0
+        return run
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.round_trip()
+            return self.result(name, args)
+        return call
+
+
+class FakePipeline:
+    """Queues calls and answers them all in one round trip."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def execute(self):
+        self.redis.round_trip()
+        results = [0 if name == 'evalsha' else self.redis.result(name, args) for name, args in self.calls]
+        self.calls = []
+        return results
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append((name, args))
+            return self
+        return call
+
+
+class FakeShell:
+    """Simulates commands in-process in place of mysh and subprocesses."""
+
+    LINE = 'x' * 79 + '\n'
+
+    def __init__(self, server, large_bytes):
+        self.server = server
+        self.large_bytes = large_bytes
+
+    def run(self, cmd, stream):
+        name, _, rest = cmd.strip().partition(' ')
+        if name == 'echo':
+            stream.write(rest + '\n')
+        elif name == 'cat':
+            block = self.LINE * (self.server.STREAM_CHUNK_SIZE // len(self.LINE) + 1)
+            remaining = self.large_bytes
+            while remaining > 0:
+                stream.write(block[:remaining])
+                remaining -= len(block)
+        elif name == 'sleep':
+            self.server.socketio.sleep(float(rest or 0))
+        else:
+            stream.write(f'{name}: command not found\n')
+            return 127
+        return 0
+
+    def install(self):
+        shells = self.server.shell_manager
+        shell_info = {'cwd': None}
+        shells.available = True
+        shells.pool.max_size = 0  # Nothing to pre-spawn
+        shells.assign_shell = lambda session_id: True
+        shells.get_shell = lambda session_id, cwd=None, env=None: shell_info
+        shells.is_alive = lambda session_id: True
+        shells.get_cwd = lambda session_id: None
+        shells.cleanup_shell = lambda session_id: None
+        shells.execute = lambda session_id, cmd, stream, timeout=None, cwd=None, env=None: \
+            self.run(cmd, stream)
+        self.server.stream_subprocess = lambda args, stream, shell=False, **kwargs: \
+            self.run(args if shell else ' '.join(args), stream)
+
+
+def serve(args):
+    """Child process: import the server, put the fakes in and serve"""
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    started = time.perf_counter()
+    import server
+    import_time = time.perf_counter() - started
+
+    fake_redis = None
+    if args.redis == 'fake':
+        fake_redis = FakeRedis(args.redis_latency)
+        manager = server.redis_manager
+        manager.started = True  # No pool, no health check
+        manager.client = fake_redis
+        manager.state = 'closed'
+    if args.backend == 'fake':
+        FakeShell(server, args.large_bytes).install()
+    started = time.perf_counter()
+    app = server.create_app({'START_SUBSYSTEMS': True})
+    start_time = time.perf_counter() - started
+
+    @app.route('/_bench/stats')
+    def bench_stats():
+        return server.jsonify({
+            'redis_round_trips': fake_redis.round_trips if fake_redis else 0,
+            'sessions': len(server.user_sessions)
+        })
+
+    print(json.dumps({'import_s': round(import_time, 4), 'start_subsystems_s': round(start_time, 4)}), flush=True)
+    server.socketio.run(app, host='127.0.0.1', port=args.port, debug=False,
+                        allow_unsafe_werkzeug=True, log_output=False)
+
+
+# Client side
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def start_server(args, port):
+    env = dict(
+        os.environ,
+        CBASH_ASYNC_MODE=args.mode,
+        # The limiter would otherwise throttle a single benchmarking host
+        CBASH_COMMAND_RATE_LIMIT='1000000000',
+        CBASH_COMMAND_RATE_LIMIT_PER_IP='1000000000',
+        CBASH_MAX_SESSIONS=str(max(args.sessions * 2, 500))
+    )
+    if args.redis == 'none':
+        env['REDIS_URL'] = 'redis://127.0.0.1:1'
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--port', str(port),
+               '--redis', args.redis, '--redis-latency', str(args.redis_latency),
+               '--backend', args.backend, '--large-bytes', str(args.large_bytes)]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.PIPE,
+                               stderr=None if args.verbose else subprocess.DEVNULL, text=True)
+    startup = json.loads(process.stdout.readline() or '{}')
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/health', timeout=1).ok:
+                startup['boot_s'] = round(time.perf_counter() - started, 4)
+                return process, startup
+        except requests.RequestException:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('server did not start')
+
+
+def command_failed(data):
+    """Whether a completion event reports a failed command"""
+    if not isinstance(data, dict):
+        return False
+    if 'exit_code' in data:
+        return data['exit_code'] != 0  # None: the command never ran, or timed out
+    return str(data.get('output') or '').startswith(ERROR_PREFIXES)
+
+
+class BenchClient:
+    """One simulated terminal session."""
+
+    def __init__(self, url):
+        self.url = url
+        self.sio = socketio.Client(reconnection=False)
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        self.completed = 0
+        self.failed = 0
+        self.first_byte = None
+        self.sio.on('output_chunk', self.on_chunk)
+        for event in DONE_EVENTS:
+            self.sio.on(event, self.on_done)
+
+    def on_chunk(self, chunk):
+        with self.lock:
+            if self.first_byte is None:
+                self.first_byte = time.perf_counter()
+        self.sio.emit('output_ack', {'bytes': chunk['bytes']})
+
+    def on_done(self, data):
+        with self.lock:
+            self.completed += 1
+            if command_failed(data):
+                self.failed += 1
+            self.done.notify()
+
+    def connect(self):
+        self.sio.connect(self.url, transports=['websocket'], wait_timeout=30)
+
+    def run(self, lines, timeout):
+        """Send lines back to back and wait for all of them to finish.
+
+        Returns (latency, time to first byte or None), or None on timeout
+        or if any of them failed.
+        """
+        with self.lock:
+            self.completed = 0
+            self.failed = 0
+            self.first_byte = None
+        started = time.perf_counter()
+        for line in lines:
+            self.sio.emit('command', line)
+        deadline = time.time() + timeout
+        with self.lock:
+            while self.completed < len(lines):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.done.wait(remaining)
+            if self.failed:
+                return None
+            finished = time.perf_counter()
+            first_byte = self.first_byte
+        return finished - started, (first_byte - started) if first_byte is not None else None
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+def workload(kind, args):
+    """The lines one command of this kind sends"""
+    if kind == 'tiny':
+        return ['echo hello']
+    if kind == 'large':
+        return ['cat large.log']
+    if kind == 'long':
+        return [f'sleep {args.long_seconds}']
+    return [''] * args.burst
+
+
+def server_rss(process, children):
+    rss = process.memory_info().rss
+    if children:
+        rss += sum(child.memory_info().rss for child in process.children(recursive=True))
+    return rss
+
+
+def run(args):
+    mix = MIXES[args.mix]
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    server, startup = start_server(args, port)
+    server_proc = psutil.Process(server.pid)
+    count_children = args.backend == 'mysh'
+    clients = []
+    samples = {kind: {'latency': [], 'ttfb': [], 'errors': 0} for kind in mix}
+    connect_errors = 0
+    lock = threading.Lock()
+
+    try:
+        baseline_rss = server_rss(server_proc, count_children)
+        # The first session also pays for whatever the server set up lazily
+        first = BenchClient(url)
+        first_started = time.perf_counter()
+        first.connect()
+        startup['first_connect_ms'] = ms(time.perf_counter() - first_started)
+        clients.append(first)
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            def open_session(_):
+                client = BenchClient(url)
+                client.connect()
+                return client
+
+            connect_started = time.perf_counter()
+            for future in [pool.submit(open_session, i) for i in range(args.sessions - 1)]:
+                try:
+                    clients.append(future.result())
+                except Exception:
+                    connect_errors += 1
+            connect_time = time.perf_counter() - connect_started
+        time.sleep(0.5)  # Let connect handlers finish before measuring
+        connected_rss = server_rss(server_proc, count_children)
+        stats_before = requests.get(f'{url}/_bench/stats', timeout=5).json()
+
+        peak_rss = connected_rss
+        sampling = True
+
+        def sample():
+            nonlocal peak_rss
+            while sampling:
+                try:
+                    peak_rss = max(peak_rss, server_rss(server_proc, count_children))
+                except psutil.Error:
+                    return
+                time.sleep(0.1)
+
+        def drive(client, seed):
+            rng = random.Random(seed)
+            kinds = rng.choices(list(mix), weights=list(mix.values()), k=args.commands)
+            for kind in kinds:
+                result = client.run(workload(kind, args), args.timeout)
+                with lock:
+                    if result is None:
+                        samples[kind]['errors'] += 1
+                    else:
+                        samples[kind]['latency'].append(result[0])
+                        if result[1] is not None:
+                            samples[kind]['ttfb'].append(result[1])
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        drive_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(len(clients), 1)) as drivers:
+            list(drivers.map(drive, clients, range(args.seed, args.seed + len(clients))))
+        drive_time = time.perf_counter() - drive_started
+        sampling = False
+        sampler.join()
+        stats_after = requests.get(f'{url}/_bench/stats', timeout=5).json()
+    finally:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as closer:
+            list(closer.map(BenchClient.close, clients))
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    latencies = [value for kind in samples.values() for value in kind['latency']]
+    ttfbs = [value for kind in samples.values() for value in kind['ttfb']]
+    completed = len(latencies)
+    sessions = len(clients)
+    return {
+        'config': {
+            'mode': args.mode, 'backend': args.backend, 'redis': args.redis,
+            'redis_latency_ms': ms(args.redis_latency), 'mix': mix, 'sessions': args.sessions,
+            'commands_per_session': args.commands, 'large_bytes': args.large_bytes,
+            'long_seconds': args.long_seconds, 'burst': args.burst
+        },
+        'startup': startup,
+        'sessions': sessions,
+        'connect_errors': connect_errors,
+        'connects_per_s': round((sessions - 1) / connect_time, 1) if connect_time and sessions > 1 else None,
+        'commands_completed': completed,
+        'command_errors': sum(kind['errors'] for kind in samples.values()),
+        'commands_per_s': round(completed / drive_time, 1) if drive_time else None,
+        'latency_p50_ms': ms(percentile(latencies, 50)),
+        'latency_p99_ms': ms(percentile(latencies, 99)),
+        'ttfb_p50_ms': ms(percentile(ttfbs, 50)),
+        'ttfb_p99_ms': ms(percentile(ttfbs, 99)),
+        'by_kind': {
+            kind: {
+                'completed': len(data['latency']),
+                'errors': data['errors'],
+                'latency_p50_ms': ms(percentile(data['latency'], 50)),
+                'latency_p99_ms': ms(percentile(data['latency'], 99)),
+                'ttfb_p50_ms': ms(percentile(data['ttfb'], 50)),
+                'ttfb_p99_ms': ms(percentile(data['ttfb'], 99)),
+            } for kind, data in samples.items()
+        },
+        'rss_per_session_kb': round((connected_rss - baseline_rss) / sessions / 1024, 1) if sessions else None,
+        'server_peak_rss_mb': round(peak_rss / (1024 * 1024), 1),
+        'redis_round_trips_per_command': round(
+            (stats_after['redis_round_trips'] - stats_before['redis_round_trips']) / completed, 2)
+            if completed else None,
+    }
+
+
+def regressions(report, baseline, tolerance):
+    """Gated metrics more than ``tolerance`` worse than the baseline"""
+    found = []
+    for key, higher_is_better in GATES:
+        old, new = baseline.get(key), report.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if (-change if higher_is_better else change) > tolerance:
+            found.append(f'{key}: {old} -> {new} ({change:+.0%})')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='threading', choices=['threading', 'eventlet'])
+    parser.add_argument('--backend', default='fake', choices=['fake', 'mysh'])
+    parser.add_argument('--redis', default='fake', choices=['fake', 'none'])
+    parser.add_argument('--redis-latency', type=float, default=0.0002, help='seconds per fake Redis round trip')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--commands', type=int, default=20, help='commands per session')
+    parser.add_argument('--mix', default='default', choices=sorted(MIXES))
+    parser.add_argument('--large-bytes', type=int, default=256 * 1024)
+    parser.add_argument('--long-seconds', type=float, default=0.5)
+    parser.add_argument('--burst', type=int, default=8, help='lines per burst')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--concurrency', type=int, default=20, help='parallel connects')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='also write the report here')
+    parser.add_argument('--baseline', help='earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--verbose', action='store_true', help="show the server's log")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    report = run(args)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print(f'regression: {line}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Load test comparing CBash's async backends.
+
+Starts server.py once per backend (CBASH_ASYNC_MODE) and drives it over
+Socket.IO with two kinds of simulated clients:
+
+* idle sessions, which connect and then sit there, and
+* busy sessions, which run --commands commands back to back.
+
+It prints a JSON report per backend: how many sessions the single worker
+held, connect time, command latency percentiles (p50/p99/max), and the
+server's thread count and RSS at peak.
+
+    python tests/loadtest.py --modes threading eventlet --idle 500 --busy 100
+
+Needs python-socketio's client extras (requests and websocket-client).
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psutil
+import requests
+import socketio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ERROR_PREFIXES = ('Error:', 'System error:')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def start_server(mode, port):
+    env = dict(os.environ, PORT=str(port), CBASH_ASYNC_MODE=mode)
+    # Keep Redis out of the measurement unless the caller points us at one
+    env.setdefault('REDIS_URL', 'redis://127.0.0.1:1')
+    process = subprocess.Popen(
+        [sys.executable, 'server.py'],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/health', timeout=1).ok:
+                return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f'server did not start in {mode} mode')
+
+
+def command_failed(data):
+    """Whether a completion event reports a failed command"""
+    if not isinstance(data, dict):
+        return False
+    if 'exit_code' in data:
+        return data['exit_code'] != 0  # None: the command never ran, or timed out
+    return str(data.get('output') or '').startswith(ERROR_PREFIXES)
+
+
+class LoadClient:
+    """One simulated terminal session."""
+
+    def __init__(self, url):
+        self.url = url
+        self.sio = socketio.Client(reconnection=False)
+        self.done = threading.Event()
+        self.failed = False
+        self.sio.on('output_chunk', self.on_chunk)
+        self.sio.on('command_done', self.on_done)
+        self.sio.on('response', self.on_done)
+
+    def on_chunk(self, chunk):
+        self.sio.emit('output_ack', {'bytes': chunk['bytes']})
+
+    def on_done(self, data):
+        self.failed = command_failed(data)
+        self.done.set()
+
+    def connect(self):
+        self.sio.connect(self.url, transports=['websocket'], wait_timeout=30)
+
+    def run(self, command, timeout):
+        """Run one command; returns its latency in seconds, or None on timeout or failure"""
+        self.done.clear()
+        started = time.perf_counter()
+        self.sio.emit('command', command)
+        if not self.done.wait(timeout) or self.failed:
+            return None
+        return time.perf_counter() - started
+
+    def close(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+
+def run_mode(mode, args):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    server = start_server(mode, port)
+    server_proc = psutil.Process(server.pid)
+    clients = []
+    latencies = []
+    errors = 0
+    connect_errors = 0
+    peak_threads = 0
+    peak_rss = 0
+
+    try:
+        pool = ThreadPoolExecutor(max_workers=args.concurrency)
+
+        def open_session(_):
+            client = LoadClient(url)
+            client.connect()
+            return client
+
+        connect_started = time.perf_counter()
+        for future in [pool.submit(open_session, i) for i in range(args.idle + args.busy)]:
+            try:
+                clients.append(future.result())
+            except Exception:
+                connect_errors += 1
+        connect_time = time.perf_counter() - connect_started
+
+        busy = clients[:args.busy]
+        lock = threading.Lock()
+
+        def drive(client):
+            nonlocal errors
+            for _ in range(args.commands):
+                latency = client.run(args.command, args.timeout)
+                with lock:
+                    if latency is None:
+                        errors += 1
+                    else:
+                        latencies.append(latency)
+
+        sampling = True
+
+        def sample():
+            nonlocal peak_threads, peak_rss
+            while sampling:
+                try:
+                    peak_threads = max(peak_threads, server_proc.num_threads())
+                    peak_rss = max(peak_rss, server_proc.memory_info().rss)
+                except psutil.Error:
+                    return
+                time.sleep(0.1)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        busy_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(len(busy), 1)) as drivers:
+            list(drivers.map(drive, busy))
+        busy_time = time.perf_counter() - busy_started
+        sampling = False
+        sampler.join()
+        pool.shutdown()
+
+        return {
+            'mode': mode,
+            'sessions_requested': args.idle + args.busy,
+            'sessions_per_worker': len(clients),
+            'connect_errors': connect_errors,
+            'connect_time_s': round(connect_time, 3),
+            'busy_sessions': len(busy),
+            'command': args.command,
+            'commands_completed': len(latencies),
+            'command_errors': errors,
+            'commands_per_s': round(len(latencies) / busy_time, 1) if busy_time else None,
+            'latency_p50_ms': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+            'latency_p99_ms': round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+            'latency_max_ms': round(max(latencies) * 1000, 1) if latencies else None,
+            'server_peak_threads': peak_threads,
+            'server_peak_rss_mb': round(peak_rss / (1024 * 1024), 1),
+        }
+    finally:
+        # Disconnects can take a few seconds each against the threading
+        # server, so close everything in parallel
+        with ThreadPoolExecutor(max_workers=args.concurrency) as closer:
+            list(closer.map(LoadClient.close, clients))
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['threading', 'eventlet'])
+    parser.add_argument('--idle', type=int, default=200, help='sessions that only connect')
+    parser.add_argument('--busy', type=int, default=50, help='sessions that run commands')
+    parser.add_argument('--commands', type=int, default=10, help='commands per busy session')
+    parser.add_argument('--command', default='sleep 0.2')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--concurrency', type=int, default=50, help='parallel connects')
+    args = parser.parse_args()
+
+    results = [run_mode(mode, args) for mode in args.modes]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
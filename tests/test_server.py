@@ -1,9 +1,16 @@
 import pytest
 import json
-from unittest.mock import patch, MagicMock
-from server import app, socket_manager, shell_manager
+from unittest.mock import patch, MagicMock, ANY
+from collections import deque
+from datetime import datetime
+from server import app, shell_manager
 import tempfile
 import os
+import shutil
+import subprocess
+import sys
+import time
+import errno
 
 @pytest.fixture
 def client():
@@ -12,6 +19,50 @@ def client():
     with app.test_client() as client:
         yield client
 
+@pytest.fixture(scope='session')
+def mysh_path(tmp_path_factory):
+    """Build mysh from source for this platform."""
+    if shutil.which('gcc') is None:
+        pytest.skip('gcc not available to build mysh')
+    path = str(tmp_path_factory.mktemp('mysh') / 'mysh')
+    source = os.path.join(os.path.dirname(__file__), '..', 'enhanced_shell.c')
+    subprocess.run(['gcc', '-o', path, source], check=True)
+    return path
+
+class CollectingStream:
+    """Stand-in for OutputStream that keeps everything written to it."""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, text):
+        self.chunks.append(text)
+    
+    @property
+    def output(self):
+        return ''.join(self.chunks)
+
+def run_command(client, command, timeout=10):
+    """Emit a command and collect events until its final one arrives."""
+    client.emit('command', command)
+    received = []
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        received.extend(client.get_received())
+        if received and received[-1]['name'] in ('command_done', 'response', 'clear_terminal'):
+            return received
+        time.sleep(0.01)
+    raise AssertionError(f'no completion event for {command!r}')
+
+def run_builtin(cmd, state=None, session_id='builtin-session'):
+    """Resolve a command line to a builtin and run it; returns (exit code, output)."""
+    from server import resolve_builtin, SessionState
+    state = state or SessionState()
+    resolved = resolve_builtin(cmd, state)
+    assert resolved is not None, cmd
+    entry, args = resolved
+    return entry.handler(state, args, session_id)
+
 @pytest.fixture
 def socket_client():
     """Create a test client for Socket.IO."""
@@ -51,6 +102,9 @@ class TestRoutes:
         mock_memory.return_value = MagicMock(percent=45.2)
         mock_disk.return_value = MagicMock(percent=60.8)
         
+        # Handlers serve the sampler's latest sample
+        from server import system_sampler
+        system_sampler.sample()
         response = client.get('/api/system-info')
         assert response.status_code == 200
         data = json.loads(response.data)
@@ -61,13 +115,14 @@ class TestRoutes:
 class TestShellManager:
     """Test shell management functionality."""
     
-    def test_shell_creation(self):
+    def test_shell_creation(self, mysh_path):
         """Test creating a new shell process."""
         manager = shell_manager
         session_id = 'test_session_123'
         
         # Create shell
-        shell_info = manager.create_shell(session_id)
+        with patch.object(manager, 'shell_path', mysh_path), patch.object(manager, 'available', True):
+            shell_info = manager.create_shell(session_id)
         assert session_id in manager.shells
         assert manager.shells[session_id]['process'] is not None
         assert manager.shells[session_id]['cwd'] == os.getcwd()
@@ -76,18 +131,351 @@ class TestShellManager:
         manager.cleanup_shell(session_id)
         assert session_id not in manager.shells
     
-    def test_shell_cleanup(self):
+    def test_shell_cleanup(self, mysh_path):
         """Test shell cleanup functionality."""
         manager = shell_manager
         session_id = 'test_cleanup_session'
         
         # Create and then cleanup shell
-        manager.create_shell(session_id)
+        with patch.object(manager, 'shell_path', mysh_path), patch.object(manager, 'available', True):
+            manager.create_shell(session_id)
         assert session_id in manager.shells
         
         manager.cleanup_shell(session_id)
         assert session_id not in manager.shells
 
+class TestPersistentShell:
+    """Test running commands in the session's long-lived mysh."""
+    
+    def test_shell_state_persists_between_commands(self, mysh_path):
+        """Test variables and aliases survive across commands."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path)
+        manager.create_shell('persist')
+        try:
+            assert manager.execute('persist', 'export GREETING=hello', CollectingStream()) == 0
+            assert manager.execute('persist', 'alias say=echo', CollectingStream()) == 0
+            
+            stream = CollectingStream()
+            assert manager.execute('persist', 'say $GREETING', stream) == 0
+            assert stream.output == 'hello\n'
+        finally:
+            manager.cleanup_shell('persist')
+    
+    def test_exit_code_and_cwd_are_reported(self, mysh_path, tmp_path):
+        """Test the sentinel line carries exit status and directory."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path)
+        manager.create_shell('status')
+        try:
+            assert manager.execute('status', 'false', CollectingStream()) == 1
+            assert manager.execute('status', f'cd {tmp_path}', CollectingStream()) == 0
+            assert manager.get_cwd('status') == str(tmp_path)
+        finally:
+            manager.cleanup_shell('status')
+    
+    def test_shell_creation_has_its_own_stage(self, mysh_path):
+        """Test starting a session shell isn't counted as a command spawn."""
+        from server import ShellManager, command_stages
+        spawn, shell_start = command_stages.labels(stage='spawn'), command_stages.labels(stage='shell_start')
+        spawns, starts = spawn._sum.get(), shell_start._sum.get()
+        manager = ShellManager(shell_path=mysh_path, pool_min=0, pool_max=0)
+        manager.create_shell('staged')
+        manager.cleanup_shell('staged')
+        assert spawn._sum.get() == spawns
+        assert shell_start._sum.get() > starts
+    
+    def test_commands_do_not_read_the_command_pipe(self, mysh_path):
+        """Test a program reading stdin sees end of input instead of the next commands."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path)
+        manager.create_shell('stdin')
+        try:
+            stream = CollectingStream()
+            assert manager.execute('stdin', 'wc -l', stream, timeout=3) == 0
+            assert stream.output.strip() == '0'
+            stream = CollectingStream()
+            assert manager.execute('stdin', 'echo still-here', stream, timeout=3) == 0
+            assert stream.output == 'still-here\n'
+        finally:
+            manager.cleanup_shell('stdin')
+    
+    def test_each_command_gets_its_own_output(self, mysh_path):
+        """Test lines mysh can't take as one command aren't sent, and stray output is dropped."""
+        from server import ShellManager, SHELL_MAX_LINE
+        manager = ShellManager(shell_path=mysh_path)
+        manager.create_shell('framed')
+        try:
+            assert manager.execute('framed', 'echo one\nid', CollectingStream()) is None
+            assert manager.execute('framed', 'echo ' + 'x' * SHELL_MAX_LINE, CollectingStream()) is None
+            # A line sent behind the manager's back: its output isn't the next command's
+            shell_info = manager.shells['framed']
+            shell_info['process'].stdin.write(b'echo stray\n')
+            shell_info['lines'] += 1
+            stream = CollectingStream()
+            assert manager.execute('framed', 'echo two', stream, timeout=3) == 0
+            assert stream.output == 'two\n'
+        finally:
+            manager.cleanup_shell('framed')
+    
+    def test_exit_ends_the_shell(self, mysh_path):
+        """Test a shell that exits is dropped so a new one can be made."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path)
+        manager.create_shell('exiting')
+        
+        stream = CollectingStream()
+        assert manager.execute('exiting', 'exit 3', stream) == 3
+        assert 'Goodbye!' in stream.output
+        assert 'exiting' not in manager.shells
+        assert manager.execute('exiting', 'echo hi', CollectingStream()) is None
+    
+    def test_session_variables_are_exported_to_the_shell(self, mysh_path):
+        """Test variables set outside mysh reach it before the next command."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path)
+        manager.create_shell('env')
+        try:
+            stream = CollectingStream()
+            assert manager.execute('env', 'printenv GREETING', stream, env={'GREETING': 'hi'}) == 0
+            assert stream.output == 'hi\n'
+            assert manager.shells['env']['env']['GREETING'] == 'hi'
+            assert manager.execute('env', 'true', CollectingStream(), env={'GREETING': 'two words'}) is None
+        finally:
+            manager.cleanup_shell('env')
+    
+    def test_shell_syntax_routing(self):
+        """Test which commands need /bin/sh instead of mysh."""
+        from server import needs_system_shell
+        assert not needs_system_shell('ls -la')
+        assert not needs_system_shell('sleep 10 &')
+        assert needs_system_shell('ls | wc -l')
+        assert needs_system_shell('echo hi > out.txt')
+        assert needs_system_shell('make && make test')
+        assert needs_system_shell('echo "quoted words"')
+        assert needs_system_shell('echo one\nid')
+
+class TestShellPool:
+    """Test the warm pool of pre-spawned shells."""
+    
+    @staticmethod
+    def wait_for(condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+    
+    def test_pool_fills_and_refills(self, mysh_path):
+        """Test the pool keeps min_size shells ready."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path, pool_min=2, pool_max=4)
+        pool = manager.pool
+        pool.start()
+        try:
+            assert self.wait_for(lambda: len(pool.idle) == 2)
+            assert manager.assign_shell('pooled')
+            assert manager.is_alive('pooled')
+            assert self.wait_for(lambda: len(pool.idle) == 2)
+        finally:
+            manager.cleanup_shell('pooled')
+            pool.stop()
+    
+    def test_empty_pool_grows_target(self, mysh_path):
+        """Test a miss makes the pool keep more shells ready."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path, pool_min=1, pool_max=4)
+        pool = manager.pool
+        pool.stopped = True  # Keep the refill task out of the way
+        pool.started = True
+        
+        assert pool.acquire() is None
+        assert pool.target == 2
+        assert manager.create_shell('fallback') is not None
+        manager.cleanup_shell('fallback')
+    
+    def test_idle_shells_are_replaced(self, mysh_path):
+        """Test shells idle past max_idle are killed and replaced."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path, pool_min=1, pool_max=1)
+        pool = manager.pool
+        pool.max_idle = 0.2
+        pool.start()
+        try:
+            assert self.wait_for(lambda: len(pool.idle) == 1)
+            first = pool.idle[0]['process']
+            assert self.wait_for(lambda: pool.idle and pool.idle[0]['process'] is not first)
+            assert first.poll() is not None
+        finally:
+            pool.stop()
+    
+    def test_transient_spawn_failures_are_retried(self):
+        """Test refill backs off and retries after a failure that isn't permanent."""
+        from server import ShellManager
+        manager = ShellManager(shell_path='/bin/true', pool_min=1, pool_max=1)
+        calls = []
+        
+        def popen(*args, **kwargs):
+            calls.append(time.time())
+            if len(calls) == 1:
+                raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+            return MagicMock(**{'poll.return_value': None})
+        
+        with patch('server.subprocess.Popen', side_effect=popen), patch('server.SHELL_POOL_RETRY_MIN', 0.05), \
+                patch.object(ShellManager, '_handshake', return_value=True):
+            manager.pool.start()
+            try:
+                assert self.wait_for(lambda: len(manager.pool.idle) == 1)
+            finally:
+                manager.pool.stop()
+        assert manager.available is True
+        assert len(calls) == 2
+    
+    def test_missing_binary_disables_spawning(self, tmp_path):
+        """Test a shell binary that doesn't exist stops further attempts."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=str(tmp_path / 'missing'), pool_min=0, pool_max=0)
+        assert manager.spawn_shell() is None
+        assert manager.available is False
+    
+    def test_shell_without_the_sentinel_disables_spawning(self, tmp_path):
+        """Test a binary that doesn't end output with the expected status line isn't used."""
+        from server import ShellManager
+        stale = tmp_path / 'old-mysh'
+        stale.write_text('#!/bin/sh\nread line\necho "$MYSH_SENTINEL 0 $PWD"\nsleep 60\n')  # No line number
+        stale.chmod(0o755)
+        for path in ['/bin/true', str(stale)]:
+            manager = ShellManager(shell_path=path, pool_min=0, pool_max=0)
+            assert manager.spawn_shell() is None, path
+            assert manager.available is False
+
+    def test_shell_retired_after_max_commands(self, mysh_path):
+        """Test a session shell is recycled after max_commands."""
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path, pool_min=0, pool_max=0, max_commands=2)
+        manager.create_shell('recycled')
+        assert manager.execute('recycled', 'true', CollectingStream()) == 0
+        assert manager.execute('recycled', 'true', CollectingStream()) == 0
+        assert 'recycled' not in manager.shells
+
+class TestSessionReaper:
+    """Test eviction of idle, orphaned and excess sessions."""
+    
+    def test_cleanup_kills_background_jobs(self, mysh_path):
+        """Test cleaning up a shell takes down its whole process group."""
+        import psutil
+        from server import ShellManager
+        manager = ShellManager(shell_path=mysh_path, pool_min=0, pool_max=0)
+        manager.create_shell('jobs')
+        manager.execute('jobs', 'sleep 30 &', CollectingStream())
+        shell = psutil.Process(manager.shells['jobs']['process'].pid)
+        children = shell.children()
+        assert children
+        
+        manager.cleanup_shell('jobs')
+        gone, alive = psutil.wait_procs(children, timeout=5)
+        assert not alive
+    
+    def test_idle_sessions_are_reaped(self):
+        """Test sessions idle past the timeout are evicted."""
+        from datetime import datetime, timedelta
+        from server import SessionReaper, user_sessions, session_states, get_session_state
+        now = datetime.utcnow()
+        user_sessions['stale'] = {'connected_at': now, 'command_count': 0,
+                                  'last_activity': now - timedelta(hours=1)}
+        user_sessions['fresh'] = {'connected_at': now, 'command_count': 0,
+                                  'last_activity': now}
+        get_session_state('stale')
+        try:
+            assert SessionReaper(idle_timeout=60).reap() == 1
+            assert 'stale' not in user_sessions
+            assert 'stale' not in session_states
+            assert 'fresh' in user_sessions
+        finally:
+            user_sessions.pop('stale', None)
+            user_sessions.pop('fresh', None)
+    
+    def test_orphaned_shell_reaped_on_second_pass(self, mysh_path):
+        """Test a shell with no session is killed once it stays orphaned."""
+        from server import ShellManager, SessionReaper
+        manager = ShellManager(shell_path=mysh_path, pool_min=0, pool_max=0)
+        manager.create_shell('orphan')
+        process = manager.shells['orphan']['process']
+        reaper = SessionReaper(idle_timeout=0)
+        with patch('server.shell_manager', manager):
+            assert reaper.reap() == 0
+            assert reaper.reap() == 1
+        assert 'orphan' not in manager.shells
+        assert process.wait(timeout=5) is not None
+    
+    def test_least_recently_active_session_is_evicted(self):
+        """Test connecting past the session cap evicts the oldest session."""
+        from server import socketio, user_sessions
+        with patch('server.MAX_SESSIONS', 1):
+            first = socketio.test_client(app)
+            second = socketio.test_client(app)
+            try:
+                assert not first.is_connected()
+                assert second.is_connected()
+                assert len(user_sessions) == 1
+            finally:
+                second.disconnect()
+
+class TestSessionState:
+    """Test per-session working directory and environment."""
+    
+    def test_chdir_is_per_session(self, tmp_path):
+        """Test cd changes only the session, not the server process."""
+        from server import SessionState
+        server_cwd = os.getcwd()
+        state = SessionState(cwd=str(tmp_path))
+        (tmp_path / 'sub').mkdir()
+        
+        state.chdir('sub')
+        assert state.cwd == str(tmp_path / 'sub')
+        state.chdir('..')
+        assert state.cwd == str(tmp_path)
+        state.chdir('-')
+        assert state.cwd == str(tmp_path / 'sub')
+        assert os.getcwd() == server_cwd
+    
+    def test_chdir_errors(self, tmp_path):
+        """Test invalid targets raise and leave the cwd alone."""
+        from server import SessionState
+        state = SessionState(cwd=str(tmp_path))
+        (tmp_path / 'file.txt').write_text('x')
+        
+        with pytest.raises(FileNotFoundError):
+            state.chdir('missing')
+        with pytest.raises(NotADirectoryError):
+            state.chdir('file.txt')
+        assert state.cwd == str(tmp_path)
+    
+    def test_environment_is_cached_until_changed(self):
+        """Test the merged environment is built once per change."""
+        from server import SessionState
+        state = SessionState()
+        env = state.environ()
+        assert env['COLUMNS'] == '120'
+        assert state.environ() is env
+        
+        state.setenv('EDITOR', 'nano')
+        assert state.environ() is not env
+        assert state.environ()['EDITOR'] == 'nano'
+    
+    def test_sessions_do_not_share_cwd(self, tmp_path):
+        """Test cd in one connection doesn't move another."""
+        from server import socketio
+        first = socketio.test_client(app)
+        second = socketio.test_client(app)
+        
+        first.get_received()
+        second.get_received()
+        assert run_command(first, f'cd {tmp_path}')[-1]['args'][0]['prompt'] == f'{tmp_path} $ '
+        assert run_command(second, 'pwd')[-1]['args'][0]['prompt'] == f'{os.getcwd()} $ '
+        
+        first.disconnect()
+        second.disconnect()
+
 class TestCommandExecution:
     """Test command execution functionality."""
     
@@ -119,6 +507,811 @@ class TestCommandExecution:
             # This test ensures we have the list of dangerous commands
             assert any(danger in cmd for danger in ['rm -rf /', 'mkfs', 'dd if=', ':(){:|:&};:'])
 
+class TestRedisManager:
+    """Test the pooled Redis client and its circuit breaker."""
+    
+    @staticmethod
+    def make_manager():
+        from server import RedisManager
+        manager = RedisManager(url='redis://127.0.0.1:1', failure_threshold=2)
+        manager.started = True  # Keep the health check task out of the way
+        manager.client = MagicMock()
+        return manager
+    
+    def test_unusable_until_first_successful_ping(self):
+        """Test get() returns None until a health check passes."""
+        manager = self.make_manager()
+        assert manager.get() is None
+        assert manager.check()
+        assert manager.get() is manager.client
+    
+    def test_repeated_failures_open_the_circuit(self):
+        """Test the circuit opens after the threshold and a ping closes it."""
+        import redis
+        manager = self.make_manager()
+        manager.check()
+        manager.report_failure(redis.ConnectionError('down'))
+        assert manager.get() is not None
+        manager.report_failure(redis.ConnectionError('down'))
+        assert manager.get() is None
+        
+        manager.client.ping.side_effect = redis.ConnectionError('still down')
+        assert not manager.check()
+        manager.client.ping.side_effect = None
+        assert manager.check()
+        assert manager.get() is manager.client
+    
+    def test_start_does_not_touch_the_network(self):
+        """Test creating the pool doesn't connect."""
+        from server import RedisManager
+        manager = RedisManager(url='redis://10.255.255.1:6379', connect_timeout=5)
+        started = time.time()
+        with patch('server.socketio.start_background_task') as start_task:
+            assert manager.get() is None
+        assert time.time() - started < 1
+        start_task.assert_called_once()
+        assert manager.client.connection_pool.max_connections == manager.max_connections
+
+class TestSessionReattach:
+    """Test resuming a session after the connection drops."""
+    
+    @staticmethod
+    def session_info(client):
+        for event in client.get_received():
+            if event['name'] == 'session_info':
+                return event['args'][0]
+        raise AssertionError('no session_info event')
+    
+    def test_scrollback_keeps_the_latest_bytes(self):
+        """Test the scrollback is bounded and read by absolute offset."""
+        from server import Scrollback
+        scrollback = Scrollback(max_bytes=8)
+        assert scrollback.append('hello ') == 6
+        assert scrollback.append('world\n') == 12
+        assert scrollback.read(0) == (4, 'o world\n')
+        assert scrollback.read(10) == (10, 'd\n')
+        scrollback.clear()
+        assert scrollback.read(0) == (12, '')
+        assert scrollback.append('$ ') == 14
+    
+    def test_reattach_resumes_session_and_replays_output(self, tmp_path):
+        """Test a client with the session token gets its session back."""
+        from server import socketio, get_session_state, shell_manager
+        first = socketio.test_client(app)
+        info = self.session_info(first)
+        run_command(first, f'cd {tmp_path}')
+        first.disconnect()
+        
+        second = socketio.test_client(app, auth={'token': info['token'], 'offset': 0})
+        try:
+            resumed = [e for e in second.get_received() if e['name'] == 'session_resumed']
+            assert resumed
+            assert resumed[0]['args'][0]['session_id'] == info['session_id']
+            assert f'cd {tmp_path}\n' in resumed[0]['args'][0]['data']
+            
+            run_command(second, 'cd ..')
+            assert get_session_state(info['session_id']).cwd == os.path.dirname(str(tmp_path))
+        finally:
+            second.disconnect()
+            shell_manager.cleanup_shell(info['session_id'])
+    
+    def test_invalid_token_starts_a_new_session(self):
+        """Test a bad token falls back to a fresh session."""
+        from server import socketio
+        client = socketio.test_client(app, auth={'token': 'invalid.token.here'})
+        try:
+            names = [e['name'] for e in client.get_received()]
+            assert 'initial_prompt' in names
+            assert 'session_resumed' not in names
+        finally:
+            client.disconnect()
+    
+    def test_detached_session_expires_after_grace(self):
+        """Test a session nobody reattaches to is ended after the grace period."""
+        from server import socketio, user_sessions
+        with patch('server.SESSION_REATTACH_GRACE', 0.1):
+            client = socketio.test_client(app)
+            session_id = self.session_info(client)['session_id']
+            client.disconnect()
+            assert session_id in user_sessions
+            assert TestShellPool.wait_for(lambda: session_id not in user_sessions)
+
+class TestSessionRegistry:
+    """Test the cross-worker session registry."""
+    
+    def test_without_redis_counts_local_sessions(self):
+        """Test the registry falls back to this worker's sessions."""
+        from server import socketio, session_registry
+        with patch('server.get_redis', return_value=None):
+            client = socketio.test_client(app)
+            try:
+                sessions = session_registry.sessions()
+                assert session_registry.count() == len(sessions) >= 1
+            finally:
+                client.disconnect()
+    
+    def test_register_is_one_script_call(self):
+        """Test registering updates the registry and count atomically."""
+        from datetime import datetime
+        from server import SessionRegistry
+        redis = MagicMock()
+        register = MagicMock(return_value=3)
+        redis.register_script.side_effect = [register, MagicMock()]
+        registry = SessionRegistry(worker_id='w1')
+        now = datetime.utcnow()
+        with patch('server.get_redis', return_value=redis):
+            count = registry.register('abc', {'connected_at': now, 'last_activity': now, 'command_count': 0})
+        assert count == 3
+        keys, args = register.call_args.kwargs['keys'], register.call_args.kwargs['args']
+        assert keys == ['cbash:sessions', 'cbash:active_sessions']
+        assert args[0] == 'abc'
+        assert json.loads(args[1])['worker'] == 'w1'
+        # Other workers see this one alive before its first sync()
+        redis.set.assert_called_once_with('cbash:worker:w1', ANY, ex=registry.heartbeat_ttl)
+        with patch('server.get_redis', return_value=redis):
+            registry.register('def', {'connected_at': now, 'last_activity': now, 'command_count': 0})
+        assert redis.set.call_count == 1
+    
+    def test_sync_drops_sessions_of_dead_workers(self):
+        """Test sessions owned by a worker without a heartbeat are removed."""
+        from server import SessionRegistry
+        redis = MagicMock()
+        register, unregister = MagicMock(), MagicMock()
+        redis.register_script.side_effect = [register, unregister]
+        redis.pipeline.return_value.execute.return_value = [True, {
+            'live': json.dumps({'worker': 'w2'}),
+            'stale': json.dumps({'worker': 'w3'})
+        }]
+        redis.mget.return_value = ['1700000000', None]
+        redis.get.return_value = '1'
+        registry = SessionRegistry(worker_id='w1')
+        with patch('server.get_redis', return_value=redis), patch('server.user_sessions', {}):
+            registry.sync()
+        redis.mget.assert_called_once_with(['cbash:worker:w2', 'cbash:worker:w3'])
+        assert [call.kwargs['args'] for call in unregister.call_args_list] == [['stale']]
+    
+    def test_sync_drops_entries_left_by_an_earlier_process(self):
+        """Test this worker's entries for sessions it doesn't have are removed."""
+        from server import SessionRegistry
+        redis = MagicMock()
+        register, unregister = MagicMock(), MagicMock()
+        redis.register_script.side_effect = [register, unregister]
+        redis.pipeline.return_value.execute.return_value = [True, True, {
+            'mine': json.dumps({'worker': 'w1'}),
+            'left-over': json.dumps({'worker': 'w1'})
+        }]
+        redis.get.return_value = '1'
+        registry = SessionRegistry(worker_id='w1')
+        sessions = {'mine': {'connected_at': datetime.utcnow(), 'last_activity': datetime.utcnow(), 'command_count': 0}}
+        with patch('server.get_redis', return_value=redis), patch('server.user_sessions', sessions):
+            registry.sync()
+        redis.mget.assert_not_called()
+        assert [call.kwargs['args'] for call in unregister.call_args_list] == [['left-over']]
+
+class TestAuditLog:
+    """Test buffered, batched audit logging."""
+    
+    def test_record_does_not_touch_redis(self):
+        """Test recording only buffers; Redis is written by flush."""
+        from server import AuditLog
+        redis = MagicMock()
+        log = AuditLog(batch_size=10)
+        log.started = True  # Keep the flush task out of the way
+        with patch('server.get_redis', return_value=redis):
+            for n in range(3):
+                log.record({'command': f'echo {n}', 'session_id': 's1', 'client_ip': '10.0.0.1',
+                            'timestamp': '2024-01-15T10:30:00'})
+            assert not redis.method_calls
+            assert log.flush() == 3
+        pipe = redis.pipeline.return_value
+        streams = [c.args[0] for c in pipe.xadd.call_args_list]
+        assert streams == ['cbash:history', 'cbash:history:session:s1', 'cbash:history:ip:10.0.0.1'] * 3
+        added = [json.loads(c.args[1]['entry'])['command'] for c in pipe.xadd.call_args_list[::3]]
+        assert added == ['echo 0', 'echo 1', 'echo 2']
+        indexes = {c.args[0] for c in pipe.zadd.call_args_list}
+        assert 'cbash:history:prefix' in indexes and 'cbash:history:session:s1:prefix' in indexes
+        pipe.execute.assert_called_once()
+    
+    def test_without_redis_entries_stay_local(self):
+        """Test entries land in command_history when Redis is unavailable."""
+        from server import AuditLog, command_history
+        log = AuditLog()
+        with patch('server.get_redis', return_value=None):
+            log.record({'command': 'local only'})
+        assert command_history[-1]['command'] == 'local only'
+        assert not log.pending
+    
+    def test_failed_flush_keeps_entries_and_counts_drops(self):
+        """Test a failed write is retried and a full buffer drops the oldest."""
+        from server import AuditLog
+        redis = MagicMock()
+        redis.pipeline.return_value.execute.side_effect = ConnectionError('down')
+        log = AuditLog(capacity=2, batch_size=10)
+        log.started = True
+        with patch('server.get_redis', return_value=redis):
+            log.record({'command': 'a'})
+            log.record({'command': 'b'})
+            assert log.flush() == 0
+            assert len(log.pending) == 2
+            log.record({'command': 'c'})
+        assert log.dropped == 1
+        assert [json.loads(entry)['command'] for entry in log.pending] == ['b', 'c']
+
+    def test_local_history_pages_and_filters(self):
+        """Test cursor pagination and filters over the in-memory history."""
+        from server import AuditLog
+        log = AuditLog()
+        with patch('server.get_redis', return_value=None), patch('server.command_history', deque(maxlen=1000)):
+            for n in range(5):
+                log.record({'command': f'git commit {n}' if n % 2 else f'ls {n}', 'session_id': 'a' if n < 3 else 'b',
+                            'timestamp': f'2024-01-15T10:30:0{n}'})
+            page, cursor = log.query(limit=2)
+            assert [e['command'] for e in page] == ['ls 4', 'git commit 3']
+            page, cursor = log.query(limit=2, cursor=cursor)
+            assert [e['command'] for e in page] == ['ls 2', 'git commit 1']
+            page, cursor = log.query(limit=2, cursor=cursor)
+            assert [e['command'] for e in page] == ['ls 0'] and cursor is None
+            
+            assert [e['command'] for e in log.query(prefix='git')[0]] == ['git commit 3', 'git commit 1']
+            assert [e['command'] for e in log.query(session_id='a', prefix='ls')[0]] == ['ls 2', 'ls 0']
+            since = (datetime(2024, 1, 15, 10, 30, 3) - datetime(1970, 1, 1)).total_seconds()
+            assert [e['command'] for e in log.query(since=since)[0]] == ['ls 4', 'git commit 3']
+    
+    def test_prefix_search_reads_the_index(self):
+        """Test prefix queries use a lexicographic range on the prefix index."""
+        from server import AuditLog
+        entry = json.dumps({'command': 'git log', 'session_id': 's1', 'timestamp': '2024-01-15T10:30:00'})
+        redis = MagicMock()
+        redis.zrangebylex.side_effect = [[AuditLog.index_member(json.loads(entry), entry)], []]
+        with patch('server.get_redis', return_value=redis):
+            entries, cursor = AuditLog().query(session_id='s1', prefix='git', limit=5)
+        assert [e['command'] for e in entries] == ['git log']
+        assert cursor is None
+        key, low, high = redis.zrangebylex.call_args_list[0].args
+        assert key == 'cbash:history:session:s1:prefix'
+        assert (low, high) == (b'[git', b'[git\xff')
+        assert not redis.xrevrange.called
+
+class TestCommandScheduler:
+    """Test queueing and admission control for commands."""
+    
+    def test_session_commands_run_in_order(self):
+        """Test one session's commands run one at a time, in order."""
+        from server import CommandScheduler
+        import threading
+        scheduler = CommandScheduler(workers=4, max_queued=10)
+        ran = []
+        done = threading.Event()
+        
+        def task(n):
+            ran.append(n)
+            time.sleep(0.01)
+            if n == 4:
+                done.set()
+        
+        for n in range(5):
+            assert scheduler.submit('ordered', lambda n=n: task(n))
+        assert done.wait(5)
+        assert ran == [0, 1, 2, 3, 4]
+    
+    def test_full_queue_is_rejected(self):
+        """Test submissions beyond the per-session depth are refused."""
+        from server import CommandScheduler
+        import threading
+        scheduler = CommandScheduler(workers=1, max_queued=2)
+        release = threading.Event()
+        
+        assert scheduler.submit('busy', release.wait)
+        time.sleep(0.05)  # Let the worker pick up the first task
+        assert scheduler.submit('busy', lambda: None)
+        assert scheduler.submit('busy', lambda: None)
+        assert not scheduler.submit('busy', lambda: None)
+        assert scheduler.queue_depth('busy') == 2
+        release.set()
+    
+    def test_sessions_are_served_round_robin(self):
+        """Test a session with a long queue doesn't starve another."""
+        from server import CommandScheduler
+        import threading
+        scheduler = CommandScheduler(workers=1, max_queued=10)
+        release = threading.Event()
+        ran = []
+        
+        scheduler.submit('hog', release.wait)
+        time.sleep(0.05)
+        for n in range(3):
+            scheduler.submit('hog', lambda n=n: ran.append(('hog', n)))
+        scheduler.submit('polite', lambda: ran.append(('polite', 0)))
+        release.set()
+        
+        deadline = time.time() + 5
+        while len(ran) < 4 and time.time() < deadline:
+            time.sleep(0.01)
+        assert ran == [('polite', 0), ('hog', 0), ('hog', 1), ('hog', 2)]
+
+class TestOutputStreaming:
+    """Test incremental command output streaming."""
+    
+    def test_malformed_acks_are_ignored(self):
+        """Test output_ack only accepts a non-negative byte count."""
+        from server import socketio, OutputStream, active_streams
+        client = socketio.test_client(app)
+        session_id = [e for e in client.get_received() if e['name'] == 'session_info'][0]['args'][0]['session_id']
+        stream = OutputStream(session_id)
+        active_streams[session_id] = stream
+        try:
+            for ack in ['nope', {'bytes': 'many'}, {'bytes': None}, {'bytes': -5}, {'bytes': [1]}, {}]:
+                client.emit('output_ack', ack)
+            assert stream.acked_bytes == 0
+            client.emit('output_ack', {'bytes': 42})
+            assert stream.acked_bytes == 42
+        finally:
+            active_streams.pop(session_id, None)
+            client.disconnect()
+    
+    def test_command_output_is_streamed(self):
+        """Test output arrives as chunks followed by a command_done event."""
+        from server import socketio
+        client = socketio.test_client(app)
+        client.get_received()
+        
+        received = run_command(client, "printf 'streamed\\n'")
+        names = [event['name'] for event in received]
+        assert 'output_chunk' in names
+        assert names[-1] == 'command_done'
+        
+        chunks = ''.join(e['args'][0]['data'] for e in received if e['name'] == 'output_chunk')
+        assert chunks == 'streamed\n'
+        done = received[-1]['args'][0]
+        assert done['exit_code'] == 0
+        assert done['bytes'] == len('streamed\n')
+        assert done['time_to_first_byte'] is not None
+        client.disconnect()
+    
+    @patch('server.socketio.emit')
+    def test_stream_waits_for_ack(self, mock_emit):
+        """Test the writer blocks once the unacknowledged window is full."""
+        from server import OutputStream
+        import threading
+        import time
+        
+        stream = OutputStream('test_session', window=4, ack_timeout=5, coalesce_delay=0)
+        stream.write('abcd')
+        threading.Timer(0.1, stream.ack, args=(4,)).start()
+        
+        started = time.time()
+        stream.write('efgh')
+        assert 0.05 < time.time() - started < 5
+        assert stream.window == 4
+        assert mock_emit.call_count == 2
+    
+    @patch('server.socketio.emit')
+    def test_stream_without_acks_stops_throttling(self, mock_emit):
+        """Test a client that never acks doesn't hang the command."""
+        from server import OutputStream
+        
+        stream = OutputStream('test_session', window=1, ack_timeout=0.05, coalesce_delay=0)
+        for _ in range(3):
+            stream.write('x')
+        assert stream.window is None
+        assert stream.sent_bytes == 3
+    
+    @patch('server.socketio.emit')
+    def test_small_writes_are_coalesced(self, mock_emit):
+        """Test writes are batched until the frame fills or is flushed."""
+        from server import OutputStream
+        stream = OutputStream('test_session', frame_bytes=8, coalesce_delay=10)
+        for piece in ('ab', 'cd', 'ef'):
+            stream.write(piece)
+        assert mock_emit.call_count == 0
+        stream.write('gh')
+        assert mock_emit.call_count == 1
+        stream.write('ij')
+        stream.flush()
+        frames = [c.args[1] for c in mock_emit.call_args_list]
+        assert [f['data'] for f in frames] == ['abcdefgh', 'ij']
+        assert [f['bytes'] for f in frames] == [8, 10]
+    
+    @patch('server.socketio.emit')
+    def test_binary_frames_are_deflated(self, mock_emit):
+        """Test binary clients get raw bytes, deflated when large."""
+        import zlib
+        from server import OutputStream
+        text = 'line of noisy output\n' * 500
+        with patch.dict('server.user_sessions', {'bin': {'framing': {'binary': True, 'deflate': True}}}):
+            stream = OutputStream('bin', coalesce_delay=10)
+            stream.write('ok\n')
+            stream.flush()
+            stream.write(text)
+            stream.flush()
+        (small_event, small), _ = mock_emit.call_args_list[0]
+        (large_event, large), _ = mock_emit.call_args_list[1]
+        assert small_event == large_event == 'output_frame'
+        assert small['data'] == b'ok\n' and not small['deflated']
+        assert large['deflated'] and len(large['data']) < len(text)
+        assert zlib.decompress(large['data']).decode() == text
+        assert large['bytes'] == 3 + len(text)
+    
+    @patch('server.socketio.emit')
+    def test_quiet_command_flushes_pending_output(self, mock_emit):
+        """Test output is sent when the command pauses, not held to the end."""
+        from server import OutputStream, stream_subprocess
+        stream = OutputStream('test_session', coalesce_delay=0.05)
+        stream_subprocess('echo a; sleep 0.3; echo b', stream, shell=True)
+        stream.flush()
+        assert [c.args[1]['data'] for c in mock_emit.call_args_list] == ['a\n', 'b\n']
+    
+    def test_binary_client_receives_frames(self):
+        """Test a client that asks for binary framing gets output_frame events."""
+        from server import socketio
+        client = socketio.test_client(app, auth={'binary': True})
+        client.get_received()
+        try:
+            received = run_command(client, "printf 'framed\\n'")
+            frames = [e['args'][0] for e in received if e['name'] == 'output_frame']
+            assert b''.join(f['data'] for f in frames) == b'framed\n'
+            assert 'command' not in received[-1]['args'][0]
+        finally:
+            client.disconnect()
+    
+    def test_stream_timeout_kills_command(self):
+        """Test long-running commands are killed at the timeout."""
+        from server import OutputStream, stream_subprocess
+        import subprocess
+        
+        stream = OutputStream('test_session')
+        with pytest.raises(subprocess.TimeoutExpired):
+            stream_subprocess(['sleep', '5'], stream, timeout=0.2)
+
+class TestOutputBudget:
+    """Test output limits, truncation and spilled full output."""
+    
+    @staticmethod
+    def sent(mock_emit):
+        return ''.join(c.args[1]['data'] for c in mock_emit.call_args_list)
+    
+    @patch('server.socketio.emit')
+    def test_output_over_byte_budget_is_truncated(self, mock_emit):
+        """Test output past the byte budget is dropped and reported."""
+        from server import OutputStream
+        stream = OutputStream('test_session', coalesce_delay=0, max_bytes=10, spill=False)
+        stream.write('x' * 25)
+        stream.write('more\n')
+        assert stream.finish() is None
+        assert stream.truncated
+        assert self.sent(mock_emit) == 'x' * 10 + '\n[output truncated: 20 bytes omitted]\n'
+    
+    @patch('server.socketio.emit')
+    def test_output_over_line_budget_is_truncated(self, mock_emit):
+        """Test output stops at the line budget."""
+        from server import OutputStream
+        stream = OutputStream('test_session', coalesce_delay=0, max_lines=2, spill=False)
+        stream.write('a\nb\nc\nd\n')
+        stream.finish()
+        assert self.sent(mock_emit) == 'a\nb\n[output truncated: 4 bytes omitted]\n'
+    
+    @patch('server.socketio.emit')
+    def test_line_endings_are_normalized_across_writes(self, mock_emit):
+        """Test CRLF split between writes becomes LF; lone CR is kept."""
+        from server import OutputStream
+        stream = OutputStream('test_session', coalesce_delay=0, spill=False)
+        stream.write('a\r')
+        stream.write('\nb\r\n50%\r')
+        stream.write('60%\n')
+        stream.finish()
+        assert self.sent(mock_emit) == 'a\nb\n50%\r60%\n'
+    
+    @patch('server.socketio.emit')
+    def test_spill_file_is_only_made_once_over_budget(self, mock_emit):
+        """Test output within budget stays in memory and the spill file gets all of it once needed."""
+        from server import OutputStream, spilled_outputs
+        with patch('server.tempfile.SpooledTemporaryFile', wraps=tempfile.SpooledTemporaryFile) as spool:
+            stream = OutputStream('spill_session', coalesce_delay=0, max_bytes=20)
+            stream.write('first\n')
+            assert stream.finish() is None
+            assert not spool.called
+            
+            stream = OutputStream('spill_session', coalesce_delay=0, max_bytes=20)
+            stream.write('first\n')
+            stream.write('second\n')
+            assert not spool.called
+            stream.write('third line\n')
+            output_id = stream.finish()
+        assert spool.call_count == 1
+        spilled = spilled_outputs.pop(output_id)['file']
+        spilled.seek(0)
+        assert spilled.read() == b'first\nsecond\nthird line\n'
+    
+    @patch('server.socketio.emit')
+    def test_spilled_output_is_paged_over_http(self, mock_emit, client):
+        """Test the full output of a truncated command can be fetched."""
+        from server import OutputStream, generate_session_token, RateLimiter
+        text = ''.join(f'line {n} é\n' for n in range(100))
+        stream = OutputStream('spill_session', coalesce_delay=0, max_bytes=100)
+        stream.write(text)
+        output_id = stream.finish()
+        assert output_id
+        assert f'/api/output/{output_id}' in self.sent(mock_emit)
+        
+        token = generate_session_token('spill_session')
+        with patch('server.get_redis', return_value=None), patch('server.rate_limiter', RateLimiter()):
+            assert client.get(f'/api/output/{output_id}').status_code == 404
+            pages, offset = [], 0
+            while True:
+                page = client.get(f'/api/output/{output_id}?offset={offset}&limit=251',
+                                  headers={'X-Session-Token': token}).get_json()
+                pages.append(page['data'])
+                offset = page['next_offset']
+                if page['eof']:
+                    break
+        assert ''.join(pages) == text
+        assert len(pages) > 1
+
+class TestPtySession:
+    """Test PTY-mode sessions."""
+    
+    @staticmethod
+    def wait_for_output(chunks, text, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if text in ''.join(chunks):
+                return True
+            time.sleep(0.02)
+        return False
+    
+    def test_keystrokes_and_resize_reach_the_terminal(self, mysh_path):
+        """Test raw input runs in the shell and resizes are seen by programs."""
+        from server import PtySession
+        chunks = []
+        with patch('server.socketio.emit', side_effect=lambda name, frame, to=None: chunks.append(frame['data'])):
+            session = PtySession('pty_test', cols=91, rows=17, shell_path=mysh_path)
+            assert session.start()
+            session.relay()
+            try:
+                session.write('stty size\r')
+                assert self.wait_for_output(chunks, '17 91')
+                session.resize(100, 40)
+                session.write('stty size\r')
+                assert self.wait_for_output(chunks, '40 100')
+            finally:
+                session.close()
+        assert session.process.poll() is not None
+    
+    def test_typed_lines_are_tracked(self):
+        """Test completed input lines are picked out of keystrokes for auditing."""
+        from server import PtySession
+        session = PtySession('pty_test')
+        assert session._track_lines('ls -x') == []
+        assert session._track_lines('\x7fl\r') == ['ls -l']
+        assert session._track_lines('\x1b[A') == []
+        assert session._track_lines('\x1b[Bpwd\x1bOA\r') == ['pwd']
+        assert session._track_lines('rm x\x03') == []
+        assert session._track_lines('pwd\rdate\r') == ['pwd', 'date']
+    
+    def test_pty_client_gets_a_terminal(self, mysh_path):
+        """Test a client asking for PTY mode is given one and it is cleaned up."""
+        from server import socketio, shell_manager, pty_sessions, command_history
+        with patch.object(shell_manager, 'shell_path', mysh_path), \
+                patch('server.SESSION_REATTACH_GRACE', 0), patch('server.PTY_ENABLED', True):
+            client = socketio.test_client(app, auth={'pty': True, 'cols': 80, 'rows': 24})
+            events = client.get_received()
+            names = [e['name'] for e in events]
+            assert 'initial_prompt' not in names
+            info = [e for e in events if e['name'] == 'session_info'][0]['args'][0]
+            assert info['mode'] == 'pty'
+            session_id = info['session_id']
+            
+            client.emit('pty_input', 'echo from-pty\r')
+            received = []
+            deadline = time.time() + 5
+            while time.time() < deadline and 'from-pty\r\n' not in ''.join(received):
+                received.extend(e['args'][0]['data'] for e in client.get_received() if e['name'] == 'output_chunk')
+                time.sleep(0.02)
+            assert 'from-pty\r\n' in ''.join(received)
+            assert command_history[-1]['command'] == 'echo from-pty'
+            
+            client.disconnect()
+            assert session_id not in pty_sessions
+    
+    def test_pty_mode_is_opt_in(self):
+        """Test a client asking for PTY mode gets line mode unless it is enabled."""
+        from server import socketio
+        client = socketio.test_client(app, auth={'pty': True, 'cols': 80, 'rows': 24})
+        try:
+            info = [e for e in client.get_received() if e['name'] == 'session_info'][0]['args'][0]
+            assert info['mode'] == 'line'
+        finally:
+            client.disconnect()
+    
+    def test_typed_lines_pass_the_policy_and_rate_limit(self):
+        """Test Enter is only sent for lines the policy and rate limiter admit."""
+        from server import PtySession, socketio, RateLimiter
+        session = PtySession('pty_test')
+        session.master = 0
+        session.process = MagicMock()
+        written = []
+        with patch.object(session, '_reading_lines', return_value=True), \
+                patch('server.os.write', side_effect=lambda fd, data: written.append(data.decode())), \
+                patch.object(session.stream, 'send') as notices, patch.dict('server.pty_sessions', pty_test=session), \
+                patch('server.current_session_id', return_value='pty_test'), patch('server.client_ip', return_value='ip'), \
+                patch('server.get_redis', return_value=None), patch('server.rate_limiter', RateLimiter()), \
+                patch('server.COMMAND_RATE_LIMIT', 2), patch('server.audit_log.record') as record:
+            from server import handle_pty_input
+            handle_pty_input('dd if=/dev/zero of=/dev/null count=1\r')
+            handle_pty_input('pwd\r')
+            handle_pty_input('ls\r')
+            handle_pty_input('\x1b[Arm -rf /tmp/x\r')
+        assert written == ['dd if=/dev/zero of=/dev/null count=1', '\x15\r', 'pwd', '\r', 'ls', '\x15\r',
+                           '\x1b[Arm -rf /tmp/x', '\x15\r']
+        assert record.call_args_list[0].args[0]['blocked'] == 'dd if=*'
+        assert record.call_args_list[0].args[0]['mode'] == 'pty'
+        assert 'blocked by policy (dd if=*)' in notices.call_args_list[0].args[0]
+        assert 'Rate limit' in notices.call_args_list[1].args[0]
+    
+    def test_raw_mode_programs_are_not_screened(self, mysh_path):
+        """Test only lines the shell reads in canonical mode go through admit()."""
+        import tty
+        from server import PtySession
+        session = PtySession('pty_raw', shell_path=mysh_path)
+        assert session.start()
+        try:
+            admit = MagicMock(return_value=False)
+            assert session._reading_lines()
+            assert session.write('true\r', admit) == []
+            admit.assert_called_once_with('true')
+            tty.setraw(session.master)  # As vim or a REPL would
+            admit.reset_mock()
+            assert not session._reading_lines()
+            assert session.write('dd\r', admit) == []
+            admit.assert_not_called()
+        finally:
+            session.close()
+
+class TestOutputCache:
+    """Test the read-only command output cache."""
+    
+    @staticmethod
+    def make_cache(**kwargs):
+        from server import OutputCache
+        return OutputCache(enabled=True, **kwargs)
+    
+    def test_only_allowlisted_simple_commands_are_cacheable(self, tmp_path):
+        """Test the cache is limited to plain read-only commands."""
+        from server import SessionState
+        cache = self.make_cache()
+        state = SessionState(cwd=str(tmp_path))
+        assert cache.key('ls -l', state) is not None
+        assert cache.key('git log --oneline', state) is not None
+        for cmd in ['rm file', 'git status', 'ls | wc -l', 'cat *.txt', 'cat $HOME/x', 'cat "unterminated']:
+            assert cache.key(cmd, state) is None, cmd
+        state.shell_customized = True
+        assert cache.key('ls -l', state) is None
+    
+    def test_changed_file_invalidates_entry(self, tmp_path):
+        """Test an entry is only served while the files it names are unchanged."""
+        from server import SessionState
+        cache = self.make_cache()
+        target = tmp_path / 'notes.txt'
+        target.write_text('one\n')
+        key = cache.key('cat notes.txt', SessionState(cwd=str(tmp_path)))
+        cache.put(key, cache.fingerprint(key), 'one\n', 0)
+        assert cache.get(key, cache.fingerprint(key))['output'] == 'one\n'
+        
+        target.write_text('one\ntwo\n')
+        assert cache.get(key, cache.fingerprint(key)) is None
+        assert cache.hits == 1 and cache.misses == 1
+    
+    def test_least_recently_used_entries_are_evicted(self):
+        """Test the cache stays within its byte budget, dropping the stalest entries."""
+        cache = self.make_cache(max_bytes=10)
+        for name in 'abc':
+            cache.put(name, (), name * 4, 0)
+            if name == 'b':
+                assert cache.get('a', ()) is not None  # 'a' is now more recent than 'b'
+        assert list(cache.entries) == ['a', 'c']
+        assert cache.size == 8
+    
+    def test_repeated_command_is_served_from_cache(self, tmp_path):
+        """Test a repeat of a cached command is replayed and marked as a hit."""
+        from server import socketio
+        (tmp_path / 'notes.txt').write_text('cached text\n')
+        with patch('server.output_cache', self.make_cache()):
+            client = socketio.test_client(app)
+            client.get_received()
+            try:
+                run_command(client, f'cd {tmp_path}')
+                dones = []
+                for _ in range(2):
+                    received = run_command(client, 'cat notes.txt')
+                    output = ''.join(e['args'][0]['data'] for e in received if e['name'] == 'output_chunk')
+                    assert output == 'cached text\n'
+                    dones.append(received[-1]['args'][0])
+                assert [d['cached'] for d in dones] == [False, True]
+            finally:
+                client.disconnect()
+
+class TestCgroupManager:
+    """Test per-session resource limits."""
+    
+    @staticmethod
+    def make_root(tmp_path, controllers='cpuset cpu io memory pids'):
+        (tmp_path / 'cgroup.controllers').write_text(controllers + '\n')
+        return str(tmp_path)
+    
+    def test_disabled_without_root(self):
+        """Test nothing is touched when no cgroup root is configured."""
+        from server import CgroupManager
+        manager = CgroupManager(root='')
+        assert manager.path('abc') is None
+        assert manager.attach('abc', os.getpid()) is False
+        assert manager.preexec('abc') is None
+    
+    def test_missing_controller_disables_limits(self, tmp_path):
+        """Test limits are off when the root can't hand out every controller."""
+        from server import CgroupManager
+        manager = CgroupManager(root=self.make_root(tmp_path, 'cpu pids'))
+        assert manager.path('abc') is None
+        assert manager.available is False
+    
+    def test_session_group_gets_limits(self, tmp_path):
+        """Test a session's group is created with its limits and joined by its processes."""
+        from server import CgroupManager, stream_subprocess
+        manager = CgroupManager(root=self.make_root(tmp_path), cpu=0.25, memory_max=1024, pids_max=0)
+        group = tmp_path / 'session-abc'
+        assert manager.path('abc') == str(group)
+        assert (tmp_path / 'cgroup.subtree_control').read_text() == '+cpu +memory +pids'
+        assert (group / 'cpu.max').read_text() == '25000 100000'
+        assert (group / 'memory.max').read_text() == '1024'
+        assert (group / 'pids.max').read_text() == 'max'
+        
+        assert manager.attach('abc', 4242)
+        assert (group / 'cgroup.procs').read_text() == '4242'
+        stream_subprocess(['true'], CollectingStream(), preexec_fn=manager.preexec('abc'))
+        assert (group / 'cgroup.procs').read_text() == '0'
+    
+    def test_usage_is_published_per_session(self, tmp_path):
+        """Test the group's counters are exported as session metrics."""
+        from server import CgroupManager
+        from prometheus_client import REGISTRY
+        manager = CgroupManager(root=self.make_root(tmp_path))
+        group = tmp_path / 'session-abc'
+        manager.path('abc')
+        (group / 'cpu.stat').write_text('usage_usec 2500000\nuser_usec 2000000\nthrottled_usec 500000\n')
+        (group / 'memory.current').write_text('1048576\n')
+        (group / 'memory.events').write_text('low 0\nhigh 0\nmax 3\noom 1\noom_kill 1\n')
+        (group / 'pids.current').write_text('7\n')
+        
+        manager.collect()
+        sample = lambda name: REGISTRY.get_sample_value(name, {'session': 'abc'})
+        assert sample('cbash_session_cpu_seconds') == 2.5
+        assert sample('cbash_session_cpu_throttled_seconds') == 0.5
+        assert sample('cbash_session_memory_bytes') == 1048576
+        assert sample('cbash_session_pids') == 7
+        assert sample('cbash_session_oom_kills') == 1
+        
+        with patch('server.socketio.start_background_task') as background:
+            manager.remove('abc')
+        assert sample('cbash_session_cpu_seconds') is None
+        assert background.called  # Not empty here, so deleting it is left to a background task
+    
+    def test_remove_does_not_wait_for_the_group_to_drain(self, tmp_path):
+        """Test an empty group is deleted at once and a busy one in the background."""
+        from server import CgroupManager
+        manager = CgroupManager(root=self.make_root(tmp_path))
+        manager.path('empty')
+        with patch('server.socketio.start_background_task') as background, patch('server.socketio.sleep') as sleep:
+            with patch('server.os.rmdir'):
+                manager.remove('empty')
+            assert not background.called
+            manager.path('busy')
+            with patch('server.os.rmdir', side_effect=OSError(errno.EBUSY, 'busy')):
+                manager.remove('busy')
+            assert not sleep.called
+            drain, group = background.call_args.args
+            with patch('server.os.rmdir', side_effect=[OSError(errno.EBUSY, 'busy'), None]) as rmdir:
+                drain(group)
+            assert rmdir.call_count == 2
+
 class TestSecurity:
     """Test security features."""
     
@@ -129,6 +1322,69 @@ class TestSecurity:
         from server import rate_limit
         assert rate_limit is not None
     
+    def test_local_token_bucket(self):
+        """Test the in-process fallback limits and refills."""
+        from server import RateLimiter
+        limiter = RateLimiter()
+        limits = [('rate_limit:test', 2, 60)]
+        with patch('server.get_redis', return_value=None), patch('server.time.monotonic') as clock:
+            clock.return_value = 100.0
+            assert limiter.allow(limits)
+            assert limiter.allow(limits)
+            assert not limiter.allow(limits)
+            clock.return_value = 130.0  # Half the window refills one token
+            assert limiter.allow(limits)
+            assert not limiter.allow(limits)
+    
+    def test_request_counts_only_if_all_keys_allow(self):
+        """Test a refused multi-key check doesn't use up the other keys."""
+        from server import RateLimiter
+        limiter = RateLimiter()
+        with patch('server.get_redis', return_value=None):
+            assert limiter.allow([('session', 1, 60)])
+            assert not limiter.allow([('ip', 5, 60), ('session', 1, 60)])
+            assert limiter.buckets['ip'][0] == 5
+    
+    def test_redis_check_is_one_script_call(self):
+        """Test Redis limits go through a single script invocation."""
+        from server import RateLimiter
+        redis = MagicMock()
+        script = redis.register_script.return_value
+        script.return_value = 0
+        limiter = RateLimiter()
+        with patch('server.get_redis', return_value=redis):
+            assert limiter.allow([('a', 5, 60), ('b', 10, 1)])
+            script.return_value = 2
+            assert not limiter.allow([('a', 5, 60), ('b', 10, 1)])
+        assert redis.register_script.call_count == 1
+        keys, args = script.call_args.kwargs['keys'], script.call_args.kwargs['args']
+        assert keys == ['a', 'b']
+        assert args[2:] == [5, 60000, 10, 1000]
+        assert not redis.get.called
+    
+    def test_http_route_is_rate_limited(self, client):
+        """Test a decorated route answers 429 once over its limit."""
+        from server import RateLimiter
+        with patch('server.get_redis', return_value=None), patch('server.rate_limiter', RateLimiter()):
+            statuses = [client.get('/api/system-info').status_code for _ in range(11)]
+        assert statuses[:10] == [200] * 10
+        assert statuses[10] == 429
+    
+    def test_command_event_is_rate_limited(self):
+        """Test commands past the per-session limit are refused."""
+        from server import socketio, RateLimiter
+        with patch('server.get_redis', return_value=None), patch('server.rate_limiter', RateLimiter()), \
+                patch('server.COMMAND_RATE_LIMIT', 1):
+            client = socketio.test_client(app)
+            client.get_received()
+            try:
+                run_command(client, 'clear')
+                received = run_command(client, 'clear')
+                assert received[-1]['name'] == 'response'
+                assert 'Rate limit' in received[-1]['args'][0]['output']
+            finally:
+                client.disconnect()
+    
     def test_jwt_token_generation(self):
         """Test JWT token generation and verification."""
         from server import generate_session_token, verify_session_token
@@ -148,6 +1404,161 @@ class TestSecurity:
         result = verify_session_token(invalid_token)
         assert result is None
 
+class TestCommandPolicy:
+    """Test the compiled per-role command policy."""
+    
+    def test_blocklist_sees_through_spelling(self):
+        """Test the default rules match however the command is written."""
+        from server import CommandPolicy
+        policy = CommandPolicy(path='')
+        for cmd in ['rm -rf /', 'rm  -r -f "/"', '/bin/rm -fr /', 'sudo rm -rf /*', 'ls; rm -rf /',
+                    'rm -rf //*', 'rm -rf /./*', 'rm -rf //', 'rm -rf /.', 'rm -rf /tmp/../',
+                    'mkfs.ext4 /dev/sda', 'dd if=/dev/zero of=disk', ':(){ :|:& };:']:
+            assert not policy.check(cmd)[0], cmd
+        for cmd in ['rm -rf /tmp/build', 'rm -rf //tmp/./build', 'ls -la /', 'information', '']:
+            assert policy.check(cmd) == (True, None), cmd
+    
+    def test_embedded_scripts_and_flag_case_are_checked(self):
+        """Test scripts handed to another shell and upper-case flags don't get past the blocklist."""
+        from server import CommandPolicy
+        policy = CommandPolicy(path='')
+        for cmd in ["sh -c 'rm -rf /'", 'bash -c "rm -rf /"', 'eval "rm -rf /"', "echo 'rm -rf /' | sh",
+                    'printf "rm -rf /" | /bin/bash', 'sudo bash -ec "ls; rm -rf /*"', 'rm -Rf /', 'rm -R -f /',
+                    'rm --recursive --force /']:
+            assert not policy.check(cmd)[0], cmd
+        for cmd in ['sh -c "ls -la"', 'echo rm | grep r', 'ls -R /', 'rm --force /tmp/x']:
+            assert policy.check(cmd)[0], cmd
+    
+    def test_decisions_are_cached_by_normalized_command(self):
+        """Test spellings that normalize the same share one cache entry."""
+        from server import CommandPolicy
+        policy = CommandPolicy(path='')
+        for cmd in ['rm -rf /tmp/x', 'rm  -r  -f  /tmp/x', '/bin/rm -fr "/tmp/x"']:
+            assert policy.check(cmd) == (True, None)
+        assert len(policy.decisions) == 1
+    
+    def test_roles_allow_deny_and_inherit(self):
+        """Test default-deny roles need every command allowed, and inherit rules."""
+        from server import CommandPolicy
+        policy = CommandPolicy(path='')
+        policy.load({'default_role': 'user', 'roles': {
+            'user': {'default': 'allow', 'deny': ['shutdown', 'kill -9 *']},
+            'viewer': {'default': 'deny', 'allow': ['ls', 'cat', 'git log'], 'inherit': 'user'}
+        }})
+        assert policy.check('kill -9 1')[0] is False
+        assert policy.check('git push')[0] is True
+        assert policy.check('ls -la', 'viewer')[0] is True
+        assert policy.check('ls | cat', 'viewer')[0] is True
+        assert policy.check('git log --oneline', 'viewer')[0] is True
+        assert policy.check('ls; git push', 'viewer') == (False, 'git is not allowed')
+        assert policy.check('shutdown', 'viewer') == (False, 'shutdown')  # Inherited deny
+        assert policy.check('kill -9 1', 'no-such-role')[0] is False  # Falls back to the default role
+        with pytest.raises(ValueError):
+            policy.load({'roles': {'a': {'inherit': 'b'}}})
+    
+    def test_policy_file_is_hot_reloaded(self, tmp_path):
+        """Test edits to the policy file apply, and a broken file keeps the last policy."""
+        from server import CommandPolicy
+        path = tmp_path / 'policy.json'
+        path.write_text(json.dumps({'roles': {'default': {'deny': ['curl']}}}))
+        policy = CommandPolicy(path=str(path), reload_interval=0)
+        assert policy.check('curl example.com')[0] is False
+        assert policy.check('wget example.com')[0] is True
+        path.write_text(json.dumps({'roles': {'default': {'deny': ['wget']}}}))
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 10**9))
+        assert policy.check('curl example.com')[0] is True
+        assert policy.check('wget example.com')[0] is False
+        path.write_text('{not json')
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 2 * 10**9))
+        assert policy.check('wget example.com')[0] is False
+    
+    def test_blocked_command_never_runs(self):
+        """Test a denied command is answered, audited and counted without executing."""
+        from server import socketio, command_counter, CommandPolicy, generate_role_token
+        policy = CommandPolicy(path='')
+        policy.load({'roles': {'default': {}, 'viewer': {'default': 'deny', 'allow': ['pwd']}}})
+        blocked = command_counter.labels(family='other', status='blocked')
+        before = blocked._value.get()
+        with patch('server.command_policy', policy), patch('server.audit_log.record') as record, \
+                patch('server.command_scheduler.submit', side_effect=AssertionError('queued')):
+            client = socketio.test_client(app, auth={'role_token': generate_role_token('viewer')})
+            client.get_received()
+            try:
+                received = run_command(client, 'whoami')
+            finally:
+                client.disconnect()
+        assert received[-1]['args'][0]['output'] == 'Error: Command blocked by policy (whoami is not allowed)'
+        assert record.call_args.args[0]['blocked'] == 'whoami is not allowed'
+        assert blocked._value.get() == before + 1
+        assert policy.check('whoami', 'viewer') in policy.decisions.values()
+
+    def test_line_breaks_separate_commands(self, tmp_path):
+        """Test each line of a multi-line command must pass an allow-list on its own."""
+        from server import socketio, CommandPolicy, generate_role_token
+        policy = CommandPolicy(path='')
+        policy.load({'roles': {'default': {}, 'viewer': {'default': 'deny', 'allow': ['ls']}}})
+        marker = tmp_path / 'pwned'
+        for cmd in ['ls\nid', 'ls\r\nid', f'ls static\ntouch {marker}', 'ls |\nsh', 'ls "\nid']:
+            assert not policy.check(cmd, 'viewer')[0], cmd
+        assert policy.check('ls\nid', 'viewer') == (False, 'id is not allowed')
+        assert policy.check('ls\nls -la', 'viewer')[0] is True
+        with patch('server.command_policy', policy):
+            client = socketio.test_client(app, auth={'role_token': generate_role_token('viewer')})
+            client.get_received()
+            try:
+                received = run_command(client, f'ls static\ntouch {marker}')
+            finally:
+                client.disconnect()
+        assert received[-1]['args'][0]['output'] == 'Error: Command blocked by policy (touch is not allowed)'
+        assert not marker.exists()
+    
+class TestAsyncBackend:
+    """Test the async backend switch."""
+    
+    def test_socketio_uses_configured_mode(self):
+        """Test Socket.IO runs in the mode chosen by CBASH_ASYNC_MODE."""
+        import server
+        assert server.ASYNC_MODE == os.environ.get('CBASH_ASYNC_MODE', 'threading')
+        assert server.socketio.async_mode == server.ASYNC_MODE
+
+class TestLifecycle:
+    """Test the app factory and subsystem lifecycle."""
+    
+    def test_import_starts_nothing(self):
+        """Test importing the server starts no threads and no Redis connection."""
+        code = ('import threading, server; '
+                'print(threading.active_count(), server.redis_manager.started, '
+                'server.system_sampler.started, server.audit_log.started)')
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=60,
+                                cwd=os.path.join(os.path.dirname(__file__), '..'))
+        assert result.stdout.split() == ['1', 'False', 'False', 'False']
+    
+    def test_create_app_starts_subsystems_on_request(self):
+        """Test create_app only starts subsystems when configured to."""
+        import server
+        with patch('server.start_subsystems') as start, patch('server.atexit.register') as register:
+            assert server.create_app() is app
+            start.assert_not_called()
+            assert server.create_app({'START_SUBSYSTEMS': True}) is app
+        start.assert_called_once()
+        register.assert_called_once_with(server.stop_subsystems)
+        app.config.pop('START_SUBSYSTEMS')
+    
+    def test_audit_log_stop_flushes_pending(self):
+        """Test stopping the audit log writes out what is still buffered."""
+        from server import AuditLog
+        log = AuditLog(batch_size=2)
+        log.started = True  # Keep the flush task out of the way
+        redis = MagicMock()
+        with patch('server.get_redis', return_value=redis):
+            for n in range(3):
+                log.record({'command': f'echo {n}'})
+            assert len(log.pending) == 3
+            log.stop()
+        assert log.stopped
+        assert not log.pending
+        assert redis.pipeline.return_value.execute.call_count == 2
+
 class TestPerformanceMonitoring:
     """Test performance monitoring features."""
     
@@ -166,25 +1577,282 @@ class TestPerformanceMonitoring:
         assert cpu == 15.5
         assert memory == 30.2
 
+    def test_command_names_map_to_bounded_families(self):
+        """Test metric labels come from a fixed set of command families."""
+        from server import command_family, COMMAND_FAMILIES
+        assert command_family('ls') == 'files'
+        assert command_family('/usr/bin/git') == 'vcs'
+        assert command_family('cd') == 'builtin'
+        assert command_family('definitely-a-typo') == 'other'
+        assert command_family('') == 'other'
+        assert len(COMMAND_FAMILIES) < 20
+    
+    def test_streamed_command_records_stage_metrics(self):
+        """Test a streamed command is timed per stage and counted by family."""
+        from server import socketio
+        from prometheus_client import REGISTRY
+        
+        def count(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+        
+        stages = ['execute', 'output', 'emit']
+        before = {stage: count('cbash_command_stage_seconds_count', stage=stage) for stage in stages}
+        commands_before = count('cbash_commands_total', family='text', status='success')
+        bytes_before = count('cbash_command_output_bytes_sum', family='text')
+        emits_before = count('cbash_emit_seconds_count', event='command_done')
+        
+        client = socketio.test_client(app)
+        try:
+            run_command(client, 'printf metrics')
+        finally:
+            client.disconnect()
+        
+        for stage in stages:
+            assert count('cbash_command_stage_seconds_count', stage=stage) == before[stage] + 1
+        assert count('cbash_commands_total', family='text', status='success') == commands_before + 1
+        assert count('cbash_command_output_bytes_sum', family='text') == bytes_before + len('metrics')
+        assert count('cbash_emit_seconds_count', event='command_done') == emits_before + 1
+
+    def test_execute_stage_leaves_out_shell_start(self):
+        """Test time spent getting the session's shell isn't counted as execution."""
+        from server import socketio, shell_manager, command_stages
+        execute = command_stages.labels(stage='execute')
+        
+        def slow_get_shell(*args, **kwargs):
+            time.sleep(0.5)
+            return None  # Run it as a subprocess instead
+        
+        client = socketio.test_client(app)
+        try:
+            before = execute._sum.get()
+            with patch.object(shell_manager, 'get_shell', side_effect=slow_get_shell):
+                run_command(client, 'true')
+            assert execute._sum.get() - before < 0.4
+        finally:
+            client.disconnect()
+    
+    def test_ring_buffer_wraps_and_downsamples(self):
+        """Test the ring buffer keeps the newest samples and averages them down."""
+        from server import RingBuffer
+        buffer = RingBuffer(['cpu'], capacity=4)
+        for t in range(6):
+            buffer.append(float(t), {'cpu': t * 10.0})
+        assert buffer.latest() == {'time': 5.0, 'cpu': 50.0}
+        assert buffer.series() == {'time': [2.0, 3.0, 4.0, 5.0], 'cpu': [20.0, 30.0, 40.0, 50.0]}
+        assert buffer.series(start=3.5) == {'time': [4.0, 5.0], 'cpu': [40.0, 50.0]}
+        assert buffer.series(points=2) == {'time': [2.0, 4.0], 'cpu': [25.0, 45.0]}
+        total, rows = buffer.since(4)
+        assert total == 6 and [row['time'] for row in rows] == [4.0, 5.0]
+    
+    def test_flush_is_one_pipelined_call_per_worker(self):
+        """Test new samples reach Redis in a single round trip under this worker's key."""
+        from server import SystemSampler, WORKER_ID
+        sampler = SystemSampler(capacity=10)
+        sampler.sample()
+        sampler.sample()
+        mock_client = MagicMock()
+        pipe = mock_client.pipeline.return_value
+        with patch('server.get_redis', return_value=mock_client):
+            assert sampler.flush()
+            assert sampler.flush()  # Nothing new to send
+        assert mock_client.pipeline.call_count == 1
+        pipe.execute.assert_called_once()
+        key, members = pipe.zadd.call_args.args
+        assert key == f'cbash:metrics:{WORKER_ID}'
+        assert len(members) == 2
+    
+    def test_history_endpoint_downsamples(self, client):
+        """Test the history endpoint returns at most the requested points."""
+        from server import system_sampler
+        for _ in range(3):
+            system_sampler.sample()
+        data = json.loads(client.get('/api/system-history?seconds=600&points=2').data)
+        assert len(data['series']['time']) <= 2
+        assert set(data['series']) == {'time', 'cpu', 'memory', 'disk', 'worker_cpu', 'worker_rss'}
+        assert client.get('/api/system-history?points=x').status_code == 400
+
+class TestBuiltins:
+    """Test commands run in-process by the builtin registry."""
+    
+    def test_trivial_commands(self, tmp_path):
+        """Test pwd, echo, export and env use the session state."""
+        from server import SessionState
+        state = SessionState(cwd=str(tmp_path))
+        assert run_builtin('pwd', state) == (0, str(tmp_path))
+        assert run_builtin('export GREETING=hello', state) == (0, '')
+        assert run_builtin('echo $GREETING "two  words"', state) == (0, 'hello two  words')
+        assert state.environ()['GREETING'] == 'hello'
+        assert 'GREETING=hello' in run_builtin('env', state)[1].split('\n')
+        assert run_builtin('export 1BAD=x', state)[0] == 1
+        assert run_builtin('true', state) == (0, '')
+        assert run_builtin('false', state) == (1, '')
+    
+    def test_shell_features_are_left_to_the_shell(self):
+        """Test command lines a builtin can't reproduce faithfully aren't taken."""
+        from server import resolve_builtin, SessionState
+        state = SessionState()
+        for cmd in ['echo hi > out.txt', 'echo *.py', "echo '$HOME'", 'echo -n hi', 'pwd | wc -c',
+                    'env FOO=1 ls', 'ls -la', 'echo "unbalanced']:
+            assert resolve_builtin(cmd, state) is None, cmd
+        state.shell_customized = True  # Aliases might redefine them now
+        assert resolve_builtin('echo hi', state) is None
+        assert resolve_builtin('cd /tmp', state) is not None
+    
+    def test_builtins_run_inline_without_a_shell(self):
+        """Test a builtin answers with a response and never reaches a shell."""
+        from server import socketio
+        with patch('server.stream_subprocess', side_effect=AssertionError('forked')), \
+                patch.object(shell_manager, 'execute', side_effect=AssertionError('sent to shell')), \
+                patch('server.command_scheduler.submit', side_effect=AssertionError('queued')):
+            client = socketio.test_client(app)
+            client.get_received()
+            try:
+                received = run_command(client, 'echo hello')
+            finally:
+                client.disconnect()
+        assert received[-1]['name'] == 'response'
+        assert received[-1]['args'][0]['output'] == 'hello'
+    
+    def test_run_now_defers_to_queued_work(self):
+        """Test inline runs wait their turn behind a session's running command."""
+        from server import CommandScheduler
+        scheduler = CommandScheduler(workers=1)
+        ran = []
+        assert scheduler.run_now('s', lambda: ran.append('first'))
+        scheduler.running.add('s')
+        assert not scheduler.run_now('s', lambda: ran.append('second'))
+        assert ran == ['first']
+
 class TestCBashCommands:
     """Test custom CBash commands."""
     
     def test_cbash_status_command(self):
-        """Test cbash status command functionality."""
-        # This would test the custom cbash status command
-        # For now, we ensure the function exists
-        from server import handle_cbash_command
-        assert handle_cbash_command is not None
+        """Test cbash status reports the session and system usage."""
+        from server import system_sampler
+        system_sampler.sample()
+        exit_code, output = run_builtin('cbash status', session_id='status-session')
+        status = json.loads(output)
+        assert exit_code == 0
+        assert status['session_id'] == 'status-session'
+        assert 'cpu_usage' in status and 'memory_usage' in status
     
     def test_cbash_history_command(self):
-        """Test cbash history command functionality."""
-        # Test would verify history command works correctly
-        pass
+        """Test cbash history lists the session's commands, oldest first."""
+        from server import AuditLog
+        with patch('server.get_redis', return_value=None), patch('server.command_history', deque(maxlen=1000)), \
+                patch('server.audit_log', AuditLog()) as log:
+            for cmd in ['ls', 'git status', 'git log']:
+                log.record({'command': cmd, 'session_id': 'hist'})
+            log.record({'command': 'pwd', 'session_id': 'other'})
+            assert run_builtin('cbash history', session_id='hist') == (0, '1: ls\n2: git status\n3: git log')
+            assert run_builtin('cbash history 5 git', session_id='hist') == (0, '1: git status\n2: git log')
+            assert run_builtin('history 2', session_id='hist') == (0, '    1  git status\n    2  git log')
     
     def test_cbash_sessions_command(self):
-        """Test cbash sessions command functionality."""
-        # Test would verify sessions command works correctly
-        pass
+        """Test cbash sessions lists the registered sessions."""
+        from collections import OrderedDict
+        now = datetime.utcnow()
+        sessions = OrderedDict(listed={'connected_at': now, 'last_activity': now, 'command_count': 4})
+        with patch('server.get_redis', return_value=None), patch('server.user_sessions', sessions), \
+                patch('server.session_registry.worker_id', 'w1'):
+            exit_code, output = run_builtin('cbash sessions', session_id='listed')
+        assert exit_code == 0
+        assert json.loads(output) == [{'session_id': 'listed...', 'connected_at': now.isoformat(),
+                                       'command_count': 4, 'worker': 'w1'}]
+    
+    def test_history_includes_unflushed_commands(self):
+        """Test commands still waiting for the audit flush show up in history."""
+        from server import AuditLog
+        redis = MagicMock()
+        redis.xrevrange.return_value = []
+        with patch('server.get_redis', return_value=redis), patch('server.command_history', deque(maxlen=1000)), \
+                patch('server.audit_log', AuditLog()) as log, patch.object(log, 'start'):
+            log.record({'command': 'make', 'session_id': 'fresh', 'timestamp': datetime.utcnow().isoformat()})
+            assert list(log.pending)
+            assert run_builtin('history', session_id='fresh') == (0, '    1  make')
+    
+    def test_history_zero_is_empty(self):
+        """Test asking for no commands returns none rather than the whole history."""
+        from server import AuditLog
+        with patch('server.get_redis', return_value=None), patch('server.command_history', deque(maxlen=1000)), \
+                patch('server.audit_log', AuditLog()) as log, patch.object(log, 'start'):
+            for cmd in ['make', 'make test']:
+                log.record({'command': cmd, 'session_id': 'zero', 'timestamp': datetime.utcnow().isoformat()})
+            assert run_builtin('history 0', session_id='zero') == (0, '')
+            assert log.recent_for_session('zero', limit=0) == []
+            assert log.query(session_id='zero', limit=0) == ([], None)
+            assert run_builtin('history 1', session_id='zero') == (0, '    1  make test')
+    
+    def test_unknown_cbash_command_shows_help(self):
+        """Test unknown subcommands get the list of commands."""
+        exit_code, output = run_builtin('cbash nope')
+        assert exit_code == 1
+        assert 'Available CBash commands' in output and 'sessions' in output
+
+class TestCompletion:
+    """Test tab completion of commands and paths."""
+    
+    def test_path_completion_from_cached_listings(self, tmp_path):
+        """Test paths complete relative to the cwd and listings refresh on change."""
+        from server import Completer, SessionState
+        (tmp_path / 'notes.txt').write_text('')
+        (tmp_path / 'notebook').mkdir()
+        (tmp_path / '.profile').write_text('')
+        state = SessionState(cwd=str(tmp_path))
+        completer = Completer()
+        assert completer.complete('cat no', state) == ('path', 4, ['notebook/', 'notes.txt'])
+        assert completer.complete('cd no', state)[2] == ['notebook/']
+        assert completer.complete('ls notebook/../.p', state)[2] == ['notebook/../.profile']
+        assert completer.complete(f'ls {tmp_path}/not', state)[2] == [f'{tmp_path}/notebook/', f'{tmp_path}/notes.txt']
+        listing = state.listings[str(tmp_path)]
+        assert completer.complete('cat no', state)[2] and state.listings[str(tmp_path)] is listing
+        (tmp_path / 'nothing').write_text('')
+        os.utime(tmp_path, ns=(time.time_ns(), time.time_ns() + 10**9))
+        assert completer.complete('cat noth', state)[2] == ['nothing']
+    
+    def test_listing_cache_is_per_session_lru(self, tmp_path):
+        """Test each session keeps only its most recent directory listings."""
+        from server import Completer, SessionState
+        for name in 'abc':
+            (tmp_path / name).mkdir()
+        state, other = SessionState(cwd=str(tmp_path)), SessionState(cwd=str(tmp_path))
+        completer = Completer(dir_cache_size=2)
+        for name in 'abc':
+            completer.complete(f'ls {name}/', state)
+        assert list(state.listings) == [str(tmp_path / 'b'), str(tmp_path / 'c')]
+        assert not other.listings
+    
+    def test_command_completion(self, tmp_path):
+        """Test command names come from builtins and PATH, and cbash subcommands complete."""
+        from server import Completer, SessionState
+        tool = tmp_path / 'cbtool'
+        tool.write_text('#!/bin/sh\n')
+        tool.chmod(0o755)
+        (tmp_path / 'cbdata').write_text('')  # Not executable
+        state = SessionState(env={'PATH': str(tmp_path)})
+        completer = Completer()
+        assert completer.complete('cb', state) == ('command', 0, ['cbash', 'cbtool'])
+        assert completer.complete('ls | cbt', state) == ('command', 5, ['cbtool'])
+        assert completer.complete('cbash st', state) == ('cbash', 6, ['status'])
+        newer = tmp_path / 'cbtool2'
+        newer.write_text('#!/bin/sh\n')
+        newer.chmod(0o755)
+        os.utime(tmp_path, ns=(time.time_ns(), time.time_ns() + 10**9))
+        assert completer.complete('cbt', state)[2] == ['cbtool', 'cbtool2']
+    
+    def test_complete_event_answers_in_the_ack(self):
+        """Test the Socket.IO event returns matches tagged with the request id."""
+        from server import socketio
+        client = socketio.test_client(app)
+        try:
+            result = client.emit('complete', {'id': 7, 'line': 'cbash he'}, callback=True)
+            assert client.emit('complete', 'bad', callback=True) == {'error': 'invalid request'}
+        finally:
+            client.disconnect()
+        assert result['id'] == 7
+        assert result['start'] == 6
+        assert result['matches'] == ['help'] and result['common'] == 'help'
+        assert result['prompt'].endswith(' $ ')
 
 class TestErrorHandling:
     """Test error handling and resilience."""